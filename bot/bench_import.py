@@ -0,0 +1,125 @@
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+"""
+Slack Lambdaのコールドスタートの計測。
+新しいPythonプロセスで slack_bot を読み込み、-X importtime の出力からモジュールごとの読み込み時間を集計する。
+--budget-ms を指定すると読み込み時間が予算を超えた場合に終了コード1を返す。
+予算は tests/test_import_budget.py でも検査する。
+
+使用例:
+python bench_import.py --runs 5 --budget-ms 800
+python bench_import.py --module pipeline --top 30
+"""
+
+_importtime_pattern = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+_bot_dir = Path(__file__).resolve().parent
+
+# slack_bot の読み込み時間の予算（-X importtime の合計）
+IMPORT_BUDGET_MS = 500
+
+# 読み込み時に参照される環境変数。値は使われないのでダミーでよい
+_env = {
+    "SLACK_BOT_TOKEN": "xoxb-dummy",
+    "SLACK_SIGNING_SECRET": "dummy",
+    "AWS_REGION": "us-west-2",
+    "AWS_DEFAULT_REGION": "us-west-2",
+}
+
+
+def _run(module: str, importtime: bool, code: str = "") -> tuple[float, str]:
+    # code は読み込んだ後に実行する。出力は標準エラーに書くと戻り値で受け取れる
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", f"import {module}\n{code}"]
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        command,
+        cwd=_bot_dir,
+        env={**os.environ, **_env},
+        capture_output=True,
+        text=True,
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def _parse_importtime(output: str) -> list[tuple[str, int, int, int]]:
+    # (モジュール名, self[us], cumulative[us], ネストの深さ)
+    rows = []
+    for line in output.splitlines():
+        match = _importtime_pattern.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def _total_ms(rows: list[tuple[str, int, int, int]], module: str) -> float:
+    # インタープリター起動時の読み込み（encodingsやsite）を除き、対象モジュール以下だけを数える
+    return next(row[2] for row in rows if row[0] == module and row[3] == 0) / 1000
+
+
+def measure_import_ms(module: str) -> float:
+    """新しいプロセスで module を読み込み、-X importtime で計測した読み込み時間を返す"""
+    return _total_ms(_parse_importtime(_run(module, importtime=True)[1]), module)
+
+
+def imported_modules(module: str, candidates: list[str]) -> list[str]:
+    """新しいプロセスで module を読み込み、candidates のうち読み込まれたものを返す"""
+    code = (
+        "import sys\n"
+        f"print(*(m for m in {candidates!r} if m in sys.modules), file=sys.stderr)"
+    )
+    _, output = _run(module, importtime=False, code=code)
+    return output.split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="slack_bot")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    # 1回目はファイルシステムのキャッシュやpycの生成が入るので捨てる
+    _run(args.module, importtime=False)
+    wall_times = [_run(args.module, importtime=False)[0] for _ in range(args.runs)]
+
+    _, output = _run(args.module, importtime=True)
+    rows = _parse_importtime(output)
+    total_ms = _total_ms(rows, args.module)
+
+    print(f"Top {args.top} modules by cumulative import time:")
+    print(f"{'cumulative[ms]':>15} {'self[ms]':>10}  module")
+    for name, self_us, cumulative_us, _ in sorted(
+        rows, key=lambda row: row[2], reverse=True
+    )[: args.top]:
+        print(f"{cumulative_us / 1000:>15.1f} {self_us / 1000:>10.1f}  {name}")
+
+    print()
+    print(f"import {args.module}: {total_ms:.1f} ms (importtime total)")
+    print(
+        f"process start + import: median {statistics.median(wall_times):.1f} ms, "
+        f"max {max(wall_times):.1f} ms over {args.runs} runs"
+    )
+
+    if total_ms > args.budget_ms:
+        print(f"Import time {total_ms:.1f} ms exceeds budget {args.budget_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
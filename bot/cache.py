@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from pynamodb.models import Model
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+
+import config
+
+"""
+検索やリランクの結果をキャッシュする。
+DiscordのFargateタスクはプロセス内のメモリに、SlackのLambdaは呼び出しをまたいで共有できるDynamoDBに持つ。
+キーにはKnowledge BaseのIDとコーパスのバージョンを含めるので、クローラーが新しいコーパスを公開して
+CORPUS_VERSION が変われば古いエントリは参照されなくなる（DynamoDB側はTTLで消える）。
+"""
+
+logger = logging.getLogger(__name__)
+
+_whitespace_pattern = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    # 大文字小文字・空白・末尾の句読点の違いでキャッシュが外れないようにする
+    text = _whitespace_pattern.sub(" ", text).strip().lower()
+    return text.rstrip("?？.。!！ ")
+
+
+def make_key(*parts: Any) -> str:
+    payload = json.dumps(
+        [config.KNOWLEDGE_BASE_ID, config.CORPUS_VERSION, *parts],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Cache:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        self._set(key, value)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Any):
+        raise NotImplementedError
+
+
+class NullCache(Cache):
+    def _get(self, key: str) -> Optional[Any]:
+        return None
+
+    def _set(self, key: str, value: Any):
+        pass
+
+
+class MemoryCache(Cache):
+    """プロセス内のLRUキャッシュ。TTLを過ぎたエントリは参照時に捨てる"""
+
+    def __init__(self, ttl: int, max_size: int):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class CacheModel(Model):
+    class Meta:
+        table_name = os.environ.get("CACHE_TABLE_NAME", "")
+
+    cache_key = UnicodeAttribute(hash_key=True)
+    value = UnicodeAttribute()
+    ttl = NumberAttribute()
+
+
+# DynamoDBのアイテムサイズ上限(400KB)に余裕を持たせる
+_MAX_ITEM_BYTES = 350 * 1024
+
+
+class DynamoDBCache(Cache):
+    """
+    Lambdaの呼び出し間で共有するキャッシュ。
+    期限切れはDynamoDBのTTLで削除されるが、削除は遅延するので参照時にも期限を確認する。
+    """
+
+    def _get(self, key: str) -> Optional[Any]:
+        try:
+            item = CacheModel.get(key)
+        except CacheModel.DoesNotExist:
+            return None
+        if item.ttl < time.time():
+            return None
+        return json.loads(item.value)
+
+    def _set(self, key: str, value: Any):
+        serialized = json.dumps(value, ensure_ascii=False)
+        if len(serialized.encode()) > _MAX_ITEM_BYTES:
+            return
+        item = CacheModel()
+        item.cache_key = key
+        item.value = serialized
+        item.ttl = int(time.time()) + self.ttl
+        item.save()
+
+
+class _SafeCache(Cache):
+    # キャッシュの障害で回答できなくなるのは本末転倒なので、エラーはログに出して無視する
+    def __init__(self, cache: Cache):
+        super().__init__(cache.ttl)
+        self._cache = cache
+
+    def _get(self, key: str) -> Optional[Any]:
+        try:
+            return self._cache._get(key)
+        except Exception as e:
+            logger.warning("Cache get failed: %r", e)
+            return None
+
+    def _set(self, key: str, value: Any):
+        try:
+            self._cache._set(key, value)
+        except Exception as e:
+            logger.warning("Cache set failed: %r", e)
+
+
+def create_cache(backend: str) -> Cache:
+    if backend == "memory":
+        cache = MemoryCache(config.CACHE_TTL, config.CACHE_MAX_SIZE)
+    elif backend == "dynamodb":
+        cache = DynamoDBCache(config.CACHE_TTL)
+    elif backend == "none":
+        cache = NullCache(config.CACHE_TTL)
+    else:
+        raise ValueError(f"Unknown cache backend: {backend}")
+    return _SafeCache(cache)
+
+
+retrieval_cache = create_cache(config.RETRIEVAL_CACHE_BACKEND)
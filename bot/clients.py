@@ -1,7 +1,254 @@
-import boto3
-from botocore.config import Config
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import AsyncExitStack
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
 
+import config
 
-bedrock_runtime_config = Config(retries={"max_attempts": 10, "mode": "standard"})
-bedrock_runtime_client = boto3.client("bedrock-runtime", config=bedrock_runtime_config)
-bedrock_agent_client = boto3.client("bedrock-agent-runtime")
+"""
+AWSクライアントの作成を一か所にまとめる。
+
+- boto3の読み込みとクライアントの作成は重いので、最初に使われるまで遅らせる
+- 接続プールの大きさは並列数に合わせ、接続と読み込みのタイムアウトを設定する
+  （botocoreのタイムアウトはクライアント単位なので、接続プールを分けないようサービス単位で設定する）
+- リトライは adaptive モード。botocoreのリトライクォータ（トークンバケット）がリトライ予算として働き、
+  Bedrockが不調なときにリトライが雪崩のように増えるのを防ぐ
+- retrieve と rerank はヘッジリクエストに対応する。p95の時間を過ぎても返ってこなければ
+  同じリクエストをもう1つ送り、先に返ってきた方を使う。p95は実行を始めてからの時間で測り、
+  同時に走るヘッジの数には上限を設ける
+
+エンドポイントURLを環境変数で差し替えられるので、ローカルのスタブに向けて動作を確認できる。
+
+Discord Botのようにasyncioで動くプロセス向けに、aioboto3のクライアントも同じ設定で作る。
+セッションは1つだけ作り、クライアントはプロセスが終わるまで使い回す。
+"""
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clients: dict = {}
+
+
+def _client_config_kwargs(read_timeout: float) -> dict:
+    return {
+        "region_name": config.REGION_NAME,
+        "connect_timeout": config.AWS_CONNECT_TIMEOUT,
+        "read_timeout": read_timeout,
+        "max_pool_connections": config.AWS_MAX_POOL_CONNECTIONS,
+        "retries": {"mode": "adaptive", "total_max_attempts": config.AWS_MAX_ATTEMPTS},
+    }
+
+
+def create_client(service_name: str):
+    import boto3
+    from botocore.config import Config
+
+    client_config = Config(**_client_config_kwargs(config.READ_TIMEOUTS[service_name]))
+    return boto3.client(
+        service_name,
+        config=client_config,
+        endpoint_url=config.AWS_ENDPOINT_URLS.get(service_name) or None,
+    )
+
+
+def _get_client(service_name: str):
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    # デフォルトセッションからのクライアント作成はスレッドセーフではないのでロックを取る
+    with _lock:
+        if service_name not in _clients:
+            _clients[service_name] = create_client(service_name)
+        return _clients[service_name]
+
+
+def get_bedrock_runtime_client():
+    return _get_client("bedrock-runtime")
+
+
+def get_bedrock_agent_client():
+    return _get_client("bedrock-agent-runtime")
+
+
+_async_session = None
+_async_exit_stack: Optional[AsyncExitStack] = None
+_async_clients: dict = {}
+_async_lock: Optional[asyncio.Lock] = None
+
+
+async def _get_async_client(service_name: str):
+    global _async_session, _async_exit_stack, _async_lock
+    client = _async_clients.get(service_name)
+    if client is not None:
+        return client
+
+    if _async_lock is None:
+        _async_lock = asyncio.Lock()
+    async with _async_lock:
+        if service_name not in _async_clients:
+            import aioboto3
+            from aiobotocore.config import AioConfig
+
+            if _async_session is None:
+                _async_session = aioboto3.Session()
+                _async_exit_stack = AsyncExitStack()
+            read_timeout = config.READ_TIMEOUTS[service_name]
+            _async_clients[service_name] = await _async_exit_stack.enter_async_context(
+                _async_session.client(
+                    service_name,
+                    config=AioConfig(**_client_config_kwargs(read_timeout)),
+                    endpoint_url=config.AWS_ENDPOINT_URLS.get(service_name) or None,
+                )
+            )
+        return _async_clients[service_name]
+
+
+async def get_async_bedrock_runtime_client():
+    return await _get_async_client("bedrock-runtime")
+
+
+async def get_async_bedrock_agent_client():
+    return await _get_async_client("bedrock-agent-runtime")
+
+
+async def close_async_clients():
+    global _async_session, _async_exit_stack
+    if _async_exit_stack is not None:
+        await _async_exit_stack.aclose()
+    _async_clients.clear()
+    _async_session = None
+    _async_exit_stack = None
+
+
+class _LatencyTracker:
+    def __init__(self, window: int):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < config.HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+
+_trackers: dict = {}
+_hedge_executor = ThreadPoolExecutor(max_workers=config.HEDGE_MAX_WORKERS)
+_hedge_slots = threading.BoundedSemaphore(config.HEDGE_MAX_IN_FLIGHT)
+
+
+def _timed_call(
+    tracker: _LatencyTracker,
+    func: Callable,
+    kwargs: dict,
+    started_event: Optional[threading.Event] = None,
+):
+    if started_event is not None:
+        started_event.set()
+    started = time.monotonic()
+    result = func(**kwargs)
+    tracker.record(time.monotonic() - started)
+    return result
+
+
+def _get_tracker(operation: str) -> _LatencyTracker:
+    return _trackers.setdefault(operation, _LatencyTracker(config.HEDGE_WINDOW))
+
+
+def call_hedged(operation: str, func: Callable, **kwargs):
+    """
+    func(**kwargs) を呼び出す。p95の時間を過ぎても返ってこなければ同じ呼び出しをもう1つ送り、
+    先に成功した方の結果を返す。負けた方はキャンセルできないので裏で完了させて捨てる。
+    """
+    tracker = _get_tracker(operation)
+    delay = tracker.percentile(0.95) if config.HEDGE_ENABLED else None
+    if delay is None:
+        # 計測が足りないうちはヘッジしない
+        return _timed_call(tracker, func, kwargs)
+
+    started_event = threading.Event()
+    primary = _hedge_executor.submit(_timed_call, tracker, func, kwargs, started_event)
+    # スレッドの空き待ちの時間はp95に含めず、実行が始まってから待つ
+    started_event.wait()
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    # 同時に走っているヘッジが上限に達していれば、元のリクエストを待つだけにする
+    if not _hedge_slots.acquire(blocking=False):
+        return primary.result()
+
+    logger.info("Hedging %s after %.2fs", operation, delay)
+    hedge = _hedge_executor.submit(_timed_call, tracker, func, kwargs)
+    hedge.add_done_callback(lambda _: _hedge_slots.release())
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def _atimed_call(tracker: _LatencyTracker, func: Callable, kwargs: dict):
+    started = time.monotonic()
+    result = await func(**kwargs)
+    tracker.record(time.monotonic() - started)
+    return result
+
+
+async def acall_hedged(operation: str, func: Callable, **kwargs):
+    """
+    call_hedged の非同期版。こちらは負けた方のリクエストをキャンセルできる。
+    ヘッジの同時実行数の上限は同期版と共有する。
+    """
+    tracker = _get_tracker(operation)
+    delay = tracker.percentile(0.95) if config.HEDGE_ENABLED else None
+    if delay is None:
+        return await _atimed_call(tracker, func, kwargs)
+
+    primary = asyncio.ensure_future(_atimed_call(tracker, func, kwargs))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+    except asyncio.CancelledError:
+        # 呼び出し側がキャンセルされたら、送ったリクエストも止める
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+
+    # 同期版と同じ上限を共有する。上限に達していれば元のリクエストを待つだけにする
+    # （タスクを直接待つので、呼び出し側のキャンセルはそのまま primary に伝わる）
+    if not _hedge_slots.acquire(blocking=False):
+        return await primary
+
+    logger.info("Hedging %s after %.2fs", operation, delay)
+    hedge = asyncio.ensure_future(_atimed_call(tracker, func, kwargs))
+    hedge.add_done_callback(lambda _: _hedge_slots.release())
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
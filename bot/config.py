@@ -15,11 +15,145 @@ RERANK_MODEL_ID = "amazon.rerank-v1:0"
 # Knowledge BaseのID
 KNOWLEDGE_BASE_ID = os.environ.get("KNOWLEDGE_BASE_ID", "R4XR9BKK70")
 
+# 前回のメッセージからこの秒数以上空いていれば新しい会話とみなす
+CONTINUITY_MAX_GAP = int(os.environ.get("CONTINUITY_MAX_GAP", str(60 * 60 * 6)))
+# 前回のメッセージからこの秒数以内なら会話の続きとみなす
+CONTINUITY_MIN_GAP = int(os.environ.get("CONTINUITY_MIN_GAP", "120"))
+# 直前のやりとりとの文字bigramの類似度がこの値以上なら会話の続きとみなす
+CONTINUITY_SIMILARITY_THRESHOLD = 0.3
+
+# 会話履歴のうち、そのまま残す直近のメッセージ数。これより古いものは要約にまとめる
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "10"))
+# 会話履歴のトークン数の上限（概算）
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "4000"))
+
+# 指示文とツール定義にキャッシュポイントを付け、Bedrockのプロンプトキャッシュを使う
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE_ENABLED", "false") == "true"
+# プロンプトキャッシュに対応したモデル（IDに含まれる文字列）と、キャッシュされるプレフィックスの最小トークン数
+# ここにないモデルにキャッシュポイントを送るとValidationExceptionになることがあるので送らない
+PROMPT_CACHE_MIN_TOKENS = {
+    "anthropic.claude-3-7-sonnet": 1024,
+    "anthropic.claude-3-5-haiku": 2048,
+    "anthropic.claude-sonnet-4": 1024,
+    "anthropic.claude-opus-4": 1024,
+}
+
 # クエリごとにこの件数のドキュメントを取得する
 RETRIEVE_DOCUMENTS_PER_QUERY = 20
 
+# クエリを並列に検索する際の最大同時実行数
+RETRIEVE_MAX_WORKERS = int(os.environ.get("RETRIEVE_MAX_WORKERS", "4"))
+
+# AWSクライアントの設定。接続プールは検索の並列数と回答生成が同時に使える大きさにする
+AWS_MAX_POOL_CONNECTIONS = int(
+    os.environ.get("AWS_MAX_POOL_CONNECTIONS", str(RETRIEVE_MAX_WORKERS * 2 + 2))
+)
+AWS_CONNECT_TIMEOUT = float(os.environ.get("AWS_CONNECT_TIMEOUT", "3"))
+# リトライを含めた最大試行回数
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "5"))
+# サービスごとの読み込みタイムアウト（秒）。回答生成は長くかかるので長めにする
+# 接続プールを分けないよう、クライアントはサービスごとに1つにしてタイムアウトもサービス単位にする
+READ_TIMEOUTS = {
+    "bedrock-runtime": 60.0,
+    "bedrock-agent-runtime": 10.0,
+}
+# ローカルのスタブなどに向ける場合に指定する
+AWS_ENDPOINT_URLS = {
+    "bedrock-runtime": os.environ.get("BEDROCK_RUNTIME_ENDPOINT_URL", ""),
+    "bedrock-agent-runtime": os.environ.get("BEDROCK_AGENT_RUNTIME_ENDPOINT_URL", ""),
+}
+
+# retrieve と rerank で、p95の時間を過ぎたら同じリクエストをもう1つ送る
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "true") == "true"
+# p95の計算に使う直近の件数と、ヘッジを始めるのに必要な件数
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# ヘッジ用のスレッド数。検索の並列数とリランキングの分だけ、元のリクエストとヘッジが同時に走れる大きさにする
+HEDGE_MAX_WORKERS = (RETRIEVE_MAX_WORKERS + 1) * 2
+# 同時に走らせるヘッジの上限。遅延が広がったときにヘッジがさらに負荷を増やすのを防ぐ
+HEDGE_MAX_IN_FLIGHT = RETRIEVE_MAX_WORKERS + 1
+
 # リランキングして最終的にこの件数を残す
 MAX_DOCUMENTS_PER_PROMPT = 5
+# 検索スコアの上位からこの件数だけをリランクに送る
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "15"))
+# 上位 MAX_DOCUMENTS_PER_PROMPT 件とその次のスコアの差がこれ以上ならリランクを省略する
+RERANK_SKIP_MARGIN = float(os.environ.get("RERANK_SKIP_MARGIN", "0.1"))
+
+# プロンプトに含めるドキュメントのトークン数の上限（概算）
+MAX_DOCUMENT_TOKENS = int(os.environ.get("MAX_DOCUMENT_TOKENS", "6000"))
+
+# この類似度（Jaccard係数）以上のチャンクはほぼ重複とみなして除く
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# 検索に使うバックエンド。bedrock（Knowledge Base）か local（クローラーの出力から作ったインデックス）
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "bedrock")
+# local_retriever.py build で作ったインデックスの場所。bedrock でも、あればスロットリング時に使う
+LOCAL_INDEX_DIR = os.environ.get("LOCAL_INDEX_DIR", "")
+# インデックスを作るときのチャンクのトークン数（概算）と、密ベクトルの次元数（0なら作らない）
+LOCAL_INDEX_CHUNK_TOKENS = 300
+LOCAL_INDEX_DIMENSIONS = 256
+# ローカル検索でのBM25と密ベクトルのスコアの重み（密ベクトル側）
+LOCAL_DENSE_WEIGHT = float(os.environ.get("LOCAL_DENSE_WEIGHT", "0.3"))
+
+# 検索・リランク結果のキャッシュ。memory（プロセス内）、dynamodb（Lambda間で共有）、none のいずれか
+RETRIEVAL_CACHE_BACKEND = os.environ.get("RETRIEVAL_CACHE_BACKEND", "memory")
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(60 * 60 * 24)))
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", "1024"))
+
+# クローラーが公開したコーパスのバージョン。変わるとキャッシュが無効になる
+CORPUS_VERSION = os.environ.get("CORPUS_VERSION", "")
+
+# 似た質問に保存済みの回答を返すキャッシュ
+# Lambdaではプロセス内のキャッシュがほとんど当たらず、埋め込みの呼び出しが増えるだけなので既定では無効にする
+_IS_LAMBDA = bool(os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+ANSWER_CACHE_ENABLED = (
+    os.environ.get("ANSWER_CACHE_ENABLED", "false" if _IS_LAMBDA else "true") == "true"
+)
+# 質問の要約の埋め込みに使用するモデル
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+EMBEDDING_DIMENSIONS = 512
+# コサイン類似度がこの値以上なら同じ質問とみなす
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_SIZE = int(os.environ.get("ANSWER_CACHE_MAX_SIZE", "512"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", str(60 * 60 * 24)))
+# 指定するとキャッシュをこのファイルに保存し、起動時に読み込む
+ANSWER_CACHE_SNAPSHOT_PATH = os.environ.get("ANSWER_CACHE_SNAPSHOT_PATH", "")
+
+# Slackにはすぐにackを返し、回答の生成は非同期に行う
+SLACK_ACK_FIRST = os.environ.get("SLACK_ACK_FIRST", "true") == "true"
+# 非同期処理の実行方法。lambda（自己呼び出し）か thread（ローカル検証用）
+SLACK_LAZY_RUNNER = os.environ.get("SLACK_LAZY_RUNNER", "lambda")
+
+# 回答生成中に表示するメッセージ
+PLACEHOLDER_TEXT = "回答を生成しています…"
+
+# ストリーミング中にメッセージを更新する最小間隔（秒）。Slack/Discordのレート制限に引っかからないように間引く
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", "1.0"))
+
+# Discord Botの処理済みメッセージを覚えておく時間（秒）と件数
+PROCESSED_MESSAGE_TTL = 60 * 60
+PROCESSED_MESSAGE_MAX_SIZE = 10000
+
+# Discord Botで同時に回答を生成する数の上限（全体・チャンネルごと・ユーザーごと）
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "8"))
+MAX_CONCURRENT_REQUESTS_PER_CHANNEL = int(
+    os.environ.get("MAX_CONCURRENT_REQUESTS_PER_CHANNEL", "3")
+)
+MAX_CONCURRENT_REQUESTS_PER_USER = int(
+    os.environ.get("MAX_CONCURRENT_REQUESTS_PER_USER", "1")
+)
+# 待ちがこの数を超えたら受け付けない
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "50"))
+
+# Discordのリプライツリーをさかのぼる深さと、会話に含めるトークン数（概算）の上限
+DISCORD_MAX_CHAIN_DEPTH = int(os.environ.get("DISCORD_MAX_CHAIN_DEPTH", "20"))
+DISCORD_MAX_CHAIN_TOKENS = int(os.environ.get("DISCORD_MAX_CHAIN_TOKENS", "4000"))
+# 組み立てた会話を覚えておく件数
+DISCORD_CHAIN_CACHE_SIZE = 1000
+
+# 会話に出てくる言語名・プロジェクト名から検索のフィルタを作る（false ならKnowledge Baseに推論させる）
+LOCAL_FILTER_ENABLED = os.environ.get("LOCAL_FILTER_ENABLED", "true") == "true"
 
 LANGUAGES = ["TypeScript", "JavaScript", "Python", "Shell"]
 PROJECTS = [
@@ -0,0 +1,56 @@
+import os
+import time
+import threading
+
+from pynamodb.models import Model
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.exceptions import PutError
+
+"""
+Slackのイベントを1回だけ処理するための重複排除。
+応答が遅れるとSlackが同じイベントを再送してくるので、client_msg_id を条件付き書き込みで確保できた場合だけ処理する。
+テーブルが設定されていない場合（ローカル実行）はプロセス内で管理する。
+"""
+
+# 再送は数分以内に来るので、1日あれば十分
+_TTL = 60 * 60 * 24
+
+
+class ProcessedEventModel(Model):
+    class Meta:
+        table_name = os.environ.get("EVENT_TABLE_NAME", "")
+
+    event_id = UnicodeAttribute(hash_key=True)
+    ttl = NumberAttribute()
+
+
+_claimed: dict = {}
+_lock = threading.Lock()
+
+
+def _claim_locally(event_id: str) -> bool:
+    now = time.time()
+    with _lock:
+        for key in [key for key, expires_at in _claimed.items() if expires_at < now]:
+            del _claimed[key]
+        if event_id in _claimed:
+            return False
+        _claimed[event_id] = now + _TTL
+        return True
+
+
+def claim(event_id: str) -> bool:
+    """まだ誰も処理していないイベントなら確保して True を返す"""
+    if not ProcessedEventModel.Meta.table_name:
+        return _claim_locally(event_id)
+
+    item = ProcessedEventModel()
+    item.event_id = event_id
+    item.ttl = int(time.time()) + _TTL
+    try:
+        item.save(condition=ProcessedEventModel.event_id.does_not_exist())
+    except PutError as e:
+        if e.cause_response_code == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
@@ -1,13 +1,16 @@
 import os
 import logging
 import re
+import time
 import traceback
-import asyncio
 
 import discord
 
-from retriever import retrieve_and_rerank
-from generator import generate_answer
+from pipeline import aanswer_stream
+from scheduler import TTLSet, FairScheduler, QueueFullError
+from reply_chain import ReplyChainBuilder
+from singleflight import SingleFlight, conversation_key
+import config
 
 # Logger の設定
 logging.basicConfig(level=logging.INFO)
@@ -24,16 +27,20 @@ intents.typing = False
 discord_client = discord.Client(intents=intents)
 
 
-async def generate_reply(messages: list) -> str:
-    try:
-        _, documents = await asyncio.to_thread(retrieve_and_rerank, messages)
-        answer = await asyncio.to_thread(generate_answer, messages, documents)
-    except Exception:
-        reply = (
-            f"エラーが発生しました：```\n"
-            f"{traceback.format_exc()}```"
-        )
-        return reply
+# 同じ会話への回答は同時に1回だけ生成して共有する
+_flights = SingleFlight()
+
+
+async def generate_reply(messages: list, placeholder: discord.Message) -> str:
+    # 生成途中のテキストで間引きながらプレースホルダーを更新する
+    last_updated = time.monotonic()
+    async for answer in _flights.stream(
+        conversation_key(messages), lambda: aanswer_stream(messages)
+    ):
+        now = time.monotonic()
+        if now - last_updated >= config.STREAM_UPDATE_INTERVAL:
+            await placeholder.edit(content=answer["text"] + " …")
+            last_updated = now
 
     reply = answer["text"]
 
@@ -58,63 +65,98 @@ def _remove_mentions(message: str) -> str:
     return re.sub(r"<@\d+>", "", message).strip()
 
 
-_processed_messages = {}
+def _to_entry(message: discord.Message) -> dict:
+    return {
+        "role": _get_role(message.author),
+        "content": _remove_mentions(message.content),
+    }
+
+
+# 長時間動かし続けるので、処理済みのメッセージは期限付きで一定数だけ覚えておく
+_processed_messages = TTLSet(
+    ttl=config.PROCESSED_MESSAGE_TTL, max_size=config.PROCESSED_MESSAGE_MAX_SIZE
+)
+_scheduler = FairScheduler(
+    max_concurrency=config.MAX_CONCURRENT_REQUESTS,
+    per_channel=config.MAX_CONCURRENT_REQUESTS_PER_CHANNEL,
+    per_user=config.MAX_CONCURRENT_REQUESTS_PER_USER,
+    max_queue=config.MAX_QUEUED_REQUESTS,
+)
+
+
+_reply_chains = ReplyChainBuilder(
+    discord_client,
+    _to_entry,
+    max_depth=config.DISCORD_MAX_CHAIN_DEPTH,
+    max_tokens=config.DISCORD_MAX_CHAIN_TOKENS,
+    cache_size=config.DISCORD_CHAIN_CACHE_SIZE,
+)
+
+
+async def _reply(message: discord.Message, messages: list):
+    placeholder = await message.channel.send(
+        config.PLACEHOLDER_TEXT, reference=message
+    )
+
+    # 順番待ちの表示に書き換えたときだけ、実行を始めるときに元に戻す
+    waited = False
+
+    async def on_wait(position: int):
+        nonlocal waited
+        try:
+            await placeholder.edit(content=f"順番待ちをしています（{position}番目）…")
+        except discord.HTTPException as e:
+            # 表示を更新できなくても回答は続ける
+            logger.warning("Failed to show the queue position: %r", e)
+            return
+        waited = True
+
+    try:
+        if _flights.in_flight(conversation_key(messages)):
+            # 同じ会話の回答を生成中なら、順番待ちせずにその結果を受け取る
+            response = await generate_reply(messages, placeholder)
+        else:
+            async with _scheduler.slot(
+                message.channel.id, message.author.id, on_wait=on_wait
+            ):
+                if waited:
+                    await placeholder.edit(content=config.PLACEHOLDER_TEXT)
+                response = await generate_reply(messages, placeholder)
+    except QueueFullError:
+        logger.warning("Queue is full: %s", _scheduler.stats())
+        response = "混雑しているため回答できませんでした。しばらくしてからもう一度お試しください。"
+        await placeholder.edit(content=response)
+        return
+    except Exception:
+        # エラーの内容は会話として覚えない
+        response = (
+            f"エラーが発生しました：```\n"
+            f"{traceback.format_exc()}```"
+        )
+        await placeholder.edit(content=response)
+        return
+    await placeholder.edit(content=response)
+
+    # 返信へのリプライで会話を組み立て直さなくて済むように覚えておく
+    _reply_chains.remember(
+        placeholder.id, messages + [{"role": "assistant", "content": response}]
+    )
 
 
 @discord_client.event
 async def on_message(message):
-    if message.id in _processed_messages:
+    if not _processed_messages.add(message.id):
         return
 
-    _processed_messages[message.id] = True
-
     if not (
             discord_client.user.mentioned_in(message)
             and message.author != discord_client.user
     ):
         return
 
-    if message.reference:
-        # リプライツリーがある場合、さかのぼってログを取得する
-        referenced_message = await message.channel.fetch_message(
-            message.reference.message_id
-        )
-        messages = []
-
-        messages.append(
-            {
-                "role": _get_role(referenced_message.author),
-                "content": _remove_mentions(referenced_message.content),
-            }
-        )
-
-        referenced_message = referenced_message.reference
-        while referenced_message is not None:
-            referenced_message = await message.channel.fetch_message(
-                referenced_message.message_id
-            )
-            messages.append(
-                {
-                    "role": _get_role(referenced_message.author),
-                    "content": _remove_mentions(referenced_message.content),
-                }
-            )
-            referenced_message = referenced_message.reference
-        messages.reverse()
-        messages.append(
-            {
-                "role": _get_role(message.author),
-                "content": _remove_mentions(message.content),
-            }
-        )
-        messages.append({"role": "user", "content": message.content})
-        response = await generate_reply(messages)
-        await message.channel.send(response, reference=message)
-
-    else:
-        # リプライツリーがない場合
-        response = await generate_reply([{"role": "user", "content": message.content}])
-        await message.channel.send(response, reference=message)
+    # リプライツリーがある場合はさかのぼって会話を組み立てる
+    messages = await _reply_chains.build(message)
+    await _reply(message, messages)
 
 
 if __name__ == "__main__":
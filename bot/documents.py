@@ -0,0 +1,114 @@
+import re
+import hashlib
+from typing import TypedDict
+
+import config
+
+"""
+検索結果のドキュメントをプロンプトに詰める前処理。
+複数クエリで同じチャンクが何度も取れるので重複を除き、件数とトークン数の上限に収まるように絞る。
+"""
+
+
+class Metadata(TypedDict):
+    languages: list[str]
+    projects: list[str]
+    url: str
+    s3_uri: str
+
+
+class Document(TypedDict):
+    text: str
+    metadata: Metadata
+    # Knowledge Baseの検索スコア。大きいほど関連が強い
+    score: float
+
+
+_word_pattern = re.compile(r"\w+")
+_whitespace_pattern = re.compile(r"\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    # トークナイザーを持ち込むほどではないので概算する
+    # 英数字はおおよそ4文字で1トークン、日本語などはおおよそ1文字1トークン
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def content_hash(text: str) -> str:
+    normalized = _whitespace_pattern.sub(" ", text).strip().lower()
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = _word_pattern.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def deduplicate(documents: list[Document]) -> list[Document]:
+    """
+    同じURI・同じ内容のチャンクと、ほぼ同じ内容のチャンクを取り除く。
+    先に出てきたものを残すので、順番は検索結果の順番のまま。
+    """
+    result: list[Document] = []
+    seen = set()
+    kept_shingles = []
+
+    for document in documents:
+        key = (document["metadata"]["s3_uri"], content_hash(document["text"]))
+        if key in seen:
+            continue
+        seen.add(key)
+
+        shingles = _shingles(document["text"])
+        if any(
+            _jaccard(shingles, kept) >= config.NEAR_DUPLICATE_THRESHOLD
+            for kept in kept_shingles
+        ):
+            continue
+
+        kept_shingles.append(shingles)
+        result.append(document)
+    return result
+
+
+def pack(
+    documents: list[Document],
+    max_documents: int = config.MAX_DOCUMENTS_PER_PROMPT,
+    token_budget: int = config.MAX_DOCUMENT_TOKENS,
+) -> list[Document]:
+    # 上位から順に、件数とトークン数の上限に収まるものだけを残す
+    result: list[Document] = []
+    used_tokens = 0
+    for document in documents:
+        if len(result) >= max_documents:
+            break
+        tokens = estimate_tokens(document["text"])
+        if used_tokens + tokens > token_budget:
+            continue
+        result.append(document)
+        used_tokens += tokens
+    return result
+
+
+def score_of(document: Document) -> float:
+    # スコアを持たない古いキャッシュのドキュメントは最下位として扱う
+    return document.get("score", 0.0)
+
+
+def format_documents(documents: list[Document]) -> str:
+    # json.dumps(indent=2) だと空白やキー名でトークンを浪費するので簡素なタグ形式にする
+    return "\n".join(
+        f'<document url="{document["metadata"]["url"]}">\n'
+        f'{document["text"].strip()}\n'
+        f"</document>"
+        for document in documents
+    )
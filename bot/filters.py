@@ -0,0 +1,183 @@
+import re
+from collections import deque
+from typing import Optional
+
+from history import Message
+import config
+
+"""
+会話に出てくる言語名・プロジェクト名から、Knowledge Baseの検索に使うメタデータのフィルタを作る。
+implicitFilterConfiguration はクエリごとにLLMでフィルタを推論するので遅く、
+ほとんどの質問はプロジェクト名をそのまま書いているので、別名の辞書との文字列照合で済ませる。
+辞書の照合にはAho-Corasick法を使い、会話の長さに比例する時間で全ての別名を探す。
+"""
+
+# config.LANGUAGES / config.PROJECTS の名前自体に加えて、会話で使われる別名
+_ALIASES: dict[str, dict[str, list[str]]] = {
+    "languages": {
+        "TypeScript": ["ts", "tsx", "tsc", "tsconfig"],
+        "JavaScript": ["js", "jsx", "node.js", "nodejs", "ecmascript"],
+        "Python": ["py", "python3", "pip", "パイソン"],
+        "Shell": ["bash", "zsh", "sh", "shell script", "シェル", "シェルスクリプト"],
+    },
+    "projects": {
+        "AWS CLI": ["awscli", "aws-cli", "aws cli v2"],
+        "AWS SDK for JavaScript": [
+            "aws-sdk",
+            "@aws-sdk",
+            "aws sdk for js",
+            "aws-sdk-js",
+            "aws sdk v3",
+        ],
+        "AWS CDK": ["cdk", "aws-cdk", "aws-cdk-lib", "cloud development kit"],
+        "Boto3": ["botocore"],
+        "React": ["react.js", "reactjs", "usestate", "useeffect", "リアクト"],
+        "Hono": ["hono.js", "honojs"],
+        "SWR": ["useswr"],
+        "Prisma": ["prisma client", "prisma schema"],
+        "peewee": ["peewee orm"],
+        "PynamoDB": ["pynamo"],
+        "Playwright": ["playwright-python", "@playwright/test"],
+        "Tailwind CSS": ["tailwind", "tailwindcss"],
+        "Zustand": [],
+    },
+}
+
+_word_pattern = re.compile(r"[0-9a-z_]")
+
+
+class KeywordMatcher:
+    """別名の辞書からAho-Corasickのオートマトンを作り、文中に現れる値を探す"""
+
+    def __init__(self, aliases: dict[str, list[str]]):
+        # 状態ごとの遷移・失敗時の遷移先・その状態で見つかる (別名, 値)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[tuple[str, str]]] = [[]]
+        for value, names in aliases.items():
+            for name in {value, *names}:
+                self._add(name.lower(), value)
+        self._build()
+
+    def _add(self, keyword: str, value: str):
+        state = 0
+        for char in keyword:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._output[state].append((keyword, value))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    @staticmethod
+    def _is_bounded(text: str, start: int, end: int, keyword: str) -> bool:
+        # 英数字で始まる（終わる）別名は、前後が英数字の場合は単語の一部なので無視する
+        # 日本語の別名は単語の区切りがないので、前後を見ない
+        if _word_pattern.match(keyword[0]) and start > 0:
+            if _word_pattern.match(text[start - 1]):
+                return False
+        if _word_pattern.match(keyword[-1]) and end < len(text):
+            if _word_pattern.match(text[end]):
+                return False
+        return True
+
+    def find(self, text: str) -> list[str]:
+        """見つかった値を、初めて現れた順に返す"""
+        text = text.lower()
+        found: dict[str, None] = {}
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for keyword, value in self._output[state]:
+                start = i - len(keyword) + 1
+                if self._is_bounded(text, start, i + 1, keyword):
+                    found.setdefault(value, None)
+        return list(found)
+
+
+def _matcher(key: str, values: list[str]) -> KeywordMatcher:
+    return KeywordMatcher({value: _ALIASES[key].get(value, []) for value in values})
+
+
+_matchers = {
+    "languages": _matcher("languages", config.LANGUAGES),
+    "projects": _matcher("projects", config.PROJECTS),
+}
+
+
+def _any_of(key: str, values: list[str]) -> dict:
+    conditions = [{"listContains": {"key": key, "value": value}} for value in values]
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"orAll": conditions}
+
+
+def _find_values(text: str) -> dict[str, list[str]]:
+    return {key: matcher.find(text) for key, matcher in _matchers.items()}
+
+
+def _message_text(message: Message) -> str:
+    # Slackの履歴は "text"、Discordのリプライツリーは "content" に本文を持つ
+    return message.get("text") or message.get("content") or ""
+
+
+def build_filter(messages: list[Message]) -> Optional[dict]:
+    """
+    会話からメタデータのフィルタを作る。何も見つからなければ None を返す。
+    話題が変わっていることがあるので、最新のユーザーのメッセージで見つかればそれを優先し、
+    見つからなければ会話全体から探す。
+    """
+    user_messages = [message for message in messages if message["role"] == "user"]
+    if not user_messages:
+        return None
+
+    found = _find_values(_message_text(user_messages[-1]))
+    if not any(found.values()):
+        found = _find_values("\n".join(map(_message_text, user_messages)))
+
+    conditions = [_any_of(key, values) for key, values in found.items() if values]
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"andAll": conditions}
+
+
+def matches_filter(expression: dict, attributes: dict) -> bool:
+    """
+    Knowledge Baseのフィルタ式をメタデータに対して評価する。
+    ローカルの検索で build_filter の結果をそのまま使うためのもので、その範囲の演算子に対応する。
+    """
+    ((operator, operand),) = expression.items()
+    if operator == "andAll":
+        return all(matches_filter(e, attributes) for e in operand)
+    if operator == "orAll":
+        return any(matches_filter(e, attributes) for e in operand)
+
+    value = attributes.get(operand["key"])
+    if operator == "listContains":
+        return isinstance(value, list) and operand["value"] in value
+    if operator == "equals":
+        return value == operand["value"]
+    if operator == "notEquals":
+        return value != operand["value"]
+    if operator == "in":
+        return value in operand["value"]
+    raise ValueError(f"Unsupported filter operator: {operator}")
@@ -1,8 +1,11 @@
+import re
 import json
-from typing import TypedDict
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, TypedDict
 
 from history import Message
-from clients import bedrock_runtime_client
+from clients import get_bedrock_runtime_client, get_async_bedrock_runtime_client
+from documents import Document, format_documents
+from prompts import converse_params, log_usage
 import config
 
 _tool_name = "respond_to_user"
@@ -30,18 +33,11 @@ _tool_definition = {
     }
 }
 
-_prompt = """あなたはAWSやプログラミングに精通したスペシャリストで、ユーザーからの技術的な質問に正確に答えます。
+_prompt = f"""あなたはAWSやプログラミングに精通したスペシャリストで、ユーザーからの技術的な質問に正確に答えます。
 ユーザーとのやりとりは<messages>タグで古い順に与えられるため一番最後のメッセージに返信する形で答えて下さい。
+role が summary のメッセージはそれより前のやりとりの要約です。
 また回答に必要なドキュメントは事前にデータベースから検索され、<documents>タグで与えられます。
-回答には $tool_name$ ツールのみを使用し、テキストは日本語で応答して下さい。
-
-<messages>
-$messages$
-</messages>
-
-<documents>
-$documents$
-</documents>
+回答には {_tool_name} ツールのみを使用し、テキストは日本語で応答して下さい。
 """
 
 
@@ -50,24 +46,158 @@ class Answer(TypedDict):
     references: list[str]
 
 
-def generate_answer(messages: list[Message], documents: dict) -> Answer:
-    prompt = (
-        _prompt.replace("tool_name", _tool_name)
-        .replace("$messages$", json.dumps(messages, indent=2, ensure_ascii=False))
-        .replace("$documents$", json.dumps(documents, indent=2, ensure_ascii=False))
+def _converse_params(messages: list[Message], documents: list[Document]) -> dict:
+    # ドキュメントは会話より大きくなりやすいので先に置く
+    content = (
+        f"<documents>\n{format_documents(documents)}\n</documents>\n"
+        f"<messages>\n{json.dumps(messages, ensure_ascii=False)}\n</messages>"
+    )
+    return converse_params(
+        config.EXPENSIVE_MODEL_ID, _prompt, _tool_definition, content
     )
 
-    response = bedrock_runtime_client.converse(
-        modelId=config.EXPENSIVE_MODEL_ID,
-        messages=[{"role": "user", "content": [{"text": prompt}]}],
-        toolConfig={
-            "tools": [_tool_definition],
-            "toolChoice": {
-                "tool": {
-                    "name": _tool_name,
-                },
-            },
-        },
+
+def generate_answer(messages: list[Message], documents: list[Document]) -> Answer:
+    response = get_bedrock_runtime_client().converse(
+        **_converse_params(messages, documents)
     )
+    log_usage(_tool_name, response.get("usage"))
     answer = response["output"]["message"]["content"][0]["toolUse"]["input"]
     return answer
+
+
+# ツールの入力はJSON文字列の断片としてストリームされるので、text の値だけを逐次取り出す
+_text_key_pattern = re.compile(r'[{,]\s*"text"\s*:\s*"')
+_escapes = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class _PartialAnswerParser:
+    def __init__(self):
+        self._buffer = ""
+        self._text_start: Optional[int] = None
+        self.text = ""
+
+    def feed(self, fragment: str) -> bool:
+        """断片を追加し、text の値が伸びた場合は True を返す"""
+        self._buffer += fragment
+        if self._text_start is None:
+            match = _text_key_pattern.search(self._buffer)
+            if match is None:
+                return False
+            self._text_start = match.end()
+
+        text = _decode_partial_string(self._buffer, self._text_start)
+        if len(text) == len(self.text):
+            return False
+        self.text = text
+        return True
+
+    def result(self) -> Answer:
+        if not self._buffer:
+            return Answer(text=self.text, references=[])
+        answer = json.loads(self._buffer)
+        answer.setdefault("references", [])
+        return answer
+
+
+def _decode_partial_string(raw: str, start: int) -> str:
+    # 閉じていないJSON文字列を、デコードできるところまでデコードする
+    chars = []
+    i = start
+    while i < len(raw):
+        c = raw[i]
+        if c == '"':
+            break
+        if c != "\\":
+            chars.append(c)
+            i += 1
+            continue
+
+        if i + 1 >= len(raw):
+            break
+        escape = raw[i + 1]
+        if escape != "u":
+            chars.append(_escapes.get(escape, escape))
+            i += 2
+            continue
+
+        if i + 6 > len(raw):
+            break
+        code = int(raw[i + 2 : i + 6], 16)
+        if 0xD800 <= code < 0xDC00:
+            # サロゲートペアは後半が揃うまで待つ
+            if i + 12 > len(raw):
+                break
+            low = int(raw[i + 8 : i + 12], 16)
+            code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+            i += 6
+        chars.append(chr(code))
+        i += 6
+    return "".join(chars)
+
+
+class StreamError(Exception):
+    pass
+
+
+def _handle_event(parser: _PartialAnswerParser, event: dict) -> Optional[Answer]:
+    # テキストが伸びた場合だけ途中までの Answer を返す
+    for key, value in event.items():
+        # modelStreamErrorException などのエラーはイベントとして届く
+        if key.endswith("Exception"):
+            raise StreamError(f"{key}: {value.get('message', '')}")
+    if "metadata" in event:
+        log_usage(_tool_name, event["metadata"].get("usage"))
+    delta = event.get("contentBlockDelta", {}).get("delta", {})
+    if "toolUse" in delta and parser.feed(delta["toolUse"]["input"]):
+        return Answer(text=parser.text, references=[])
+    return None
+
+
+def _iter_answer(stream: Iterable[dict]) -> Iterator[Answer]:
+    parser = _PartialAnswerParser()
+    for event in stream:
+        answer = _handle_event(parser, event)
+        if answer is not None:
+            yield answer
+    yield parser.result()
+
+
+async def _aiter_answer(stream: AsyncIterable[dict]) -> AsyncIterator[Answer]:
+    parser = _PartialAnswerParser()
+    async for event in stream:
+        answer = _handle_event(parser, event)
+        if answer is not None:
+            yield answer
+    yield parser.result()
+
+
+def generate_answer_stream(
+    messages: list[Message], documents: list[Document]
+) -> Iterator[Answer]:
+    """
+    回答を生成しながら、途中までのテキストを持つ Answer を順に返す。
+    最後に返す Answer が完成した回答で、references もそこで埋まる。
+    """
+    response = get_bedrock_runtime_client().converse_stream(
+        **_converse_params(messages, documents)
+    )
+    yield from _iter_answer(response["stream"])
+
+
+async def agenerate_answer_stream(
+    messages: list[Message], documents: list[Document]
+) -> AsyncIterator[Answer]:
+    client = await get_async_bedrock_runtime_client()
+    response = await client.converse_stream(**_converse_params(messages, documents))
+    async for answer in _aiter_answer(response["stream"]):
+        yield answer
@@ -1,12 +1,18 @@
 import os
+import re
 import json
-from typing import TypedDict
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Optional, TypedDict
 from datetime import datetime
 
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
 
-from clients import bedrock_runtime_client
+from prompts import invoke_tool
+from documents import estimate_tokens
 import config
 
 """
@@ -14,8 +20,14 @@ DynamoDBでSlackの履歴を管理する。
 app_mentionイベントではスレッド固有のIDが取得できないため、AIの力で会話の続きなのか判断させる。
 https://api.slack.com/events/app_mention
 制約がないなら他のイベントやAPIを使った方がよさそう。
+
+会話が長くなってもプロンプトと読み込みが膨らまないように、直近のやりとりだけをそのまま残し、
+それより古いやりとりは要約して1つのアイテムにまとめる。
+要約アイテムはソートキーを最大にしておき、降順のQuery1回で要約と直近のやりとりを一緒に取得する。
 """
 
+logger = logging.getLogger(__name__)
+
 
 class HistoryModel(Model):
     class Meta:
@@ -28,6 +40,12 @@ class HistoryModel(Model):
     ttl = NumberAttribute()
 
 
+# 要約アイテムのソートキー。降順で読むと必ず先頭に来る
+_SUMMARY_TIMESTAMP = 9_999_999_999_999
+_SUMMARY_ROLE = "summary"
+# TTL 1week
+_TTL = 60 * 60 * 24 * 7
+
 _tool_name = "send_conversation_status"
 _tool_definition = {
     "toolSpec": {
@@ -49,18 +67,37 @@ _tool_definition = {
     }
 }
 
-_prompt = """スレッドIDがないため、新しいメッセージが過去ログの続きなのか分からないデータがあります。
+_prompt = f"""スレッドIDがないため、新しいメッセージが過去ログの続きなのか分からないデータがあります。
 <messages>タグではユーザーとの会話の過去ログが、<new_message>ではユーザーの新しいメッセージが与えられます。
 あなたは過去ログと新しいメッセージが同じスレッドの会話かどうか（話が継続しているか）を判断して下さい。
-判断が難しい場合は継続していると答えて下さい。回答には $tool_name$ ツールのみを使用してください。
+判断が難しい場合は継続していると答えて下さい。回答には {_tool_name} ツールのみを使用してください。
+role が summary のメッセージはそれより前の会話の要約です。
+"""
 
-<messages>
-$messages$
-</messages>
+_summary_tool_name = "save_summary"
+_summary_tool_definition = {
+    "toolSpec": {
+        "name": _summary_tool_name,
+        "description": "Save the summary of the conversation",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "summary": {
+                        "type": "string",
+                        "description": "The summary of the conversation",
+                    }
+                },
+                "required": ["summary"],
+            }
+        },
+    }
+}
 
-<new_message>
-$new_message
-</new_message>
+_summary_prompt = f"""ユーザーとAIの会話の過去ログが<messages>タグで古い順に与えられます。
+role が summary のメッセージはそれより前の会話の要約です。
+会話を続けるのに必要な情報（質問の内容、前提条件、回答の要点、使っている言語やライブラリ）を落とさずに、
+全体を日本語で簡潔に要約して下さい。回答には {_summary_tool_name} ツールのみを使用してください。
 """
 
 
@@ -69,63 +106,288 @@ class Message(TypedDict):
     text: str
 
 
+class History(TypedDict):
+    ch_user: str
+    # 要約アイテム（あれば）と直近のやりとりを古い順に並べたもの
+    items: list[HistoryModel]
+    # 読み込んだ範囲より古いやりとりが残っているか
+    has_older_turns: bool
+
+
 def _is_conversation_continuous(messages: list[Message], new_message: Message) -> bool:
-    prompt = (
-        _prompt.replace("tool_name", _tool_name)
-        .replace("$messages$", json.dumps(messages, indent=2, ensure_ascii=False))
-        .replace("$new_message$", json.dumps(new_message, indent=2, ensure_ascii=False))
+    content = (
+        f"<messages>\n{json.dumps(messages, ensure_ascii=False)}\n</messages>\n"
+        f"<new_message>\n{json.dumps(new_message, ensure_ascii=False)}\n</new_message>"
     )
+    answer = invoke_tool(config.CHEAP_MODEL_ID, _prompt, _tool_definition, content)
+    return answer["is_continue"]
 
-    response = bedrock_runtime_client.converse(
-        modelId=config.CHEAP_MODEL_ID,
-        messages=[{"role": "user", "content": [{"text": prompt}]}],
-        toolConfig={
-            "tools": [_tool_definition],
-            "toolChoice": {
-                "tool": {
-                    "name": _tool_name,
-                },
-            },
-        },
-    )
-    answer = response["output"]["message"]["content"][0]["toolUse"]["input"][
-        "is_continue"
-    ]
-    return answer
 
+# 前の話を指していそうな言葉。含まれていれば会話の続きとみなす
+_continuation_cues = (
+    "さっき",
+    "先ほど",
+    "上記",
+    "続き",
+    "他に",
+    "ほかに",
+    "追加で",
+    "もう少し",
+)
+_whitespace_pattern = re.compile(r"\s+")
 
-def fetch_history(channel_id: str, user_id: str, text: str) -> list[Message]:
-    new_message = {"role": "user", "text": text}
-    messages = []
+
+def _bigrams(text: str) -> set:
+    # 日本語は単語で区切れないので文字bigramで比較する
+    text = _whitespace_pattern.sub(" ", text).strip().lower()
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def _similarity(a: str, b: str) -> float:
+    a_bigrams, b_bigrams = _bigrams(a), _bigrams(b)
+    if not a_bigrams or not b_bigrams:
+        return 0.0
+    return len(a_bigrams & b_bigrams) / len(a_bigrams | b_bigrams)
+
+
+def decide_continuity(
+    items: list[HistoryModel], new_message: Message
+) -> Optional[bool]:
+    """
+    LLMを使わずに判断できる場合は会話が継続しているかを返し、判断が難しい場合は None を返す。
+    安い判定から順に試し、どの段階で決まったかをログに出す。
+    """
+    turns = [item for item in items if item.role != _SUMMARY_ROLE]
+    if not turns:
+        return _decided("empty_history", False)
+
+    gap = datetime.now().timestamp() - _to_seconds(turns[-1].timestamp)
+    if gap > config.CONTINUITY_MAX_GAP:
+        return _decided("time_gap", False)
+
+    text = new_message["text"]
+    if any(cue in text for cue in _continuation_cues):
+        return _decided("cue_word", True)
+
+    last_turns = " ".join(item.text for item in turns[-2:])
+    similarity = _similarity(text, last_turns)
+    if similarity >= config.CONTINUITY_SIMILARITY_THRESHOLD:
+        return _decided("lexical_similarity", True)
+
+    if gap <= config.CONTINUITY_MIN_GAP:
+        return _decided("recent_message", True)
+
+    logger.info("Continuity is ambiguous: gap=%.0fs similarity=%.3f", gap, similarity)
+    return None
+
+
+def _to_seconds(timestamp: int) -> float:
+    # 以前は秒、現在はミリ秒でソートキーを保存しているので両方に対応する
+    if timestamp > 100_000_000_000:
+        return timestamp / 1000
+    return timestamp
+
+
+def _decided(tier: str, is_continue: bool) -> bool:
+    logger.info("Continuity decided by %s: is_continue=%s", tier, is_continue)
+    return is_continue
+
+
+_background = ThreadPoolExecutor(max_workers=1)
+_pending: list[Future] = []
+
+
+def wait_background_tasks(timeout: Optional[float] = None):
+    """Lambdaは応答後にプロセスが凍結されるので、ハンドラーの最後でバックグラウンド処理を待つ"""
+    done, not_done = wait(_pending, timeout=timeout)
+    for future in done:
+        if future.exception():
+            logger.warning("History background task failed: %r", future.exception())
+    _pending[:] = list(not_done)
+
+
+def load_history(channel_id: str, user_id: str) -> History:
+    """要約アイテムと直近 HISTORY_MAX_TURNS 件のやりとりを読み込む"""
+    ch_user = f"{channel_id}#{user_id}"
+    # 要約 + 直近の件数 + 古いやりとりが残っているかの確認用に1件多く読む
     query_result = HistoryModel.query(
-        hash_key=f"{channel_id}#{user_id}", scan_index_forward=True
+        hash_key=ch_user,
+        scan_index_forward=False,
+        limit=config.HISTORY_MAX_TURNS + 2,
+    )
+
+    summary = None
+    turns = []
+    for item in query_result:
+        if item.timestamp == _SUMMARY_TIMESTAMP:
+            summary = item
+        else:
+            turns.append(item)
+
+    has_older_turns = len(turns) > config.HISTORY_MAX_TURNS
+    turns = turns[: config.HISTORY_MAX_TURNS]
+
+    # 長いやりとりが続いた場合に備えてトークン数でも制限する
+    used_tokens = estimate_tokens(summary.text) if summary else 0
+    for i, turn in enumerate(turns):
+        used_tokens += estimate_tokens(turn.text)
+        if used_tokens > config.HISTORY_TOKEN_BUDGET and i > 0:
+            turns = turns[:i]
+            has_older_turns = True
+            break
+    turns.reverse()
+
+    return History(
+        ch_user=ch_user,
+        items=([summary] if summary else []) + turns,
+        has_older_turns=has_older_turns,
     )
 
-    for message in query_result:
-        messages.append({"role": message.role, "text": message.text})
-    is_continue = _is_conversation_continuous(messages, new_message)
 
+def _compact_history(
+    ch_user: str, summary: Optional[HistoryModel], keep_from_timestamp: int
+):
+    # 残すやりとりより古いものを要約にまとめて削除する
+    old_turns = list(
+        HistoryModel.query(
+            hash_key=ch_user,
+            range_key_condition=HistoryModel.timestamp < keep_from_timestamp,
+            scan_index_forward=True,
+        )
+    )
+    if not old_turns:
+        return
+
+    messages = to_messages(([summary] if summary else []) + old_turns)
+    content = f"<messages>\n{json.dumps(messages, ensure_ascii=False)}\n</messages>"
+    answer = invoke_tool(
+        config.CHEAP_MODEL_ID, _summary_prompt, _summary_tool_definition, content
+    )
+
+    new_summary = HistoryModel()
+    new_summary.ch_user = ch_user
+    new_summary.timestamp = _SUMMARY_TIMESTAMP
+    new_summary.role = _SUMMARY_ROLE
+    new_summary.text = answer["summary"]
+    new_summary.ttl = int(time.time()) + _TTL
+    new_summary.save()
+
+    with HistoryModel.batch_write() as batch:
+        for item in old_turns:
+            batch.delete(item)
+    logger.info("Compacted %d history items into summary", len(old_turns))
+
+
+def to_messages(items: list[HistoryModel]) -> list[Message]:
+    return [{"role": item.role, "text": item.text} for item in items]
+
+
+def resolve_history(
+    history: History,
+    new_message: Message,
+    is_continue: bool,
+    writer: "HistoryWriter",
+) -> list[Message]:
+    """
+    会話が継続していれば過去ログに新しいメッセージを足し、そうでなければ過去ログの削除を writer に予約する。
+    継続していて読み込んだ範囲より古いやりとりがあれば、バックグラウンドで要約にまとめる。
+    """
+    items = history["items"]
     if is_continue:
-        messages.append(new_message)
-        return messages
-    else:
+        if history["has_older_turns"]:
+            summary = items[0] if items[0].role == _SUMMARY_ROLE else None
+            keep_from_timestamp = items[1 if summary else 0].timestamp
+            _pending.append(
+                _background.submit(
+                    _compact_history, history["ch_user"], summary, keep_from_timestamp
+                )
+            )
+        return to_messages(items) + [new_message]
+
+    if items:
+        writer.reset()
+    return [new_message]
+
+
+def fetch_history(channel_id: str, user_id: str, text: str) -> list[Message]:
+    new_message = {"role": "user", "text": text}
+    history = load_history(channel_id, user_id)
+    items = history["items"]
+    is_continue = decide_continuity(items, new_message)
+    if is_continue is None:
+        is_continue = _decided(
+            "llm", _is_conversation_continuous(to_messages(items), new_message)
+        )
+
+    writer = HistoryWriter(channel_id, user_id)
+    messages = resolve_history(history, new_message, is_continue, writer)
+    writer.flush()
+    return messages
+
+
+_timestamp_lock = threading.Lock()
+_last_timestamp = 0
+
+
+def _next_timestamp() -> int:
+    # ミリ秒のソートキー。同じミリ秒に複数書き込んでも衝突しないように単調増加させる
+    global _last_timestamp
+    with _timestamp_lock:
+        _last_timestamp = max(_last_timestamp + 1, time.time_ns() // 1_000_000)
+        return _last_timestamp
+
+
+class HistoryWriter:
+    """1回のやりとりで発生する書き込みをまとめ、返信を投稿した後に BatchWriteItem 1回で書き込む"""
+
+    def __init__(self, channel_id: str, user_id: str):
+        self.ch_user = f"{channel_id}#{user_id}"
+        self._items: list[HistoryModel] = []
+        self._reset = False
+
+    def add(self, message: Message):
+        item = HistoryModel()
+        item.ch_user = self.ch_user
+        item.timestamp = _next_timestamp()
+        item.role = message["role"]
+        item.text = message["text"]
+        item.ttl = int(time.time()) + _TTL
+        self._items.append(item)
+
+    def reset(self):
+        """flush の際に、これまでの会話履歴（要約を含む）を全て削除する"""
+        self._reset = True
+
+    def flush(self):
+        if not self._items and not self._reset:
+            return
+
+        deletes = []
+        if self._reset:
+            first_timestamp = (
+                self._items[0].timestamp if self._items else _next_timestamp()
+            )
+            deletes = [
+                item
+                for item in HistoryModel.query(
+                    hash_key=self.ch_user,
+                    attributes_to_get=["ch_user", "timestamp"],
+                )
+                if item.timestamp < first_timestamp
+                or item.timestamp == _SUMMARY_TIMESTAMP
+            ]
+
         with HistoryModel.batch_write() as batch:
-            for item in query_result:
+            for item in deletes:
                 batch.delete(item)
+            for item in self._items:
+                batch.save(item)
 
-        return [new_message]
+        self._items = []
+        self._reset = False
 
 
 def save_message(channel_id: str, user_id: str, message: Message):
-    timestamp = int(datetime.now().timestamp())
-    if message["role"] == "assistant":
-        timestamp += 1
-
-    new_message = HistoryModel()
-    new_message.ch_user = f"{channel_id}#{user_id}"
-    new_message.timestamp = timestamp
-    new_message.role = message["role"]
-    new_message.text = message["text"]
-    # TTL 1week
-    new_message.ttl = timestamp + 60 * 60 * 24 * 7
-    new_message.save()
+    writer = HistoryWriter(channel_id, user_id)
+    writer.add(message)
+    writer.flush()
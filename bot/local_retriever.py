@@ -0,0 +1,389 @@
+import os
+import re
+import json
+import math
+import mmap
+import zlib
+import shutil
+import logging
+import argparse
+import threading
+from array import array
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from documents import Document, Metadata, estimate_tokens
+from filters import matches_filter
+import config
+
+"""
+クローラーの出力（.md と .md.metadata.json）から作るローカルの検索エンジン。
+Knowledge Baseの retrieve と同じ形の Document を返すので、次の用途で _retrieve の代わりに使える。
+
+- RETRIEVAL_BACKEND=local で、Bedrockを使わずに低レイテンシで検索する
+- Bedrockのretrieveがスロットリングされたときのフォールバック
+- AWSに接続できない環境での動作確認
+
+BM25の転置インデックスと、単語を特徴ハッシュで固定次元に落とした密ベクトルを持つ。
+インデックスはバイナリファイルに書き出し、読み込み時はmmapするので、起動時にほとんどメモリを使わない。
+スコアの計算はnumpyでまとめて行い、密ベクトルは全チャンクの行列とクエリの積で求める。
+メタデータのフィルタ用に、属性の値ごとのソースの一覧をインデックスを作るときに用意しておく。
+語彙とメタデータだけはJSONで持ち、読み込み時に展開する。
+
+使用例:
+python local_retriever.py build ../../output ./index
+python local_retriever.py search ./index "How to install Playwright"
+"""
+
+logger = logging.getLogger(__name__)
+
+_FORMAT_VERSION = 2
+_K1 = 1.2
+_B = 0.75
+
+_token_pattern = re.compile(r"[0-9a-z_]+|[^\x00-\x7f\s]+")
+_paragraph_pattern = re.compile(r"\n\s*\n")
+
+
+def _tokenize(text: str) -> list[str]:
+    # 英数字は単語、日本語などは単語で区切れないので文字bigramにする
+    tokens = []
+    for token in _token_pattern.findall(text.lower()):
+        if token.isascii():
+            tokens.append(token)
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i : i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def _hashed_vector(tokens: list[str], dimensions: int) -> dict[int, float]:
+    """単語の出現回数を特徴ハッシュで dimensions 次元に落とし、L2正規化した疎な表現を返す"""
+    counts: dict[str, int] = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+
+    vector: dict[int, float] = {}
+    for token, count in counts.items():
+        h = zlib.crc32(token.encode())
+        sign = 1.0 if (h >> 31) & 1 else -1.0
+        index = h % dimensions
+        vector[index] = vector.get(index, 0.0) + sign * (1.0 + math.log(count))
+
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm == 0:
+        return {}
+    return {index: v / norm for index, v in vector.items()}
+
+
+def _split_chunks(text: str, chunk_tokens: int) -> list[str]:
+    # 段落の区切りで、chunk_tokens に収まる程度にまとめる
+    chunks = []
+    current: list[str] = []
+    used_tokens = 0
+    for paragraph in _paragraph_pattern.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = estimate_tokens(paragraph)
+        if current and used_tokens + tokens > chunk_tokens:
+            chunks.append("\n\n".join(current))
+            current, used_tokens = [], 0
+        current.append(paragraph)
+        used_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _write_array(path: Path, values: array):
+    with open(path, "wb") as f:
+        values.tofile(f)
+
+
+def build_index(
+    source_dir: Path,
+    index_dir: Path,
+    dimensions: int = config.LOCAL_INDEX_DIMENSIONS,
+    chunk_tokens: int = config.LOCAL_INDEX_CHUNK_TOKENS,
+) -> int:
+    """source_dir 以下のMarkdownからインデックスを作り、チャンク数を返す"""
+    sources = []
+    # 属性の値 -> その値を持つソースの番号の一覧
+    facets: dict[str, dict[str, list[int]]] = {"languages": {}, "projects": {}}
+    source_ids = array("I")
+    # ソースごとのチャンクは連続しているので、先頭のチャンクの番号だけを持つ
+    source_offsets = array("I", [0])
+    lengths = array("I")
+    offsets = array("Q", [0])
+    vectors = array("f")
+    postings_by_term: dict[str, list[tuple[int, int]]] = {}
+
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    with open(tmp_dir / "texts.bin", "wb") as texts:
+        for path in sorted(source_dir.rglob("*.md")):
+            metadata_path = path.with_suffix(".md.metadata.json")
+            if not metadata_path.exists():
+                continue
+            with open(metadata_path) as f:
+                attributes = json.load(f)["metadataAttributes"]
+            sources.append(
+                Metadata(
+                    languages=attributes.get("languages", []),
+                    projects=attributes.get("projects", []),
+                    url=attributes.get("url", ""),
+                    s3_uri=path.relative_to(source_dir).as_posix(),
+                )
+            )
+            for key, values in facets.items():
+                for value in sources[-1][key]:
+                    values.setdefault(value, []).append(len(sources) - 1)
+
+            for chunk in _split_chunks(path.read_text(), chunk_tokens):
+                chunk_id = len(lengths)
+                tokens = _tokenize(chunk)
+                counts: dict[str, int] = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                for token, count in counts.items():
+                    postings_by_term.setdefault(token, []).append((chunk_id, count))
+
+                source_ids.append(len(sources) - 1)
+                lengths.append(len(tokens))
+                encoded = chunk.encode()
+                texts.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+
+                if dimensions:
+                    vector = array("f", bytes(4 * dimensions))
+                    for index, value in _hashed_vector(tokens, dimensions).items():
+                        vector[index] = value
+                    vectors.extend(vector)
+            source_offsets.append(len(lengths))
+
+    vocabulary = {}
+    postings = array("I")
+    for term in sorted(postings_by_term):
+        entries = postings_by_term[term]
+        vocabulary[term] = [len(postings) // 2, len(entries)]
+        for chunk_id, count in entries:
+            postings.append(chunk_id)
+            postings.append(count)
+
+    _write_array(tmp_dir / "sources.bin", source_ids)
+    _write_array(tmp_dir / "source_offsets.bin", source_offsets)
+    _write_array(tmp_dir / "lengths.bin", lengths)
+    _write_array(tmp_dir / "offsets.bin", offsets)
+    _write_array(tmp_dir / "postings.bin", postings)
+    _write_array(tmp_dir / "vectors.bin", vectors)
+    with open(tmp_dir / "meta.json", "w") as f:
+        json.dump(
+            {
+                "version": _FORMAT_VERSION,
+                "count": len(lengths),
+                "average_length": sum(lengths) / len(lengths) if lengths else 0.0,
+                "dimensions": dimensions,
+                "sources": sources,
+                "facets": facets,
+                "vocabulary": vocabulary,
+            },
+            f,
+            ensure_ascii=False,
+        )
+
+    # 読み込み中のプロセスが壊れたインデックスを見ないように、書き終えてから入れ替える
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    return len(lengths)
+
+
+class LocalIndex:
+    def __init__(self, index_dir: Path):
+        with open(index_dir / "meta.json") as f:
+            meta = json.load(f)
+        if meta["version"] != _FORMAT_VERSION:
+            raise ValueError(f"Unsupported index version: {meta['version']}")
+
+        self.count: int = meta["count"]
+        self.average_length: float = meta["average_length"]
+        self.dimensions: int = meta["dimensions"]
+        self._sources: list[Metadata] = meta["sources"]
+        self._facets: dict[str, dict[str, list[int]]] = meta["facets"]
+        self._vocabulary: dict[str, list[int]] = meta["vocabulary"]
+
+        self._maps = []
+        self._source_ids = self._map(index_dir / "sources.bin", np.uint32)
+        self._source_offsets = self._map(index_dir / "source_offsets.bin", np.uint32)
+        self._offsets = self._map(index_dir / "offsets.bin", np.uint64)
+        self._postings = self._map(index_dir / "postings.bin", np.uint32).reshape(-1, 2)
+        self._vectors = self._map(index_dir / "vectors.bin", np.float32).reshape(
+            self.count if self.dimensions else 0, self.dimensions
+        )
+        self._texts = self._map(index_dir / "texts.bin", np.uint8)
+        # BM25の文書長による正規化はクエリによらないので先に計算しておく
+        lengths = self._map(index_dir / "lengths.bin", np.uint32)
+        self._length_norms = _K1 * (
+            1 - _B + _B * lengths.astype(np.float32) / (self.average_length or 1)
+        )
+        # フィルタ式 -> 対象チャンクのマスク。フィルタは会話に出てくる名前から作るので種類は少ない
+        self._masks: dict[str, np.ndarray] = {}
+
+    def _map(self, path: Path, dtype) -> np.ndarray:
+        # 空のファイルはmmapできない
+        if path.stat().st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return np.frombuffer(mapped, dtype=dtype)
+
+    def _text(self, chunk_id: int) -> str:
+        start, end = self._offsets[chunk_id], self._offsets[chunk_id + 1]
+        return self._texts[start:end].tobytes().decode()
+
+    def _matching_sources(self, expression: dict) -> set:
+        ((operator, operand),) = expression.items()
+        if operator == "andAll":
+            return set.intersection(*(self._matching_sources(e) for e in operand))
+        if operator == "orAll":
+            return set().union(*(self._matching_sources(e) for e in operand))
+        if operator == "listContains" and operand["key"] in self._facets:
+            return set(self._facets[operand["key"]].get(operand["value"], []))
+        # 索引のない演算子だけ、ソースを順に評価する
+        return {
+            i
+            for i, source in enumerate(self._sources)
+            if matches_filter(expression, source)
+        }
+
+    def _allowed(self, metadata_filter: Optional[dict]) -> Optional[np.ndarray]:
+        if metadata_filter is None:
+            return None
+        key = json.dumps(metadata_filter, sort_keys=True)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = np.zeros(self.count, dtype=bool)
+            for source_id in self._matching_sources(metadata_filter):
+                start = self._source_offsets[source_id]
+                mask[start : self._source_offsets[source_id + 1]] = True
+            self._masks[key] = mask
+        return mask
+
+    def _bm25(self, tokens: list[str]) -> np.ndarray:
+        scores = np.zeros(self.count, dtype=np.float32)
+        for token in set(tokens):
+            entry = self._vocabulary.get(token)
+            if entry is None:
+                continue
+            start, df = entry
+            idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            # 1つの単語のポスティングに同じチャンクは1回しか出てこない
+            chunk_ids = self._postings[start : start + df, 0]
+            tf = self._postings[start : start + df, 1].astype(np.float32)
+            scores[chunk_ids] += (
+                idf * tf * (_K1 + 1) / (tf + self._length_norms[chunk_ids])
+            )
+        return scores
+
+    def _dense(self, tokens: list[str]) -> np.ndarray:
+        query = np.zeros(self.dimensions, dtype=np.float32)
+        for index, value in _hashed_vector(tokens, self.dimensions).items():
+            query[index] = value
+        return np.maximum(self._vectors @ query, 0.0)
+
+    def search(
+        self,
+        query: str,
+        metadata_filter: Optional[dict] = None,
+        number_of_results: int = config.RETRIEVE_DOCUMENTS_PER_QUERY,
+    ) -> list[Document]:
+        if self.count == 0:
+            return []
+        tokens = _tokenize(query)
+
+        # BM25は最大値で正規化し、コサイン類似度と重み付きで足して0〜1の尺度にする
+        scores = self._bm25(tokens)
+        top_bm25 = float(scores.max()) or 1.0
+        dense_weight = config.LOCAL_DENSE_WEIGHT if self.dimensions else 0.0
+        scores *= (1 - dense_weight) / top_bm25
+        if dense_weight:
+            scores += dense_weight * self._dense(tokens)
+
+        allowed = self._allowed(metadata_filter)
+        if allowed is not None:
+            scores[~allowed] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > number_of_results:
+            top = np.argpartition(-scores[candidates], number_of_results - 1)
+            candidates = candidates[top[:number_of_results]]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            Document(
+                text=self._text(chunk_id),
+                metadata=Metadata(**self._sources[self._source_ids[chunk_id]]),
+                score=float(scores[chunk_id]),
+            )
+            for chunk_id in ranked
+        ]
+
+
+_lock = threading.Lock()
+_index: Optional[LocalIndex] = None
+
+
+def available() -> bool:
+    return bool(config.LOCAL_INDEX_DIR) and Path(config.LOCAL_INDEX_DIR).exists()
+
+
+def _get_index() -> LocalIndex:
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = LocalIndex(Path(config.LOCAL_INDEX_DIR))
+                logger.info("Loaded local index: chunks=%d", _index.count)
+    return _index
+
+
+def retrieve(query: str, metadata_filter: Optional[dict] = None) -> list[Document]:
+    """retriever._retrieve と同じ形の結果を、ローカルのインデックスから返す"""
+    return _get_index().search(query, metadata_filter)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("source_dir", type=Path)
+    build_parser.add_argument("index_dir", type=Path)
+    build_parser.add_argument(
+        "--dimensions", type=int, default=config.LOCAL_INDEX_DIMENSIONS
+    )
+    build_parser.add_argument(
+        "--chunk-tokens", type=int, default=config.LOCAL_INDEX_CHUNK_TOKENS
+    )
+    search_parser = subparsers.add_parser("search")
+    search_parser.add_argument("index_dir", type=Path)
+    search_parser.add_argument("query")
+    search_parser.add_argument("--filter", type=json.loads, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_index(
+            args.source_dir, args.index_dir, args.dimensions, args.chunk_tokens
+        )
+        print(f"Indexed {count} chunks into {args.index_dir}")
+        return
+
+    for document in LocalIndex(args.index_dir).search(args.query, args.filter):
+        print(f'{document["score"]:.3f} {document["metadata"]["url"]}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import logging
+from typing import AsyncIterator, Iterator, Optional
+
+from history import Message
+from retriever import (
+    SearchCondition,
+    generate_search_condition,
+    agenerate_search_condition,
+    retrieve_and_rerank,
+    aretrieve_and_rerank,
+)
+from generator import Answer, generate_answer_stream, agenerate_answer_stream
+from semantic_cache import answer_cache
+import config
+
+"""
+質問から回答までの一連の処理。
+似た質問の回答がキャッシュにあれば、検索と回答生成を省略してそれを返す。
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _lookup_cache(search_condition: SearchCondition) -> Optional[Answer]:
+    if not config.ANSWER_CACHE_ENABLED:
+        return None
+    try:
+        return answer_cache.lookup(search_condition["summary"])
+    except Exception as e:
+        logger.warning("Answer cache lookup failed: %r", e)
+        return None
+
+
+def _store_cache(search_condition: SearchCondition, answer: Answer):
+    if not config.ANSWER_CACHE_ENABLED:
+        return
+    try:
+        answer_cache.store(search_condition["summary"], answer)
+    except Exception as e:
+        logger.warning("Answer cache store failed: %r", e)
+
+
+def answer_stream(
+    messages: list[Message], search_condition: Optional[SearchCondition] = None
+) -> Iterator[Answer]:
+    """generate_answer_stream と同様に、途中までの回答を順に返し最後に完成した回答を返す"""
+    if search_condition is None:
+        search_condition = generate_search_condition(messages)
+    cached = _lookup_cache(search_condition)
+    if cached is not None:
+        yield cached
+        return
+
+    _, documents = retrieve_and_rerank(messages, search_condition=search_condition)
+    answer = None
+    for answer in generate_answer_stream(messages, documents):
+        yield answer
+    _store_cache(search_condition, answer)
+
+
+async def _alookup_cache(search_condition: SearchCondition) -> Optional[Answer]:
+    if not config.ANSWER_CACHE_ENABLED:
+        return None
+    try:
+        return await answer_cache.alookup(search_condition["summary"])
+    except Exception as e:
+        logger.warning("Answer cache lookup failed: %r", e)
+        return None
+
+
+async def _astore_cache(search_condition: SearchCondition, answer: Answer):
+    if not config.ANSWER_CACHE_ENABLED:
+        return
+    try:
+        await answer_cache.astore(search_condition["summary"], answer)
+    except Exception as e:
+        logger.warning("Answer cache store failed: %r", e)
+
+
+async def aanswer_stream(
+    messages: list[Message], search_condition: Optional[SearchCondition] = None
+) -> AsyncIterator[Answer]:
+    """answer_stream の非同期版。スレッドを使わずにaioboto3でBedrockを呼び出す"""
+    if search_condition is None:
+        search_condition = await agenerate_search_condition(messages)
+    cached = await _alookup_cache(search_condition)
+    if cached is not None:
+        yield cached
+        return
+
+    _, documents = await aretrieve_and_rerank(
+        messages, search_condition=search_condition
+    )
+    answer = None
+    async for answer in agenerate_answer_stream(messages, documents):
+        yield answer
+    await _astore_cache(search_condition, answer)
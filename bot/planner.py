@@ -0,0 +1,77 @@
+import json
+from typing import TypedDict
+
+from history import Message
+from retriever import SearchCondition
+from prompts import invoke_tool
+import config
+
+"""
+Slackでは会話が継続しているかの判定と検索クエリの生成をそれぞれ安いモデルで順番に呼んでいたが、
+検索を始める前にLLMを2往復するのが遅いので、1回の呼び出しで両方を決める。
+"""
+
+_tool_name = "plan_search"
+_tool_definition = {
+    "toolSpec": {
+        "name": _tool_name,
+        "description": "Send the continuity of the topic and search conditions for the vector store",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "is_continue": {
+                        "type": "boolean",
+                        "description": "The conversation context is the same"
+                        " (the topic is continuing) if true, otherwise false.",
+                    },
+                    "queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "List of search query texts",
+                    },
+                    "summary": {
+                        "type": "string",
+                        "description": "Summary of the search query",
+                    },
+                },
+                "required": ["is_continue", "queries", "summary"],
+            }
+        },
+    }
+}
+
+_prompt = f"""Your task is to be a technical supporter of users.
+Past conversations with the user are given as <messages> in order of oldest to newest,
+and the new message from the user is given as <new_message>.
+A message whose role is summary is a summary of the earlier conversation.
+The messages have no thread ID, so first decide whether the new message
+continues the topic of the past conversations. If it is hard to decide, treat it as continuing.
+Then search the necessary information from the vector database
+to reply to the new message.
+If the topic is not continuing, make the search conditions from the new message only.
+Use only the {_tool_name} tool, and write the text in English.
+You can write up to 4 objects in the queries argument.
+"""
+
+
+class Plan(TypedDict):
+    is_continue: bool
+    queries: list[str]
+    summary: str
+
+
+def make_plan(messages: list[Message], new_message: Message) -> Plan:
+    content = (
+        f"<messages>\n{json.dumps(messages, ensure_ascii=False)}\n</messages>\n"
+        f"<new_message>\n{json.dumps(new_message, ensure_ascii=False)}\n</new_message>"
+    )
+    plan = invoke_tool(config.CHEAP_MODEL_ID, _prompt, _tool_definition, content)
+    if not messages:
+        # 過去ログがなければ継続しようがない
+        plan["is_continue"] = False
+    return plan
+
+
+def to_search_condition(plan: Plan) -> SearchCondition:
+    return SearchCondition(queries=plan["queries"], summary=plan["summary"])
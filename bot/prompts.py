@@ -0,0 +1,107 @@
+import json
+import logging
+from typing import Optional
+
+from clients import get_bedrock_runtime_client, get_async_bedrock_runtime_client
+from documents import estimate_tokens
+import config
+
+"""
+Converse APIの呼び出しを組み立てる共通処理。
+指示文とツール定義は毎回同じなので system と toolConfig に置いてキャッシュポイントを付け、
+会話やドキュメントなどの毎回変わる部分はその後ろのユーザーメッセージに入れる。
+こうするとBedrockのプロンプトキャッシュが効き、入力トークンの課金と最初のトークンまでの時間が減る。
+キャッシュされるのはモデルごとの最小トークン数を超えるプレフィックスだけなので、
+PROMPT_CACHE_MIN_TOKENS にあるモデルで、プレフィックスがその長さに届く場合だけキャッシュポイントを付ける。
+"""
+
+logger = logging.getLogger(__name__)
+
+_cache_point = {"cachePoint": {"type": "default"}}
+
+
+def _cache_min_tokens(model_id: str) -> Optional[int]:
+    if not config.PROMPT_CACHE_ENABLED:
+        return None
+    for model, min_tokens in config.PROMPT_CACHE_MIN_TOKENS.items():
+        if model in model_id:
+            return min_tokens
+    return None
+
+
+def _system(instructions: str, cache: bool) -> list[dict]:
+    system = [{"text": instructions}]
+    if cache:
+        system.append(_cache_point)
+    return system
+
+
+def _tool_config(tool_definition: dict, cache: bool) -> dict:
+    tools = [tool_definition]
+    if cache:
+        tools.append(_cache_point)
+    return {
+        "tools": tools,
+        "toolChoice": {
+            "tool": {
+                "name": tool_definition["toolSpec"]["name"],
+            },
+        },
+    }
+
+
+def converse_params(
+    model_id: str, instructions: str, tool_definition: dict, content: str
+) -> dict:
+    # キャッシュのプレフィックスは toolConfig → system の順に積み上がる
+    min_tokens = _cache_min_tokens(model_id)
+    tool_tokens = estimate_tokens(json.dumps(tool_definition))
+    system_tokens = tool_tokens + estimate_tokens(instructions)
+    return {
+        "modelId": model_id,
+        "system": _system(
+            instructions, min_tokens is not None and system_tokens >= min_tokens
+        ),
+        "messages": [{"role": "user", "content": [{"text": content}]}],
+        "toolConfig": _tool_config(
+            tool_definition, min_tokens is not None and tool_tokens >= min_tokens
+        ),
+    }
+
+
+def log_usage(name: str, usage: Optional[dict]):
+    if not usage:
+        return
+    logger.info(
+        "Token usage: %s input=%d output=%d cache_read=%d cache_write=%d",
+        name,
+        usage.get("inputTokens", 0),
+        usage.get("outputTokens", 0),
+        usage.get("cacheReadInputTokens", 0),
+        usage.get("cacheWriteInputTokens", 0),
+    )
+
+
+def _tool_input(tool_definition: dict, response: dict) -> dict:
+    log_usage(tool_definition["toolSpec"]["name"], response.get("usage"))
+    return response["output"]["message"]["content"][0]["toolUse"]["input"]
+
+
+def invoke_tool(
+    model_id: str, instructions: str, tool_definition: dict, content: str
+) -> dict:
+    """ツールの使用を強制して呼び出し、ツールへの入力を返す"""
+    response = get_bedrock_runtime_client().converse(
+        **converse_params(model_id, instructions, tool_definition, content)
+    )
+    return _tool_input(tool_definition, response)
+
+
+async def ainvoke_tool(
+    model_id: str, instructions: str, tool_definition: dict, content: str
+) -> dict:
+    client = await get_async_bedrock_runtime_client()
+    response = await client.converse(
+        **converse_params(model_id, instructions, tool_definition, content)
+    )
+    return _tool_input(tool_definition, response)
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import discord
+
+from documents import estimate_tokens
+
+"""
+Discordのリプライツリーから会話を組み立てる。
+さかのぼる際は、参照先が解決済みならそれを、クライアントのメッセージキャッシュにあればそれを使い、
+どちらにもない場合だけAPIで取得する。
+組み立てた会話は末尾のメッセージIDをキーに覚えておくので、続きのリプライでは新しい分だけ取得すればよい。
+"""
+
+
+class ReplyChainBuilder:
+    def __init__(
+        self,
+        client: discord.Client,
+        to_entry: Callable[[discord.Message], dict],
+        max_depth: int,
+        max_tokens: int,
+        cache_size: int,
+    ):
+        self._client = client
+        self._to_entry = to_entry
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+        self.cache_size = cache_size
+        self._chains: OrderedDict = OrderedDict()
+
+    def remember(self, message_id: int, entries: list[dict]):
+        self._chains[message_id] = list(entries)
+        self._chains.move_to_end(message_id)
+        while len(self._chains) > self.cache_size:
+            self._chains.popitem(last=False)
+
+    def _recall(self, message_id: int) -> Optional[list[dict]]:
+        entries = self._chains.get(message_id)
+        if entries is None:
+            return None
+        self._chains.move_to_end(message_id)
+        return list(entries)
+
+    async def _resolve(
+        self, channel, reference: discord.MessageReference
+    ) -> Optional[discord.Message]:
+        if isinstance(reference.resolved, discord.Message):
+            return reference.resolved
+        if isinstance(reference.resolved, discord.DeletedReferencedMessage):
+            return None
+
+        cached = discord.utils.get(
+            self._client.cached_messages, id=reference.message_id
+        )
+        if cached is not None:
+            return cached
+
+        try:
+            return await channel.fetch_message(reference.message_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+    async def build(self, message: discord.Message) -> list[dict]:
+        """message までの会話を古い順に返す"""
+        ancestors = []
+        prefix: list[dict] = []
+        reference = message.reference
+        while reference is not None and reference.message_id is not None:
+            if len(ancestors) >= self.max_depth:
+                break
+
+            cached = self._recall(reference.message_id)
+            if cached is not None:
+                prefix = cached
+                break
+
+            parent = await self._resolve(message.channel, reference)
+            if parent is None:
+                break
+            ancestors.append(parent)
+            reference = parent.reference
+
+        entries = prefix
+        for ancestor in reversed(ancestors):
+            entries.append(self._to_entry(ancestor))
+            self.remember(ancestor.id, entries)
+        entries.append(self._to_entry(message))
+        self.remember(message.id, entries)
+
+        return self._truncate(entries)
+
+    def _truncate(self, entries: list[dict]) -> list[dict]:
+        # 深さとトークン数の上限に収まるように古いものから落とす。最後のメッセージは必ず残す
+        entries = entries[-(self.max_depth + 1) :]
+        used_tokens = 0
+        for i in range(len(entries) - 1, -1, -1):
+            used_tokens += estimate_tokens(entries[i]["content"])
+            if used_tokens > self.max_tokens and i < len(entries) - 1:
+                return entries[i + 1 :]
+        return entries
@@ -1,10 +1,30 @@
 import json
-from typing import TypedDict
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, TypedDict
 
 from history import Message
-from clients import bedrock_runtime_client, bedrock_agent_client
+from clients import (
+    get_bedrock_agent_client,
+    get_async_bedrock_agent_client,
+    call_hedged,
+    acall_hedged,
+)
+from documents import (
+    Document,
+    Metadata,
+    content_hash,
+    deduplicate,
+    pack,
+    score_of,
+)
+from cache import retrieval_cache, make_key, normalize_query
+from prompts import invoke_tool, ainvoke_tool
+from filters import build_filter
 import config
 
+logger = logging.getLogger(__name__)
 
 _tool_name = "search_vector_store"
 _tool_definition = {
@@ -31,13 +51,11 @@ _tool_definition = {
     }
 }
 
-_prompt = """Your task is to be a technical supporter of users.
+_prompt = f"""Your task is to be a technical supporter of users.
 Search the necessary information from the vector database.
 Conversations with user are given as <messages> in order of oldest to newest.
-Use only the $tool_name$ tool, and write the text in English.
+Use only the {_tool_name} tool, and write the text in English.
 You can write up to 4 objects in the conditions argument.
-
-<messages>$messages$</messages>
 """
 
 
@@ -46,67 +64,70 @@ class SearchCondition(TypedDict):
     summary: str
 
 
-def generate_search_condition(messages: list[Message]) -> SearchCondition:
-    prompt = _prompt.replace("$tool_name$", _tool_name).replace(
-        "$messages$", json.dumps(messages, indent=2, ensure_ascii=False)
-    )
-
-    response = bedrock_runtime_client.converse(
-        modelId=config.CHEAP_MODEL_ID,
-        messages=[{"role": "user", "content": [{"text": prompt}]}],
-        toolConfig={
-            "tools": [_tool_definition],
-            "toolChoice": {
-                "tool": {
-                    "name": _tool_name,
-                },
-            },
-        },
-    )
-    return response["output"]["message"]["content"][0]["toolUse"]["input"]
+def _search_condition_content(messages: list[Message]) -> str:
+    return f"<messages>{json.dumps(messages, ensure_ascii=False)}</messages>"
 
 
-class Metadata(TypedDict):
-    languages: list[str]
-    projects: list[str]
-    url: str
-    s3_uri: str
+def generate_search_condition(messages: list[Message]) -> SearchCondition:
+    content = _search_condition_content(messages)
+    return invoke_tool(config.CHEAP_MODEL_ID, _prompt, _tool_definition, content)
 
 
-class Document(TypedDict):
-    text: str
-    metadata: Metadata
+async def agenerate_search_condition(messages: list[Message]) -> SearchCondition:
+    content = _search_condition_content(messages)
+    return await ainvoke_tool(config.CHEAP_MODEL_ID, _prompt, _tool_definition, content)
 
 
-def _retrieve(query: str) -> list[Document]:
-    result: list[Document] = []
-    response = bedrock_agent_client.retrieve(
-        knowledgeBaseId=config.KNOWLEDGE_BASE_ID,
-        retrievalConfiguration={
+def _retrieval_configuration(metadata_filter: Optional[dict] = None) -> dict:
+    if metadata_filter is not None:
+        return {
             "vectorSearchConfiguration": {
-                "implicitFilterConfiguration": {
-                    "metadataAttributes": [
-                        {
-                            "description": f'Programming languages. Choose at most one: {", ".join(config.LANGUAGES)}',
-                            "key": "languages",
-                            "type": "STRING_LIST",
-                        },
-                        {
-                            "description": f'Project name. Choose at most one: {", ".join(config.PROJECTS)}',
-                            "key": "projects",
-                            "type": "STRING_LIST",
-                        },
-                    ],
-                    "modelArn": f"arn:aws:bedrock:{config.REGION_NAME}"
-                    f"::foundation-model/{config.CHEAP_MODEL_ID.replace('us.', '')}",
-                },
+                "filter": metadata_filter,
                 "numberOfResults": config.RETRIEVE_DOCUMENTS_PER_QUERY,
                 "overrideSearchType": "HYBRID",
             }
-        },
-        retrievalQuery={"text": query},
-    )
+        }
+
+    # 会話からフィルタを作れなかった場合だけ、Knowledge Baseに推論させる
+    return {
+        "vectorSearchConfiguration": {
+            "implicitFilterConfiguration": {
+                "metadataAttributes": [
+                    {
+                        "description": f'Programming languages. Choose at most one: {", ".join(config.LANGUAGES)}',
+                        "key": "languages",
+                        "type": "STRING_LIST",
+                    },
+                    {
+                        "description": f'Project name. Choose at most one: {", ".join(config.PROJECTS)}',
+                        "key": "projects",
+                        "type": "STRING_LIST",
+                    },
+                ],
+                "modelArn": f"arn:aws:bedrock:{config.REGION_NAME}"
+                f"::foundation-model/{config.CHEAP_MODEL_ID.replace('us.', '')}",
+            },
+            "numberOfResults": config.RETRIEVE_DOCUMENTS_PER_QUERY,
+            "overrideSearchType": "HYBRID",
+        }
+    }
+
+
+def _retrieve_params(
+    query: str, metadata_filter: Optional[dict] = None
+) -> (str, dict):
+    retrieval_configuration = _retrieval_configuration(metadata_filter)
+    cache_key = make_key("retrieve", normalize_query(query), retrieval_configuration)
+    params = {
+        "knowledgeBaseId": config.KNOWLEDGE_BASE_ID,
+        "retrievalConfiguration": retrieval_configuration,
+        "retrievalQuery": {"text": query},
+    }
+    return cache_key, params
 
+
+def _parse_retrieve_response(response: dict) -> list[Document]:
+    result: list[Document] = []
     for res in response["retrievalResults"]:
         result.append(
             Document(
@@ -117,29 +138,106 @@ def _retrieve(query: str) -> list[Document]:
                     url=res["metadata"]["url"],
                     s3_uri=res["metadata"]["x-amz-bedrock-kb-source-uri"],
                 ),
+                score=res.get("score", 0.0),
             )
         )
     return result
 
 
-def _rerank(query: str, documents: list[Document]) -> list[Document]:
-    result = []
-    response = bedrock_agent_client.rerank(
-        queries=[
+def _is_throttled(error: Exception) -> bool:
+    # botocoreを読み込まずに済むように、ClientErrorのレスポンスだけを見る
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") == "ThrottlingException"
+
+
+class _LocalResults(list):
+    """ローカルのインデックスから返した結果。スコアの尺度がKnowledge Baseとは異なる"""
+
+
+def _retrieve_local(query: str, metadata_filter: Optional[dict] = None) -> list:
+    # numpyの読み込みが重いので、ローカルの検索を使うときだけ読み込む
+    import local_retriever
+
+    return _LocalResults(local_retriever.retrieve(query, metadata_filter))
+
+
+def _can_fall_back(error: Exception) -> bool:
+    import local_retriever
+
+    if not (_is_throttled(error) and local_retriever.available()):
+        return False
+    logger.warning("Retrieve throttled, falling back to the local index")
+    return True
+
+
+def _retrieve(query: str, metadata_filter: Optional[dict] = None) -> list[Document]:
+    if config.RETRIEVAL_BACKEND == "local":
+        return _retrieve_local(query, metadata_filter)
+
+    cache_key, params = _retrieve_params(query, metadata_filter)
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = call_hedged(
+            "retrieve", get_bedrock_agent_client().retrieve, **params
+        )
+    except Exception as e:
+        if not _can_fall_back(e):
+            raise
+        return _retrieve_local(query, metadata_filter)
+    result = _parse_retrieve_response(response)
+    retrieval_cache.set(cache_key, result)
+    return result
+
+
+async def _aretrieve(
+    query: str, metadata_filter: Optional[dict] = None
+) -> list[Document]:
+    if config.RETRIEVAL_BACKEND == "local":
+        return await asyncio.to_thread(_retrieve_local, query, metadata_filter)
+
+    cache_key, params = _retrieve_params(query, metadata_filter)
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    client = await get_async_bedrock_agent_client()
+    try:
+        response = await acall_hedged("retrieve", client.retrieve, **params)
+    except Exception as e:
+        if not _can_fall_back(e):
+            raise
+        return await asyncio.to_thread(_retrieve_local, query, metadata_filter)
+    result = _parse_retrieve_response(response)
+    retrieval_cache.set(cache_key, result)
+    return result
+
+
+def _rerank_params(query: str, documents: list[Document]) -> (str, dict):
+    number_of_results = min(config.MAX_DOCUMENTS_PER_PROMPT, len(documents))
+    cache_key = make_key(
+        "rerank",
+        config.RERANK_MODEL_ID,
+        normalize_query(query),
+        number_of_results,
+        [content_hash(document["text"]) for document in documents],
+    )
+    params = {
+        "queries": [
             {"textQuery": {"text": query}, "type": "TEXT"},
         ],
-        rerankingConfiguration={
+        "rerankingConfiguration": {
             "bedrockRerankingConfiguration": {
                 "modelConfiguration": {
                     "modelArn": f"arn:aws:bedrock:{config.REGION_NAME}::foundation-model/{config.RERANK_MODEL_ID}"
                 },
-                "numberOfResults": min(
-                    config.RETRIEVE_DOCUMENTS_PER_QUERY, len(documents)
-                ),
+                "numberOfResults": number_of_results,
             },
             "type": "BEDROCK_RERANKING_MODEL",
         },
-        sources=[
+        "sources": [
             {
                 "inlineDocumentSource": {
                     "jsonDocument": {
@@ -154,23 +252,186 @@ def _rerank(query: str, documents: list[Document]) -> list[Document]:
             }
             for document in documents
         ],
+    }
+    return cache_key, params
+
+
+def _rerank(query: str, documents: list[Document]) -> list[Document]:
+    cache_key, params = _rerank_params(query, documents)
+    # 並び順（インデックス）だけをキャッシュする
+    indices = retrieval_cache.get(cache_key)
+    if indices is None:
+        response = call_hedged("rerank", get_bedrock_agent_client().rerank, **params)
+        indices = [res["index"] for res in response["results"]]
+        retrieval_cache.set(cache_key, indices)
+    return [documents[index] for index in indices]
+
+
+async def _arerank(query: str, documents: list[Document]) -> list[Document]:
+    cache_key, params = _rerank_params(query, documents)
+    indices = retrieval_cache.get(cache_key)
+    if indices is None:
+        client = await get_async_bedrock_agent_client()
+        response = await acall_hedged("rerank", client.rerank, **params)
+        indices = [res["index"] for res in response["results"]]
+        retrieval_cache.set(cache_key, indices)
+    return [documents[index] for index in indices]
+
+
+def _calibrate_local_scores(results: list[list[Document]]) -> list[list[Document]]:
+    """
+    スロットリングで一部のクエリだけローカルの検索にフォールバックした場合、
+    0〜1のローカルのスコアを同じリクエストのKnowledge Baseのスコアの範囲に写してから一緒に並べる。
+    """
+    bedrock_scores = [
+        score_of(document)
+        for result in results
+        if not isinstance(result, _LocalResults)
+        for document in result
+    ]
+    if not bedrock_scores:
+        return results
+    low, high = min(bedrock_scores), max(bedrock_scores)
+    return [
+        (
+            [
+                Document(
+                    text=document["text"],
+                    metadata=document["metadata"],
+                    score=low + score_of(document) * (high - low),
+                )
+                for document in result
+            ]
+            if isinstance(result, _LocalResults)
+            else result
+        )
+        for result in results
+    ]
+
+
+def _merge_results(queries: list[str], results: list) -> list[Document]:
+    # クエリの順番を保ったまま結合する。一部のクエリが失敗しても残りの結果は使う
+    succeeded: list[list[Document]] = []
+    errors = []
+    for query, result in zip(queries, results):
+        if isinstance(result, Exception):
+            logger.warning("Retrieve failed: query=%s error=%r", query, result)
+            errors.append(result)
+            continue
+        succeeded.append(result)
+
+    if errors and len(errors) == len(queries):
+        # 全滅した場合は回答できないので例外を投げる
+        raise errors[0]
+    return [
+        document
+        for result in _calibrate_local_scores(succeeded)
+        for document in result
+    ]
+
+
+def _retrieve_all(
+    queries: list[str], metadata_filter: Optional[dict] = None
+) -> list[Document]:
+    if not queries:
+        return []
+
+    def _safe_retrieve(query: str):
+        try:
+            return _retrieve(query, metadata_filter)
+        except Exception as e:
+            return e
+
+    max_workers = min(config.RETRIEVE_MAX_WORKERS, len(queries))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_safe_retrieve, queries))
+    return _merge_results(queries, results)
+
+
+async def _aretrieve_all(
+    queries: list[str], metadata_filter: Optional[dict] = None
+) -> list[Document]:
+    if not queries:
+        return []
+
+    semaphore = asyncio.Semaphore(config.RETRIEVE_MAX_WORKERS)
+
+    async def _safe_retrieve(query: str):
+        async with semaphore:
+            return await _aretrieve(query, metadata_filter)
+
+    results = await asyncio.gather(
+        *(_safe_retrieve(query) for query in queries), return_exceptions=True
     )
-    for res in response["results"]:
-        result.append(documents[res["index"]])
-    return result
+    return _merge_results(queries, results)
+
+
+def _rank_by_score(documents: list[Document]) -> list[Document]:
+    # 複数クエリの結果を、クエリの順番ではなく検索スコアの順に並べ直す
+    return sorted(documents, key=score_of, reverse=True)
+
+
+def _needs_rerank(ranked: list[Document]) -> bool:
+    """
+    検索スコアの上位 MAX_DOCUMENTS_PER_PROMPT 件が、それ以下と十分に離れていれば
+    リランクしてもプロンプトに入るドキュメントは変わらないので省略する。
+    """
+    k = config.MAX_DOCUMENTS_PER_PROMPT
+    if len(ranked) <= k:
+        return False
+    gap = score_of(ranked[k - 1]) - score_of(ranked[k])
+    return gap < config.RERANK_SKIP_MARGIN
+
+
+def _rerank_candidates(ranked: list[Document]) -> list[Document]:
+    return ranked[: config.RERANK_CANDIDATES]
+
+
+def _metadata_filter(messages: list[Message]) -> Optional[dict]:
+    if not config.LOCAL_FILTER_ENABLED:
+        return None
+    metadata_filter = build_filter(messages)
+    logger.info("Metadata filter: %s", metadata_filter)
+    return metadata_filter
 
 
 def retrieve_and_rerank(
-    messages: list[Message], use_rerank: bool = True
+    messages: list[Message],
+    use_rerank: bool = True,
+    search_condition: Optional[SearchCondition] = None,
 ) -> (SearchCondition, list[Document]):
-    result = []
-    search_condition = generate_search_condition(messages)
+    if search_condition is None:
+        search_condition = generate_search_condition(messages)
+    metadata_filter = _metadata_filter(messages)
+    result = _rank_by_score(
+        deduplicate(_retrieve_all(search_condition["queries"], metadata_filter))
+    )
 
-    for query in search_condition["queries"]:
-        documents = _retrieve(query)
-        result.extend(documents)
+    if use_rerank and _needs_rerank(result):
+        result = _rerank(search_condition["summary"], _rerank_candidates(result))
+    else:
+        logger.info("Rerank skipped: documents=%d", len(result))
+
+    logger.info("Retrieval cache stats: %s", retrieval_cache.stats())
+    return search_condition, pack(result)
+
+
+async def aretrieve_and_rerank(
+    messages: list[Message],
+    use_rerank: bool = True,
+    search_condition: Optional[SearchCondition] = None,
+) -> (SearchCondition, list[Document]):
+    if search_condition is None:
+        search_condition = await agenerate_search_condition(messages)
+    metadata_filter = _metadata_filter(messages)
+    result = _rank_by_score(
+        deduplicate(await _aretrieve_all(search_condition["queries"], metadata_filter))
+    )
 
-    if use_rerank and result:
-        result = _rerank(search_condition["summary"], result)
+    if use_rerank and _needs_rerank(result):
+        result = await _arerank(search_condition["summary"], _rerank_candidates(result))
+    else:
+        logger.info("Rerank skipped: documents=%d", len(result))
 
-    return search_condition, result
+    logger.info("Retrieval cache stats: %s", retrieval_cache.stats())
+    return search_condition, pack(result)
@@ -0,0 +1,169 @@
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+"""
+常駐するDiscord Bot向けの、処理済みメッセージの管理と同時実行数の制御。
+Bedrockのスロットリングの上限は全員で共有しているので、全体の同時実行数を制限し、
+特定のチャンネルやユーザーが枠を占有しないように順番を決める。
+"""
+
+
+class TTLSet:
+    """一定時間で期限切れになる、件数に上限のある集合"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+
+    def add(self, key) -> bool:
+        """新しく追加できた場合は True、既にあった場合は False を返す"""
+        now = time.monotonic()
+        # 追加順に並んでいるので、先頭から期限切れのものを捨てる
+        while self._items and next(iter(self._items.values())) < now:
+            self._items.popitem(last=False)
+
+        if key in self._items:
+            return False
+        self._items[key] = now + self.ttl
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return True
+
+    def __contains__(self, key) -> bool:
+        expires_at = self._items.get(key)
+        return expires_at is not None and expires_at >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _Waiter:
+    def __init__(self, channel_id: int, user_id: int):
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.event = asyncio.Event()
+
+
+class FairScheduler:
+    """
+    全体の同時実行数に上限を設け、チャンネルごと・ユーザーごとの同時実行数も制限する。
+    空きができたら、実行中の件数が少ないチャンネルの待ちを優先し、同じなら先着順で実行する。
+    待ちが max_queue を超えたら QueueFullError を投げて受け付けない。
+    """
+
+    def __init__(
+        self, max_concurrency: int, per_channel: int, per_user: int, max_queue: int
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_channel = per_channel
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self._running = 0
+        self._running_by_channel: dict = {}
+        self._running_by_user: dict = {}
+        self._waiters: list[_Waiter] = []
+
+    def stats(self) -> dict:
+        return {"running": self._running, "queued": len(self._waiters)}
+
+    def _can_run(self, channel_id: int, user_id: int) -> bool:
+        return (
+            self._running < self.max_concurrency
+            and self._running_by_channel.get(channel_id, 0) < self.per_channel
+            and self._running_by_user.get(user_id, 0) < self.per_user
+        )
+
+    def _start(self, channel_id: int, user_id: int):
+        self._running += 1
+        self._running_by_channel[channel_id] = (
+            self._running_by_channel.get(channel_id, 0) + 1
+        )
+        self._running_by_user[user_id] = self._running_by_user.get(user_id, 0) + 1
+
+    def _finish(self, channel_id: int, user_id: int):
+        self._running -= 1
+        self._running_by_channel[channel_id] -= 1
+        if not self._running_by_channel[channel_id]:
+            del self._running_by_channel[channel_id]
+        self._running_by_user[user_id] -= 1
+        if not self._running_by_user[user_id]:
+            del self._running_by_user[user_id]
+
+    def _wake_next(self):
+        while True:
+            candidates = [
+                waiter
+                for waiter in self._waiters
+                if self._can_run(waiter.channel_id, waiter.user_id)
+            ]
+            if not candidates:
+                return
+            # min は同じ値なら先に見つかった（先着の）ものを返す
+            waiter = min(
+                candidates,
+                key=lambda w: self._running_by_channel.get(w.channel_id, 0),
+            )
+            self._waiters.remove(waiter)
+            self._start(waiter.channel_id, waiter.user_id)
+            waiter.event.set()
+
+    async def _acquire(
+        self,
+        channel_id: int,
+        user_id: int,
+        on_wait: Optional[Callable[[int], Awaitable]],
+        status_interval: float,
+    ):
+        if len(self._waiters) >= self.max_queue:
+            raise QueueFullError()
+
+        waiter = _Waiter(channel_id, user_id)
+        self._waiters.append(waiter)
+        # 空きがあればすぐに実行できる
+        self._wake_next()
+        last_position = None
+        try:
+            while not waiter.event.is_set():
+                position = self._waiters.index(waiter) + 1
+                if on_wait is not None and position != last_position:
+                    await on_wait(position)
+                    last_position = position
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout=status_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # キャンセルされた場合は待ちから外す。既に枠を割り当てられていたら返す
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.event.is_set():
+                self._finish(channel_id, user_id)
+                self._wake_next()
+            raise
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        channel_id: int,
+        user_id: int,
+        on_wait: Optional[Callable[[int], Awaitable]] = None,
+        status_interval: float = 3.0,
+    ):
+        """
+        実行枠を確保している間だけ処理を行う。
+        待っている間は順番が変わるたびに on_wait(何番目か) を呼ぶ。
+        """
+        await self._acquire(channel_id, user_id, on_wait, status_interval)
+        try:
+            yield
+        finally:
+            self._finish(channel_id, user_id)
+            self._wake_next()
@@ -0,0 +1,206 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from clients import get_bedrock_runtime_client, get_async_bedrock_runtime_client
+from generator import Answer
+import config
+
+"""
+質問の要約（generate_search_conditionのsummary）を埋め込み、過去の質問と十分に似ていれば保存済みの回答を返す。
+FAQのような同じ質問の繰り返しでは、検索と高いモデルの呼び出しを丸ごと省略できる。
+件数が少ないのでベクトル検索は全件の内積で済ませている。
+Knowledge BaseのIDとコーパスのバージョンを名前空間にするので、コーパスが更新されると
+スナップショットに残っていた古い回答は読み込まれない。
+"""
+
+logger = logging.getLogger(__name__)
+
+
+# lookup と store で同じ文章を2回埋め込まないように、直近の結果を覚えておく
+_embeddings: OrderedDict = OrderedDict()
+_EMBEDDINGS_SIZE = 256
+
+
+def _embedding_params(text: str) -> dict:
+    return {
+        "modelId": config.EMBEDDING_MODEL_ID,
+        "body": json.dumps(
+            {
+                "inputText": text,
+                "dimensions": config.EMBEDDING_DIMENSIONS,
+                "normalize": True,
+            }
+        ),
+    }
+
+
+def _remember(text: str, body: bytes) -> tuple:
+    vector = tuple(json.loads(body)["embedding"])
+    _embeddings[text] = vector
+    while len(_embeddings) > _EMBEDDINGS_SIZE:
+        _embeddings.popitem(last=False)
+    return vector
+
+
+def _embed(text: str) -> tuple:
+    if text in _embeddings:
+        return _embeddings[text]
+    response = get_bedrock_runtime_client().invoke_model(
+        **_embedding_params(text)
+    )
+    return _remember(text, response["body"].read())
+
+
+async def _aembed(text: str) -> tuple:
+    if text in _embeddings:
+        return _embeddings[text]
+    client = await get_async_bedrock_runtime_client()
+    response = await client.invoke_model(**_embedding_params(text))
+    return _remember(text, await response["body"].read())
+
+
+def _normalize(vector) -> tuple:
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return tuple(v / norm for v in vector)
+
+
+def _copy_answer(answer: Answer) -> Answer:
+    # 呼び出し側が references を書き換えてもキャッシュに影響しないようにコピーする
+    return Answer(text=answer["text"], references=list(answer["references"]))
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        threshold: float,
+        max_size: int,
+        ttl: int,
+        namespace: str = "",
+        snapshot_path: str = "",
+        snapshot_interval: int = 60,
+    ):
+        self.threshold = threshold
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.hits = 0
+        self.misses = 0
+        # text -> (vector, answer, expires_at)。LRUの順番で並ぶ
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_saved = 0.0
+        if snapshot_path:
+            self._load()
+
+    def lookup(self, text: str) -> Optional[Answer]:
+        return self._find(_embed(text))
+
+    async def alookup(self, text: str) -> Optional[Answer]:
+        return self._find(await _aembed(text))
+
+    def store(self, text: str, answer: Answer):
+        self._add(text, _embed(text), answer)
+
+    async def astore(self, text: str, answer: Answer):
+        self._add(text, await _aembed(text), answer)
+
+    def _find(self, vector: tuple) -> Optional[Answer]:
+        now = time.time()
+        with self._lock:
+            best_key, best_similarity = None, -1.0
+            for key, (entry_vector, _, expires_at) in list(self._entries.items()):
+                if expires_at < now:
+                    del self._entries[key]
+                    continue
+                similarity = sum(a * b for a, b in zip(vector, entry_vector))
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            answer = self._entries[best_key][1]
+
+        logger.info(
+            "Answer cache hit: similarity=%.3f cached_summary=%s",
+            best_similarity,
+            best_key,
+        )
+        return _copy_answer(answer)
+
+    def _add(self, text: str, vector: tuple, answer: Answer):
+        with self._lock:
+            self._entries[text] = (vector, _copy_answer(answer), time.time() + self.ttl)
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        if (
+            self.snapshot_path
+            and time.monotonic() - self._last_saved >= self.snapshot_interval
+        ):
+            self.save()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def save(self):
+        with self._lock:
+            entries = [
+                {
+                    "namespace": self.namespace,
+                    "text": text,
+                    "vector": list(vector),
+                    "answer": answer,
+                    "expires_at": expires_at,
+                }
+                for text, (vector, answer, expires_at) in self._entries.items()
+            ]
+        # 書き込み途中のファイルを読まないように一時ファイルから置き換える
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+        self._last_saved = time.monotonic()
+
+    def _load(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to load answer cache snapshot: %r", e)
+            return
+
+        now = time.time()
+        for entry in entries[-self.max_size :]:
+            # 別のコーパスに対する回答は使わない
+            if entry.get("namespace") != self.namespace or entry["expires_at"] < now:
+                continue
+            self._entries[entry["text"]] = (
+                _normalize(entry["vector"]),
+                entry["answer"],
+                entry["expires_at"],
+            )
+        logger.info("Loaded %d answer cache entries", len(self._entries))
+
+
+answer_cache = SemanticAnswerCache(
+    threshold=config.ANSWER_CACHE_THRESHOLD,
+    max_size=config.ANSWER_CACHE_MAX_SIZE,
+    ttl=config.ANSWER_CACHE_TTL,
+    namespace=f"{config.KNOWLEDGE_BASE_ID}:{config.CORPUS_VERSION}",
+    snapshot_path=config.ANSWER_CACHE_SNAPSHOT_PATH,
+)
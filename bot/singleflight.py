@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Optional
+
+from cache import make_key, normalize_query
+from history import Message
+
+"""
+同じ内容の質問が同時に来たときに、検索と回答生成を1回だけ実行して結果を共有する。
+複数のチャンネルに同じ質問が投稿されたときや、回答中にもう一度メンションされたときに、
+同じ処理が並行して走らないようにする。
+途中までの回答も、後から来たリクエストに同じように配る。
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_key(messages: list[Message]) -> str:
+    return make_key(
+        [(message["role"], normalize_query(message["content"])) for message in messages]
+    )
+
+
+class _Flight:
+    def __init__(self):
+        self.latest: Any = None
+        self.version = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: dict[str, _Flight] = {}
+        self.requests = 0
+        self.coalesced = 0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._flights
+
+    async def _run(
+        self, key: str, flight: _Flight, factory: Callable[[], AsyncIterator]
+    ):
+        try:
+            async for value in factory():
+                async with flight.changed:
+                    flight.latest = value
+                    flight.version += 1
+                    flight.changed.notify_all()
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("Shared request was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            # 完了後に来たリクエストは新しく実行する
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+    async def stream(
+        self, key: str, factory: Callable[[], AsyncIterator]
+    ) -> AsyncIterator:
+        """
+        factory() が返す値を順に返す。同じ key で実行中のものがあれば、新しく実行せずにその値を受け取る。
+        途中の値は最新のものだけを受け取るので、途中を飛ばすことがある。最後の値は必ず受け取る。
+        """
+        self.requests += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+        else:
+            self.coalesced += 1
+            logger.info("Coalesced into an in-flight request: %s", self.stats())
+
+        seen = 0
+        while True:
+            async with flight.changed:
+                await flight.changed.wait_for(
+                    lambda: flight.version != seen or flight.done
+                )
+                version, latest = flight.version, flight.latest
+                done, error = flight.done, flight.error
+
+            if version != seen:
+                seen = version
+                yield latest
+            elif done:
+                if error is not None:
+                    raise error
+                return
@@ -1,26 +1,39 @@
 import os
 import logging
 import re
+import time
 import traceback
 
 from slack_bolt import App
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
 from aws_lambda_powertools import Logger
 
-from history import fetch_history, save_message
-from retriever import retrieve_and_rerank
-from generator import generate_answer
+import config
+
+"""
+コールドスタートを短くするため、RAGの処理（pynamodbや検索・回答生成のモジュール）は mention_handler の中で読み込む。
+ackだけを返す呼び出しではこれらを読み込まずに済む。
+boto3 は slack_bolt のLambdaアダプターが自己呼び出しのために読み込むので、ackの経路でも読み込まれる。
+Bolt の App は軽いのでLambdaの初期化フェーズで作る。トークンの検証（auth.test）は通信が発生するので行わない。
+bench_import.py でモジュールごとの読み込み時間を計測でき、tests/test_import_budget.py で予算を検査する。
+"""
 
 logger = Logger()
 
 SlackRequestHandler.clear_all_log_handlers()
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
-app = App(
-    token=os.environ.get("SLACK_BOT_TOKEN"),
-    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
-    process_before_response=True,
-)
+_history = None
+
+
+def _get_history():
+    # 履歴の処理はpynamodbを読み込むので、最初のメンションで読み込む
+    global _history
+    if _history is None:
+        import history
+
+        _history = history
+    return _history
 
 
 def _remove_mentions(text: str) -> str:
@@ -35,40 +48,83 @@ def _remove_after_backticks(text: str) -> str:
     return re.sub(r"```(\w+)", "```", text)
 
 
-@app.event("app_mention")
-def mention_handler(body, say):
+def mention_handler(body, say, client):
+    history_module = _get_history()
+    from planner import make_plan, to_search_condition
+    from pipeline import answer_stream
+    from dedup import claim
+
     event = body["event"]
+    event_id = event.get("client_msg_id") or body["event_id"]
+    if not claim(event_id):
+        # Slackからの再送などで既に処理済み
+        logger.info("Skip duplicated event", extra={"event_id": event_id})
+        return
+
     text = _remove_mentions(event["text"])
     channel = event["channel"]
     thread_ts = event["ts"]
 
+    # 生成を待たずにプレースホルダーを投稿し、生成途中のテキストで更新していく
+    placeholder = say(
+        text=config.PLACEHOLDER_TEXT, channel=channel, thread_ts=thread_ts
+    )
+
+    def update(reply: str):
+        client.chat_update(channel=channel, ts=placeholder["ts"], text=reply)
+
+    # 履歴の書き込みはまとめて、返信を投稿した後に行う
+    writer = history_module.HistoryWriter(channel, event["user"])
     try:
-        messages = fetch_history(channel, event["user"], text)
-        _, documents = retrieve_and_rerank(messages)
-        answer = generate_answer(messages, documents)
+        # 会話の継続判定と検索条件の生成を1回の呼び出しで済ませる
+        # 明らかな場合はLLMに聞かずに継続を判断し、新しい会話なら過去ログを渡さない
+        new_message = {"role": "user", "text": text}
+        history = history_module.load_history(channel, event["user"])
+        items = history["items"]
+        is_continue = history_module.decide_continuity(items, new_message)
+        plan = make_plan(
+            history_module.to_messages(items) if is_continue is not False else [],
+            new_message,
+        )
+        if is_continue is None:
+            is_continue = plan["is_continue"]
+            logger.info(
+                "Continuity decided by planner", extra={"is_continue": is_continue}
+            )
+        messages = history_module.resolve_history(
+            history, new_message, is_continue, writer
+        )
+
+        answer = None
+        last_updated = time.monotonic()
+        for answer in answer_stream(messages, to_search_condition(plan)):
+            now = time.monotonic()
+            if now - last_updated >= config.STREAM_UPDATE_INTERVAL:
+                update(_remove_after_backticks(answer["text"]) + " …")
+                last_updated = now
+
         answer["references"] = [
             ref.replace("http://", "https://") for ref in answer["references"]
         ]
 
-        save_message(channel, event["user"], {"role": "user", "text": text})
-        save_message(
-            channel, event["user"], {"role": "assistant", "text": answer["text"]}
-        )
+        writer.add(new_message)
+        writer.add({"role": "assistant", "text": answer["text"]})
 
         logger.info(
             "Successfully generated answer",
             extra={
-                "client_msg_id": event["client_msg_id"],
+                "event_id": event_id,
                 "references": answer["references"],
             },
         )
     except Exception:
         reply = (
             f"エラーが発生しました：```\n"
-            f"client_msg_id: {event['client_msg_id']}\n"
+            f"event_id: {event_id}\n"
             f"{traceback.format_exc()}```"
         )
-        say(text=reply, channel=channel, thread_ts=thread_ts)
+        update(reply)
+        writer.flush()
         return
 
     reply = _remove_after_backticks(answer["text"])
@@ -79,13 +135,53 @@ def mention_handler(body, say):
     for ref in answer["references"]:
         reply += ref + "\n"
 
-    say(text=reply, channel=channel, thread_ts=thread_ts)
+    update(reply)
+    writer.flush()
+
+
+def _ack(ack):
+    ack()
+
+
+app = App(
+    token=os.environ.get("SLACK_BOT_TOKEN"),
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    process_before_response=True,
+    token_verification_enabled=False,
+)
+if config.SLACK_ACK_FIRST:
+    # 3秒以内にackだけ返し、本体はLambdaを非同期に自己呼び出しして処理する（lazy listener）
+    # ローカルで app.start() した場合はスレッドで処理される
+    app.event("app_mention")(ack=_ack, lazy=[mention_handler])
+else:
+    app.event("app_mention")(mention_handler)
+
+
+def _use_thread_lazy_runner():
+    from slack_bolt.lazy_listener import ThreadLazyListenerRunner
+
+    # Lambdaの自己呼び出しの代わりにスレッドで実行する。AWSなしで検証する際に使う
+    app.listener_runner.lazy_listener_runner = ThreadLazyListenerRunner(
+        logger=app.logger, executor=app.listener_runner.listener_executor
+    )
+
+
+# SlackRequestHandler はLambdaで実行するランナーを設定するので、差し替えはその後に行う
+slack_handler = SlackRequestHandler(app=app)
+if config.SLACK_LAZY_RUNNER == "thread":
+    _use_thread_lazy_runner()
 
 
 def handler(event, context):
-    if event["headers"].get("x-slack-retry-num"):
-        # 再送の場合はスルーする
-        return {"statucCode": 200}
+    response = slack_handler.handle(event, context)
+
+    # ackだけの呼び出しでは履歴の処理を読み込んでいないので、読み込まれている場合だけ待つ
+    if _history is not None:
+        _history.wait_background_tasks()
+    return response
+
 
-    slack_handler = SlackRequestHandler(app=app)
-    return slack_handler.handle(event, context)
+if __name__ == "__main__":
+    # ローカル実行用。lazy listener はLambdaの代わりにスレッドで非同期に実行する
+    _use_thread_lazy_runner()
+    app.start(port=int(os.environ.get("PORT", "3000")))
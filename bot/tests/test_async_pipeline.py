@@ -0,0 +1,214 @@
+import asyncio
+import json
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("pynamodb")
+
+import config
+import generator
+import pipeline
+import prompts
+import retriever
+import semantic_cache
+from cache import MemoryCache
+from semantic_cache import SemanticAnswerCache
+
+_ANSWER = {"text": "rustup を使います", "references": ["https://example.com/q1/0"]}
+_SEARCH_CONDITION = {"queries": ["q1", "q2", "q3"], "summary": "Rustのインストール方法"}
+
+
+async def _aiter(items):
+    for item in items:
+        await asyncio.sleep(0)
+        yield item
+
+
+class _Body:
+    def __init__(self, payload: dict):
+        self._payload = payload
+
+    async def read(self) -> bytes:
+        return json.dumps(self._payload).encode()
+
+
+class _FakeRuntimeClient:
+    """aioboto3 の bedrock-runtime クライアントの代わり。メソッドはすべてコルーチン"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def converse(self, **params):
+        self.calls.append("converse")
+        tool_use = {"toolUse": {"input": _SEARCH_CONDITION}}
+        return {"output": {"message": {"content": [tool_use]}}}
+
+    async def converse_stream(self, **params):
+        self.calls.append("converse_stream")
+        raw = json.dumps(_ANSWER, ensure_ascii=False)
+        events = [{"messageStart": {"role": "assistant"}}]
+        events += [
+            {"contentBlockDelta": {"delta": {"toolUse": {"input": raw[i : i + 4]}}}}
+            for i in range(0, len(raw), 4)
+        ]
+        events += [{"messageStop": {"stopReason": "tool_use"}}]
+        return {"stream": _aiter(events)}
+
+    async def invoke_model(self, **params):
+        self.calls.append("invoke_model")
+        return {"body": _Body({"embedding": [1.0, 0.0]})}
+
+
+def _result(query: str, index: int, score: float) -> dict:
+    url = f"https://example.com/{query}/{index}"
+    return {
+        "content": {"text": f"doc {query} {index}"},
+        "metadata": {
+            "languages": ["rust"],
+            "projects": [],
+            "url": url,
+            "x-amz-bedrock-kb-source-uri": f"s3://bucket/{query}/{index}",
+        },
+        "score": score,
+    }
+
+
+class _FakeAgentClient:
+    """aioboto3 の bedrock-agent-runtime クライアントの代わり。q2 だけ失敗する"""
+
+    def __init__(self):
+        self.queries = []
+        self.rerank_sources = None
+
+    async def retrieve(self, **params):
+        query = params["retrievalQuery"]["text"]
+        self.queries.append(query)
+        await asyncio.sleep(0)
+        if query == "q2":
+            raise RuntimeError("boom")
+        return {
+            "retrievalResults": [
+                _result(query, index, 0.5 - index * 0.01) for index in range(4)
+            ]
+        }
+
+    async def rerank(self, **params):
+        self.rerank_sources = params["sources"]
+        count = params["rerankingConfiguration"]["bedrockRerankingConfiguration"][
+            "numberOfResults"
+        ]
+        # 元の順番の逆にして、リランクの結果が使われていることを確かめる
+        indices = list(reversed(range(len(params["sources"]))))[:count]
+        return {"results": [{"index": index} for index in indices]}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    runtime = _FakeRuntimeClient()
+    agent = _FakeAgentClient()
+
+    async def get_runtime():
+        return runtime
+
+    async def get_agent():
+        return agent
+
+    for module in (generator, prompts, semantic_cache):
+        monkeypatch.setattr(module, "get_async_bedrock_runtime_client", get_runtime)
+    monkeypatch.setattr(retriever, "get_async_bedrock_agent_client", get_agent)
+    monkeypatch.setattr(retriever, "retrieval_cache", MemoryCache(ttl=60, max_size=100))
+    monkeypatch.setattr(semantic_cache, "_embeddings", OrderedDict())
+    monkeypatch.setattr(
+        pipeline,
+        "answer_cache",
+        SemanticAnswerCache(threshold=0.95, max_size=10, ttl=60),
+    )
+    monkeypatch.setattr(config, "RETRIEVAL_BACKEND", "bedrock")
+    monkeypatch.setattr(config, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(config, "ANSWER_CACHE_ENABLED", True)
+    return runtime, agent
+
+
+def _collect(messages) -> list:
+    async def run():
+        return [answer async for answer in pipeline.aanswer_stream(messages)]
+
+    return asyncio.run(run())
+
+
+_MESSAGES = [{"role": "user", "text": "Rustのインストール方法は？"}]
+
+
+def test_aanswer_stream_streams_partial_answers(clients):
+    runtime, agent = clients
+
+    answers = _collect(_MESSAGES)
+
+    assert answers[-1] == _ANSWER
+    partial_texts = [answer["text"] for answer in answers[:-1]]
+    assert len(partial_texts) > 1
+    assert partial_texts == sorted(partial_texts, key=len)
+    assert all(_ANSWER["text"].startswith(text) for text in partial_texts)
+    assert runtime.calls == [
+        "converse",
+        "invoke_model",
+        "converse_stream",
+    ]
+
+
+def test_aanswer_stream_merges_partial_failures(clients, monkeypatch):
+    runtime, agent = clients
+    documents = []
+
+    async def fake_stream(messages, docs):
+        documents.extend(docs)
+        yield _ANSWER
+
+    monkeypatch.setattr(pipeline, "agenerate_answer_stream", fake_stream)
+
+    assert _collect(_MESSAGES) == [_ANSWER]
+
+    assert sorted(agent.queries) == ["q1", "q2", "q3"]
+    # q2 の失敗は無視して q1 と q3 の結果をスコア順に並べ、リランクにかける
+    candidates = [source["inlineDocumentSource"] for source in agent.rerank_sources]
+    assert [c["jsonDocument"]["text"] for c in candidates] == [
+        "doc q1 0",
+        "doc q3 0",
+        "doc q1 1",
+        "doc q3 1",
+        "doc q1 2",
+        "doc q3 2",
+        "doc q1 3",
+        "doc q3 3",
+    ]
+    assert [document["text"] for document in documents] == [
+        "doc q3 3",
+        "doc q1 3",
+        "doc q3 2",
+        "doc q1 2",
+        "doc q3 1",
+    ]
+
+
+def test_aanswer_stream_raises_when_every_query_fails(clients, monkeypatch):
+    runtime, agent = clients
+    monkeypatch.setitem(_SEARCH_CONDITION, "queries", ["q2"])
+
+    with pytest.raises(RuntimeError, match="boom"):
+        _collect(_MESSAGES)
+    assert "converse_stream" not in runtime.calls
+
+
+def test_aanswer_stream_returns_cached_answer(clients):
+    runtime, agent = clients
+
+    first = _collect(_MESSAGES)
+    agent.queries.clear()
+    second = _collect(_MESSAGES)
+
+    assert second == [first[-1]]
+    assert agent.queries == []
+    assert runtime.calls.count("converse_stream") == 1
+    # 埋め込みは一度だけ計算する
+    assert runtime.calls.count("invoke_model") == 1
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import clients
+import config
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # 最初のリクエストだけ遅らせて、ヘッジが先に返る状況を作る
+    slow_first_seconds = 0.0
+    requests = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.lock:
+            index = len(self.requests)
+            self.requests.append((self.path, json.loads(body)))
+        if index == 0 and self.slow_first_seconds:
+            time.sleep(self.slow_first_seconds)
+        payload = json.dumps(
+            {
+                "retrievalResults": [
+                    {
+                        "content": {"text": f"response {index}"},
+                        "location": {
+                            "type": "WEB",
+                            "webLocation": {"url": "https://example.com/"},
+                        },
+                        "score": 0.5,
+                    }
+                ]
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_endpoint(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("AWS_SESSION_TOKEN", raising=False)
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    _StubHandler.requests = []
+    _StubHandler.slow_first_seconds = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setitem(config.AWS_ENDPOINT_URLS, "bedrock-agent-runtime", url)
+    monkeypatch.setattr(clients, "_clients", {})
+    monkeypatch.setattr(clients, "_trackers", {})
+    yield _StubHandler
+    server.shutdown()
+    server.server_close()
+
+
+def _retrieve_params(query: str) -> dict:
+    return {
+        "knowledgeBaseId": "KBSTUB0001",
+        "retrievalQuery": {"text": query},
+    }
+
+
+def test_retrieve_against_stub_endpoint(stub_endpoint):
+    client = clients.get_bedrock_agent_client()
+    response = clients.call_hedged("retrieve", client.retrieve, **_retrieve_params("q"))
+
+    assert response["retrievalResults"][0]["content"]["text"] == "response 0"
+    path, body = stub_endpoint.requests[0]
+    assert path == "/knowledgebases/KBSTUB0001/retrieve"
+    assert body["retrievalQuery"] == {"text": "q"}
+
+
+def test_one_client_per_service(stub_endpoint):
+    # retrieve と rerank で接続プールを分けない
+    assert clients.get_bedrock_agent_client() is clients.get_bedrock_agent_client()
+    assert len(clients._clients) == 1
+
+
+def test_hedge_returns_faster_response(stub_endpoint, monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    tracker = clients._get_tracker("retrieve")
+    for _ in range(config.HEDGE_MIN_SAMPLES):
+        tracker.record(0.05)
+    stub_endpoint.slow_first_seconds = 2.0
+
+    client = clients.get_bedrock_agent_client()
+    started = time.monotonic()
+    response = clients.call_hedged("retrieve", client.retrieve, **_retrieve_params("q"))
+
+    assert time.monotonic() - started < 1.5
+    assert response["retrievalResults"][0]["content"]["text"] == "response 1"
+    assert len(stub_endpoint.requests) == 2
+
+
+def test_hedge_skipped_when_no_slots(stub_endpoint, monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(clients, "_hedge_slots", threading.BoundedSemaphore(1))
+    clients._hedge_slots.acquire()
+    tracker = clients._get_tracker("retrieve")
+    for _ in range(config.HEDGE_MIN_SAMPLES):
+        tracker.record(0.05)
+    stub_endpoint.slow_first_seconds = 0.3
+
+    client = clients.get_bedrock_agent_client()
+    response = clients.call_hedged("retrieve", client.retrieve, **_retrieve_params("q"))
+
+    assert response["retrievalResults"][0]["content"]["text"] == "response 0"
+    assert len(stub_endpoint.requests) == 1
+
+
+class _SlowThenFast:
+    """1回目の呼び出しだけ遅い非同期のAPI"""
+
+    def __init__(self, slow_seconds: float):
+        self.slow_seconds = slow_seconds
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self, **kwargs):
+        self.calls += 1
+        index = self.calls - 1
+        try:
+            await asyncio.sleep(self.slow_seconds if index == 0 else 0)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return {"index": index}
+
+
+@pytest.fixture
+def warmed_tracker(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(clients, "_trackers", {})
+    tracker = clients._get_tracker("rerank")
+    for _ in range(config.HEDGE_MIN_SAMPLES):
+        tracker.record(0.05)
+
+
+def test_async_hedge_returns_faster_response(warmed_tracker):
+    func = _SlowThenFast(2.0)
+
+    response = asyncio.run(clients.acall_hedged("rerank", func))
+
+    assert response == {"index": 1}
+    assert func.calls == 2
+    # 負けた方はキャンセルする
+    assert func.cancelled == 1
+
+
+def test_async_hedge_shares_in_flight_cap(warmed_tracker, monkeypatch):
+    monkeypatch.setattr(clients, "_hedge_slots", threading.BoundedSemaphore(1))
+    clients._hedge_slots.acquire()
+    func = _SlowThenFast(0.3)
+
+    response = asyncio.run(clients.acall_hedged("rerank", func))
+
+    assert response == {"index": 0}
+    assert func.calls == 1
+
+
+def test_async_hedge_releases_slot(warmed_tracker, monkeypatch):
+    monkeypatch.setattr(clients, "_hedge_slots", threading.BoundedSemaphore(1))
+
+    asyncio.run(clients.acall_hedged("rerank", _SlowThenFast(0.3)))
+
+    assert clients._hedge_slots.acquire(blocking=False)
+
+
+def test_async_caller_cancellation_cancels_primary(warmed_tracker):
+    func = _SlowThenFast(2.0)
+
+    async def run():
+        task = asyncio.ensure_future(clients.acall_hedged("rerank", func))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        # asyncio.run の終了時の後片付けより前に止まっている
+        assert func.cancelled == 1
+
+    asyncio.run(run())
+
+    assert func.calls == 1
@@ -0,0 +1,133 @@
+import asyncio
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("pynamodb")
+
+import discord
+
+import config
+from scheduler import FairScheduler
+
+
+@pytest.fixture
+def discord_bot(monkeypatch):
+    monkeypatch.setenv("DISCORD_BOT_TOKEN", "test")
+    module = importlib.import_module("discord_bot")
+    monkeypatch.setattr(
+        module,
+        "_scheduler",
+        FairScheduler(max_concurrency=1, per_channel=1, per_user=1, max_queue=10),
+    )
+    return module
+
+
+class _Placeholder:
+    def __init__(self, fail_edits: int = 0):
+        self.id = 1
+        self.edits = []
+        self.fail_edits = fail_edits
+
+    async def edit(self, content: str):
+        if self.fail_edits:
+            self.fail_edits -= 1
+            response = SimpleNamespace(status=500, reason="Internal Server Error")
+            raise discord.HTTPException(response, "edit failed")
+        self.edits.append(content)
+
+
+def _message(placeholder: _Placeholder, message_id: int = 10):
+    async def send(content, reference=None):
+        placeholder.edits.append(content)
+        return placeholder
+
+    return SimpleNamespace(
+        id=message_id,
+        channel=SimpleNamespace(id=100, send=send),
+        author=SimpleNamespace(id=200),
+    )
+
+
+def _fake_generate_reply(discord_bot, monkeypatch, release=None):
+    async def generate_reply(messages, placeholder):
+        if release is not None:
+            await release.wait()
+        return "回答"
+
+    monkeypatch.setattr(discord_bot, "generate_reply", generate_reply)
+
+
+def test_reply_without_waiting_skips_placeholder_reset(discord_bot, monkeypatch):
+    _fake_generate_reply(discord_bot, monkeypatch)
+    placeholder = _Placeholder()
+    messages = [{"role": "user", "content": "質問"}]
+
+    asyncio.run(discord_bot._reply(_message(placeholder), messages))
+
+    assert placeholder.edits == [config.PLACEHOLDER_TEXT, "回答"]
+
+
+def _reply_while_another_runs(discord_bot, monkeypatch, second: _Placeholder):
+    # 1件目が枠を使っている間に2件目を送り、2件目が順番待ちになるようにする
+    async def run():
+        release = asyncio.Event()
+        _fake_generate_reply(discord_bot, monkeypatch, release)
+        first_messages = [{"role": "user", "content": "1件目"}]
+        running = asyncio.ensure_future(
+            discord_bot._reply(_message(_Placeholder(), 10), first_messages)
+        )
+        await asyncio.sleep(0)
+        second_messages = [{"role": "user", "content": "2件目"}]
+        waiting = asyncio.ensure_future(
+            discord_bot._reply(_message(second, 11), second_messages)
+        )
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(running, waiting)
+
+    asyncio.run(run())
+
+
+def test_reply_after_waiting_resets_placeholder(discord_bot, monkeypatch):
+    second = _Placeholder()
+    _reply_while_another_runs(discord_bot, monkeypatch, second)
+
+    assert second.edits == [
+        config.PLACEHOLDER_TEXT,
+        "順番待ちをしています（1番目）…",
+        config.PLACEHOLDER_TEXT,
+        "回答",
+    ]
+
+
+def test_failed_queue_position_edit_does_not_abort_reply(discord_bot, monkeypatch):
+    second = _Placeholder(fail_edits=1)
+    _reply_while_another_runs(discord_bot, monkeypatch, second)
+
+    assert second.edits == [config.PLACEHOLDER_TEXT, "回答"]
+
+
+def test_only_successful_answers_are_remembered(discord_bot, monkeypatch):
+    async def failing_generate_reply(messages, placeholder):
+        raise RuntimeError("Bedrock is down")
+
+    monkeypatch.setattr(discord_bot, "generate_reply", failing_generate_reply)
+    placeholder = _Placeholder()
+    placeholder.id = 20
+    messages = [{"role": "user", "content": "質問"}]
+
+    asyncio.run(discord_bot._reply(_message(placeholder), messages))
+
+    assert "Bedrock is down" in placeholder.edits[-1]
+    assert discord_bot._reply_chains._recall(20) is None
+
+    _fake_generate_reply(discord_bot, monkeypatch)
+    placeholder.id = 21
+    asyncio.run(discord_bot._reply(_message(placeholder), messages))
+
+    assert discord_bot._reply_chains._recall(21) == messages + [
+        {"role": "assistant", "content": "回答"}
+    ]
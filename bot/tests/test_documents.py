@@ -0,0 +1,85 @@
+import config
+from documents import deduplicate, estimate_tokens, format_documents, pack
+
+
+def _document(text: str, uri: str = "s3://bucket/a", score: float = 0.5) -> dict:
+    return {
+        "text": text,
+        "metadata": {
+            "languages": [],
+            "projects": [],
+            "url": uri.replace("s3://bucket/", "https://example.com/"),
+            "s3_uri": uri,
+        },
+        "score": score,
+    }
+
+
+_BASE = " ".join(f"word{i}" for i in range(20))
+
+
+def test_deduplicate_removes_exact_duplicates_of_same_uri():
+    documents = [
+        _document("Rust の  インストール"),
+        # 空白や大文字小文字の違いは同じ内容とみなす
+        _document("rust の インストール "),
+        _document("Rust の インストール", uri="s3://bucket/b"),
+    ]
+
+    result = deduplicate(documents)
+
+    # 別のURIでも内容がほぼ同じなら取り除く
+    assert result == [documents[0]]
+
+
+def test_deduplicate_keeps_different_uri_and_content():
+    documents = [
+        _document("Rust のインストール方法"),
+        _document("Go のテストの書き方", uri="s3://bucket/b"),
+    ]
+
+    assert deduplicate(documents) == documents
+
+
+def test_deduplicate_near_duplicates_at_threshold():
+    # 20単語の5-gramは16個。末尾の1単語だけ違えば共通は15個でJaccardは15/17
+    one_word_changed = _BASE.rsplit(" ", 1)[0] + " changed"
+    # 中央の単語が違うと共通の5-gramは11個でJaccardは11/21
+    middle_changed = _BASE.replace("word10", "changed")
+    documents = [
+        _document(_BASE),
+        _document(one_word_changed, uri="s3://bucket/b"),
+        _document(middle_changed, uri="s3://bucket/c"),
+    ]
+
+    assert 15 / 17 >= config.NEAR_DUPLICATE_THRESHOLD > 11 / 21
+    assert deduplicate(documents) == [documents[0], documents[2]]
+
+
+def test_pack_caps_number_of_documents():
+    documents = [_document(f"doc {i}") for i in range(10)]
+
+    assert pack(documents, max_documents=3, token_budget=1000) == documents[:3]
+
+
+def test_pack_skips_documents_over_budget_and_keeps_later_ones():
+    small = _document("a" * 40)
+    large = _document("あ" * 100)
+    later = _document("b" * 40)
+    budget = estimate_tokens(small["text"]) + estimate_tokens(later["text"])
+
+    result = pack([small, large, later], max_documents=5, token_budget=budget)
+
+    assert result == [small, later]
+
+
+def test_format_documents_uses_tags_with_url():
+    documents = [
+        _document("  本文1\n", uri="s3://bucket/a"),
+        _document("本文2", uri="s3://bucket/b"),
+    ]
+
+    assert format_documents(documents) == (
+        '<document url="https://example.com/a">\n本文1\n</document>\n'
+        '<document url="https://example.com/b">\n本文2\n</document>'
+    )
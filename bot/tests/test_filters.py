@@ -0,0 +1,59 @@
+from filters import KeywordMatcher, build_filter, matches_filter
+
+
+def test_matcher_respects_word_boundaries():
+    matcher = KeywordMatcher({"AWS CDK": ["cdk"], "Shell": ["sh", "シェル"]})
+
+    assert matcher.find("cdk deploy を ssh 先で実行") == ["AWS CDK"]
+    assert matcher.find("シェルで cdk") == ["Shell", "AWS CDK"]
+
+
+def test_build_filter_reads_slack_messages():
+    messages = [{"role": "user", "text": "Boto3でS3にアップロードするには？"}]
+
+    assert build_filter(messages) == {
+        "listContains": {"key": "projects", "value": "Boto3"}
+    }
+
+
+def test_build_filter_reads_discord_messages():
+    messages = [{"role": "user", "content": "Python で Playwright を使いたい"}]
+
+    assert build_filter(messages) == {
+        "andAll": [
+            {"listContains": {"key": "languages", "value": "Python"}},
+            {"listContains": {"key": "projects", "value": "Playwright"}},
+        ]
+    }
+
+
+def test_build_filter_prefers_latest_message_and_falls_back_to_history():
+    messages = [
+        {"role": "user", "text": "tailwind の設定について"},
+        {"role": "assistant", "text": "Zustand の話ではありません"},
+        {"role": "user", "text": "もっと詳しく"},
+    ]
+    assert build_filter(messages) == {
+        "listContains": {"key": "projects", "value": "Tailwind CSS"}
+    }
+
+    messages.append({"role": "user", "text": "React だとどうなる？"})
+    assert build_filter(messages) == {
+        "listContains": {"key": "projects", "value": "React"}
+    }
+
+
+def test_build_filter_returns_none_without_matches():
+    assert build_filter([{"role": "user", "text": "こんにちは"}]) is None
+    assert build_filter([]) is None
+
+
+def test_matches_filter_evaluates_built_expressions():
+    expression = build_filter([{"role": "user", "text": "TypeScript と AWS CDK"}])
+
+    assert matches_filter(
+        expression, {"languages": ["TypeScript"], "projects": ["AWS CDK"]}
+    )
+    assert not matches_filter(
+        expression, {"languages": ["Python"], "projects": ["AWS CDK"]}
+    )
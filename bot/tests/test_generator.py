@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import generator
+from generator import StreamError, generate_answer_stream
+
+
+def _tool_input_events(fragments: list[str]) -> list[dict]:
+    return [
+        {"contentBlockDelta": {"delta": {"toolUse": {"input": fragment}}}}
+        for fragment in fragments
+    ]
+
+
+class _FakeClient:
+    def __init__(self, events):
+        self.events = events
+        self.params = None
+
+    def converse_stream(self, **params):
+        self.params = params
+        return {"stream": iter(self.events)}
+
+
+@pytest.fixture
+def fake_stream(monkeypatch):
+    def install(events):
+        client = _FakeClient(events)
+        monkeypatch.setattr(
+            generator, "get_bedrock_runtime_client", lambda: client
+        )
+        return client
+
+    return install
+
+
+def _generate():
+    messages = [{"role": "user", "text": "質問"}]
+    return generate_answer_stream(messages, [])
+
+
+def test_stream_decodes_tokens_split_inside_escapes(fake_stream):
+    answer = {"text": 'a "q"\n改行 😀 end', "references": ["https://example.com"]}
+    raw = json.dumps(answer)
+    # エスケープシーケンスやサロゲートペアの途中で区切る
+    fragments = [raw[i : i + 3] for i in range(0, len(raw), 3)]
+    fake_stream(
+        [{"messageStart": {"role": "assistant"}}]
+        + _tool_input_events(fragments)
+        + [{"messageStop": {"stopReason": "tool_use"}}]
+    )
+
+    answers = list(_generate())
+
+    partial_texts = [a["text"] for a in answers[:-1]]
+    assert partial_texts == sorted(partial_texts, key=len)
+    assert all(answer["text"].startswith(text) for text in partial_texts)
+    assert answers[-1] == answer
+
+
+def test_stream_logs_usage_from_metadata_event(fake_stream, monkeypatch):
+    usages = []
+    monkeypatch.setattr(
+        generator, "log_usage", lambda name, usage: usages.append(usage)
+    )
+    usage = {"inputTokens": 10, "outputTokens": 5}
+    fake_stream(
+        _tool_input_events(['{"text": "ok", ', '"references": []}'])
+        + [{"metadata": {"usage": usage, "metrics": {"latencyMs": 1}}}]
+    )
+
+    answers = list(_generate())
+
+    assert answers[-1] == {"text": "ok", "references": []}
+    assert usages == [usage]
+
+
+def test_stream_raises_on_error_event(fake_stream):
+    fake_stream(
+        _tool_input_events(['{"text": "途中', "まで"])
+        + [{"modelStreamErrorException": {"message": "boom"}}]
+    )
+
+    stream = _generate()
+    assert next(stream)["text"] == "途中"
+    assert next(stream)["text"] == "途中まで"
+    with pytest.raises(StreamError, match="boom"):
+        next(stream)
+
+
+def test_stream_propagates_transport_errors(fake_stream):
+    def events():
+        yield from _tool_input_events(['{"text": "abc'])
+        raise ConnectionError("reset")
+
+    client = fake_stream([])
+    client.events = events()
+
+    stream = _generate()
+    assert next(stream)["text"] == "abc"
+    with pytest.raises(ConnectionError):
+        next(stream)
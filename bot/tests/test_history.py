@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("pynamodb")
+
+import config
+import history
+from history import (
+    HistoryModel,
+    HistoryWriter,
+    _SUMMARY_TIMESTAMP,
+    load_history,
+    resolve_history,
+    wait_background_tasks,
+)
+
+_CH_USER = "C1#U1"
+# 以前の秒のソートキーと、現在のミリ秒のソートキー
+_SECONDS = 1_700_000_000
+_MILLIS = 1_700_000_100_000
+
+
+class _FakeTable:
+    """HistoryModel の読み書きをメモリ上の辞書で置き換える"""
+
+    def __init__(self):
+        self.items: dict = {}
+        self.queries: list[dict] = []
+
+    def put(self, timestamp: int, role: str, text: str) -> HistoryModel:
+        item = HistoryModel(_CH_USER, timestamp, role=role, text=text, ttl=0)
+        self.items[(item.ch_user, item.timestamp)] = item
+        return item
+
+    def timestamps(self) -> list:
+        return sorted(timestamp for _, timestamp in self.items)
+
+    def query(
+        self,
+        hash_key,
+        range_key_condition=None,
+        scan_index_forward=True,
+        limit=None,
+        attributes_to_get=None,
+    ):
+        self.queries.append({"scan_index_forward": scan_index_forward, "limit": limit})
+        items = sorted(
+            (item for item in self.items.values() if item.ch_user == hash_key),
+            key=lambda item: item.timestamp,
+            reverse=not scan_index_forward,
+        )
+        if range_key_condition is not None:
+            assert range_key_condition.operator == "<"
+            bound = int(range_key_condition.values[1].value["N"])
+            items = [item for item in items if item.timestamp < bound]
+        return iter(items[:limit] if limit is not None else items)
+
+    def save(self, item: HistoryModel):
+        self.items[(item.ch_user, item.timestamp)] = item
+
+    def delete(self, item: HistoryModel):
+        del self.items[(item.ch_user, item.timestamp)]
+
+    @contextmanager
+    def batch_write(self):
+        yield self
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = _FakeTable()
+    monkeypatch.setattr(HistoryModel, "query", table.query)
+    monkeypatch.setattr(HistoryModel, "batch_write", table.batch_write)
+    monkeypatch.setattr(HistoryModel, "save", lambda item: table.save(item))
+    return table
+
+
+def test_reset_deletes_old_items_but_keeps_new_turns(table):
+    table.put(_SUMMARY_TIMESTAMP, "summary", "前の要約")
+    table.put(_SECONDS, "user", "秒の時代の質問")
+    table.put(_MILLIS, "assistant", "ミリ秒の時代の回答")
+
+    writer = HistoryWriter("C1", "U1")
+    writer.add({"role": "user", "text": "新しい質問"})
+    writer.add({"role": "assistant", "text": "新しい回答"})
+    first, second = [item.timestamp for item in writer._items]
+    # リセットより後に別のリクエストが書き込んだやりとりは消さない
+    table.put(second + 1, "user", "並行して届いた質問")
+    writer.reset()
+    writer.flush()
+
+    assert table.timestamps() == [first, second, second + 1]
+    assert table.items[(_CH_USER, first)].text == "新しい質問"
+
+
+def test_reset_without_turns_deletes_everything(table):
+    table.put(_SUMMARY_TIMESTAMP, "summary", "前の要約")
+    table.put(_SECONDS, "user", "秒の時代の質問")
+    table.put(_MILLIS, "assistant", "ミリ秒の時代の回答")
+
+    # エラーで返信できなかった場合は、新しいやりとりを残さずに履歴だけを消す
+    writer = HistoryWriter("C1", "U1")
+    writer.reset()
+    writer.flush()
+
+    assert table.items == {}
+
+
+def test_flush_without_changes_does_nothing(table):
+    table.put(_MILLIS, "user", "質問")
+
+    HistoryWriter("C1", "U1").flush()
+
+    assert table.queries == []
+    assert table.timestamps() == [_MILLIS]
+
+
+def _put_turns(table, count: int) -> list:
+    # 古いやりとりは秒、新しいやりとりはミリ秒のソートキーで混在させる
+    timestamps = [_SECONDS + i for i in range(count // 2)]
+    timestamps += [_MILLIS + i for i in range(count - count // 2)]
+    for i, timestamp in enumerate(timestamps):
+        table.put(timestamp, "user" if i % 2 == 0 else "assistant", f"turn {i}")
+    return timestamps
+
+
+def test_load_history_reads_summary_and_recent_turns(table, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_MAX_TURNS", 3)
+    table.put(_SUMMARY_TIMESTAMP, "summary", "前の要約")
+    _put_turns(table, 6)
+
+    loaded = load_history("C1", "U1")
+
+    assert table.queries == [{"scan_index_forward": False, "limit": 5}]
+    assert [item.text for item in loaded["items"]] == [
+        "前の要約",
+        "turn 3",
+        "turn 4",
+        "turn 5",
+    ]
+    assert loaded["has_older_turns"]
+
+
+def test_load_history_without_older_turns(table, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_MAX_TURNS", 3)
+    _put_turns(table, 3)
+
+    loaded = load_history("C1", "U1")
+
+    assert [item.text for item in loaded["items"]] == ["turn 0", "turn 1", "turn 2"]
+    assert not loaded["has_older_turns"]
+
+
+def test_load_history_limits_tokens(table, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_MAX_TURNS", 3)
+    monkeypatch.setattr(config, "HISTORY_TOKEN_BUDGET", 30)
+    table.put(_MILLIS, "user", "あ" * 20)
+    table.put(_MILLIS + 1, "assistant", "い" * 20)
+
+    loaded = load_history("C1", "U1")
+
+    # 予算を超えても直近の1件は必ず残す
+    assert [item.timestamp for item in loaded["items"]] == [_MILLIS + 1]
+    assert loaded["has_older_turns"]
+
+
+def test_continuing_compacts_turns_older_than_loaded_window(table, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_MAX_TURNS", 3)
+    contents = []
+
+    def fake_invoke_tool(model_id, instructions, tool_definition, content):
+        contents.append(content)
+        return {"summary": "新しい要約"}
+
+    monkeypatch.setattr(history, "invoke_tool", fake_invoke_tool)
+    table.put(_SUMMARY_TIMESTAMP, "summary", "前の要約")
+    timestamps = _put_turns(table, 6)
+
+    loaded = load_history("C1", "U1")
+    writer = HistoryWriter("C1", "U1")
+    messages = resolve_history(
+        loaded, {"role": "user", "text": "続きの質問"}, True, writer
+    )
+    wait_background_tasks(timeout=5)
+
+    assert [message["text"] for message in messages] == [
+        "前の要約",
+        "turn 3",
+        "turn 4",
+        "turn 5",
+        "続きの質問",
+    ]
+    # 読み込んだ範囲のやりとりは残し、それより古いものだけを要約にまとめる
+    assert table.timestamps() == timestamps[3:] + [_SUMMARY_TIMESTAMP]
+    assert table.items[(_CH_USER, _SUMMARY_TIMESTAMP)].text == "新しい要約"
+    assert "前の要約" in contents[0]
+    assert all(f"turn {i}" in contents[0] for i in range(3))
+    assert "turn 3" not in contents[0]
+
+
+def test_new_topic_resets_history(table):
+    table.put(_SUMMARY_TIMESTAMP, "summary", "前の要約")
+    table.put(_MILLIS, "user", "前の質問")
+
+    loaded = load_history("C1", "U1")
+    writer = HistoryWriter("C1", "U1")
+    messages = resolve_history(loaded, {"role": "user", "text": "別の質問"}, False, writer)
+    writer.flush()
+
+    assert messages == [{"role": "user", "text": "別の質問"}]
+    assert table.items == {}
@@ -0,0 +1,20 @@
+import pytest
+
+from bench_import import IMPORT_BUDGET_MS, imported_modules, measure_import_ms
+
+pytest.importorskip("slack_bolt")
+pytest.importorskip("aws_lambda_powertools")
+
+
+def test_slack_bot_import_within_budget():
+    # 1回目はpycの生成などが入るので捨てる
+    measure_import_ms("slack_bot")
+
+    assert measure_import_ms("slack_bot") <= IMPORT_BUDGET_MS
+
+
+def test_slack_bot_defers_rag_modules():
+    # boto3 は slack_bolt のLambdaアダプターが読み込むので対象にしない
+    heavy_modules = ["pynamodb", "history", "retriever", "pipeline"]
+
+    assert imported_modules("slack_bot", heavy_modules) == []
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from local_retriever import LocalIndex, build_index
+
+_PAGES = {
+    "playwright/install.md": (
+        "Install Playwright with pip install playwright.\n\n"
+        "Then run playwright install to download the browsers.",
+        {"languages": ["Python"], "projects": ["Playwright"]},
+    ),
+    "cdk/deploy.md": (
+        "Run cdk deploy to deploy the stack.\n\nUse cdk diff before you deploy.",
+        {"languages": ["TypeScript"], "projects": ["AWS CDK"]},
+    ),
+    "react/hooks.md": (
+        "useState returns a state value and a setter.",
+        {"languages": ["TypeScript", "JavaScript"], "projects": ["React"]},
+    ),
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    source_dir = tmp_path / "output"
+    for name, (text, attributes) in _PAGES.items():
+        path = source_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        metadata = {**attributes, "url": f"https://example.com/{name}"}
+        path.with_suffix(".md.metadata.json").write_text(
+            json.dumps({"metadataAttributes": metadata})
+        )
+    # チャンクを段落ごとに分ける
+    count = build_index(source_dir, tmp_path / "index", dimensions=64, chunk_tokens=8)
+    assert count == 5
+    return LocalIndex(tmp_path / "index")
+
+
+def test_search_ranks_matching_chunk_first(index):
+    documents = index.search("how to install playwright browsers")
+
+    top = documents[0]
+    assert top["metadata"]["url"] == "https://example.com/playwright/install.md"
+    assert "playwright install" in top["text"]
+    scores = [document["score"] for document in documents]
+    assert scores == sorted(scores, reverse=True)
+    assert 0 < scores[0] <= 1
+
+
+def test_search_applies_metadata_filter(index):
+    expression = {"listContains": {"key": "projects", "value": "React"}}
+    documents = index.search("deploy install useState", expression)
+
+    assert [document["metadata"]["projects"] for document in documents] == [["React"]]
+
+
+def test_search_evaluates_combined_filters(index):
+    expression = {
+        "andAll": [
+            {"listContains": {"key": "languages", "value": "TypeScript"}},
+            {
+                "notEquals": {
+                    "key": "url",
+                    "value": "https://example.com/react/hooks.md",
+                }
+            },
+        ]
+    }
+    documents = index.search("deploy", expression)
+    urls = {document["metadata"]["url"] for document in documents}
+
+    assert urls == {"https://example.com/cdk/deploy.md"}
+
+
+def test_search_returns_at_most_requested_results(index):
+    assert len(index.search("install deploy useState", number_of_results=2)) == 2
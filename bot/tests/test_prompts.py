@@ -0,0 +1,54 @@
+import pytest
+
+import config
+from prompts import converse_params
+
+_cached_model = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+_tool_definition = {
+    "toolSpec": {
+        "name": "answer",
+        "description": "Answer",
+        "inputSchema": {"json": {"type": "object"}},
+    }
+}
+
+
+def _cache_points(params: dict) -> dict:
+    def has_cache_point(blocks):
+        return any("cachePoint" in block for block in blocks)
+
+    return {
+        "system": has_cache_point(params["system"]),
+        "tools": has_cache_point(params["toolConfig"]["tools"]),
+    }
+
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    monkeypatch.setattr(config, "PROMPT_CACHE_ENABLED", True)
+
+
+def test_no_cache_points_by_default(monkeypatch):
+    monkeypatch.setattr(config, "PROMPT_CACHE_ENABLED", False)
+    params = converse_params(_cached_model, "x" * 10000, _tool_definition, "q")
+
+    assert _cache_points(params) == {"system": False, "tools": False}
+
+
+def test_no_cache_points_for_models_without_prompt_caching(cache_enabled):
+    params = converse_params(config.CHEAP_MODEL_ID, "x" * 10000, _tool_definition, "q")
+
+    assert _cache_points(params) == {"system": False, "tools": False}
+
+
+def test_no_cache_points_below_minimum_prefix(cache_enabled):
+    params = converse_params(_cached_model, "short", _tool_definition, "q")
+
+    assert _cache_points(params) == {"system": False, "tools": False}
+
+
+def test_cache_point_when_prefix_reaches_minimum(cache_enabled):
+    params = converse_params(_cached_model, "x" * 10000, _tool_definition, "q")
+
+    assert _cache_points(params) == {"system": True, "tools": False}
+    assert params["toolConfig"]["toolChoice"] == {"tool": {"name": "answer"}}
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+
+from reply_chain import ReplyChainBuilder
+
+
+class _Channel:
+    def __init__(self, messages: dict):
+        self.messages = messages
+        self.fetched = []
+
+    async def fetch_message(self, message_id: int):
+        self.fetched.append(message_id)
+        return self.messages[message_id]
+
+
+def _message(message_id: int, content: str, parent_id=None, channel=None):
+    reference = None
+    if parent_id is not None:
+        reference = SimpleNamespace(message_id=parent_id, resolved=None)
+    return SimpleNamespace(
+        id=message_id, content=content, reference=reference, channel=channel
+    )
+
+
+def _builder(cached_messages=(), max_depth=10, max_tokens=1000):
+    return ReplyChainBuilder(
+        SimpleNamespace(cached_messages=list(cached_messages)),
+        lambda message: {"role": "user", "content": message.content},
+        max_depth=max_depth,
+        max_tokens=max_tokens,
+        cache_size=10,
+    )
+
+
+def _contents(entries: list[dict]) -> list[str]:
+    return [entry["content"] for entry in entries]
+
+
+def test_build_walks_reply_chain_using_cache_before_api():
+    channel = _Channel({})
+    root = _message(1, "root", channel=channel)
+    middle = _message(2, "middle", parent_id=1, channel=channel)
+    channel.messages[2] = middle
+    leaf = _message(3, "leaf", parent_id=2, channel=channel)
+    builder = _builder(cached_messages=[root])
+
+    entries = asyncio.run(builder.build(leaf))
+
+    assert _contents(entries) == ["root", "middle", "leaf"]
+    # root はクライアントのキャッシュにあるのでAPIでは取得しない
+    assert channel.fetched == [2]
+
+
+def test_build_reuses_remembered_chain():
+    channel = _Channel({})
+    builder = _builder()
+    builder.remember(
+        5, [{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}]
+    )
+    reply = _message(6, "follow-up", parent_id=5, channel=channel)
+
+    entries = asyncio.run(builder.build(reply))
+
+    assert _contents(entries) == ["q", "a", "follow-up"]
+    assert channel.fetched == []
+
+
+def test_build_truncates_to_depth_and_tokens():
+    channel = _Channel({})
+    builder = _builder(max_depth=2)
+    builder.remember(9, [{"role": "user", "content": str(i)} for i in range(5)])
+    last = _message(10, "last", parent_id=9, channel=channel)
+    entries = asyncio.run(builder.build(last))
+    assert _contents(entries) == ["3", "4", "last"]
+
+    builder = _builder(max_tokens=3)
+    builder.remember(9, [{"role": "user", "content": "長い" * 10}])
+    entries = asyncio.run(builder.build(last))
+    # 最後のメッセージは上限を超えても残す
+    assert _contents(entries) == ["last"]
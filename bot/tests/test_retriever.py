@@ -0,0 +1,93 @@
+import pytest
+
+pytest.importorskip("pynamodb")
+
+import config
+import retriever
+from retriever import _LocalResults, _merge_results, _needs_rerank, _rank_by_score
+
+
+def _document(url: str, score: float) -> dict:
+    return {
+        "text": url,
+        "metadata": {"languages": [], "projects": [], "url": url, "s3_uri": url},
+        "score": score,
+    }
+
+
+def test_local_fallback_scores_are_mapped_to_bedrock_range():
+    bedrock = [_document("kb-1", 0.6), _document("kb-2", 0.4)]
+    local = _LocalResults([_document("local-1", 1.0), _document("local-2", 0.5)])
+
+    merged = _merge_results(["q1", "q2"], [bedrock, local])
+
+    assert [document["score"] for document in merged] == pytest.approx(
+        [0.6, 0.4, 0.6, 0.5]
+    )
+
+
+def test_local_only_scores_are_unchanged():
+    local = _LocalResults([_document("local-1", 1.0), _document("local-2", 0.5)])
+
+    merged = _merge_results(["q1", "q2"], [local, ValueError("throttled")])
+
+    assert [document["score"] for document in merged] == [1.0, 0.5]
+
+
+def test_merge_raises_when_every_query_fails():
+    with pytest.raises(ValueError):
+        _merge_results(["q1"], [ValueError("throttled")])
+
+
+def test_rank_by_score_puts_documents_without_score_last():
+    unscored = _document("old-cache", 0.0)
+    del unscored["score"]
+    documents = [_document("a", 0.2), unscored, _document("b", 0.9)]
+
+    ranked = _rank_by_score(documents)
+
+    assert [document["text"] for document in ranked] == ["b", "a", "old-cache"]
+
+
+def test_needs_rerank_only_when_top_k_is_not_separated(monkeypatch):
+    monkeypatch.setattr(config, "MAX_DOCUMENTS_PER_PROMPT", 2)
+    monkeypatch.setattr(config, "RERANK_SKIP_MARGIN", 0.1)
+
+    close = [_document(str(i), score) for i, score in enumerate([0.9, 0.8, 0.75])]
+    separated = [_document(str(i), score) for i, score in enumerate([0.9, 0.8, 0.5])]
+
+    assert _needs_rerank(close)
+    assert not _needs_rerank(separated)
+    assert not _needs_rerank(close[:2])
+
+
+@pytest.mark.parametrize(
+    "scores, reranked", [([0.9, 0.8, 0.75], True), ([0.9, 0.8, 0.5], False)]
+)
+def test_retrieve_and_rerank_skips_rerank_for_separated_scores(
+    monkeypatch, scores, reranked
+):
+    monkeypatch.setattr(config, "MAX_DOCUMENTS_PER_PROMPT", 2)
+    monkeypatch.setattr(config, "RERANK_SKIP_MARGIN", 0.1)
+    monkeypatch.setattr(config, "LOCAL_FILTER_ENABLED", False)
+    documents = [
+        _document(f"document {i} " + "text " * i, score)
+        for i, score in enumerate(scores)
+    ]
+    monkeypatch.setattr(retriever, "_retrieve_all", lambda queries, _: documents)
+    rerank_calls = []
+
+    def fake_rerank(query, candidates):
+        rerank_calls.append(candidates)
+        return list(reversed(candidates))
+
+    monkeypatch.setattr(retriever, "_rerank", fake_rerank)
+    search_condition = {"queries": ["q"], "summary": "s"}
+
+    _, result = retriever.retrieve_and_rerank([], search_condition=search_condition)
+
+    assert bool(rerank_calls) == reranked
+    expected = list(reversed(documents)) if reranked else documents
+    assert [document["text"] for document in result] == [
+        document["text"] for document in expected
+    ]
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import semantic_cache
+from semantic_cache import SemanticAnswerCache
+
+_VECTORS = {
+    "Rustのインストール方法": (1.0, 0.0),
+    "Rustをインストールするには": (0.99, 0.141),
+    "Goのテストの書き方": (0.0, 1.0),
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_embed(monkeypatch):
+    monkeypatch.setattr(semantic_cache, "_embed", lambda text: _VECTORS[text])
+
+
+def _answer(text: str) -> dict:
+    return {"text": text, "references": ["https://example.com/"]}
+
+
+def test_similar_question_hits():
+    cache = SemanticAnswerCache(threshold=0.95, max_size=10, ttl=60)
+    cache.store("Rustのインストール方法", _answer("rustup を使います"))
+
+    assert cache.lookup("Rustをインストールするには")["text"] == "rustup を使います"
+    assert cache.lookup("Goのテストの書き方") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_snapshot_is_scoped_to_corpus_version(tmp_path):
+    path = str(tmp_path / "answers.json")
+    cache = SemanticAnswerCache(
+        threshold=0.95, max_size=10, ttl=60, namespace="kb:v1", snapshot_path=path
+    )
+    cache.store("Rustのインストール方法", _answer("rustup を使います"))
+    cache.save()
+
+    same = SemanticAnswerCache(
+        threshold=0.95, max_size=10, ttl=60, namespace="kb:v1", snapshot_path=path
+    )
+    assert same.lookup("Rustのインストール方法") is not None
+
+    updated = SemanticAnswerCache(
+        threshold=0.95, max_size=10, ttl=60, namespace="kb:v2", snapshot_path=path
+    )
+    assert updated.lookup("Rustのインストール方法") is None
+
+
+@pytest.mark.parametrize(
+    "lambda_name, expected", [("", "True"), ("slack-bot", "False")]
+)
+def test_disabled_by_default_on_lambda(lambda_name, expected):
+    env = {**os.environ, "AWS_LAMBDA_FUNCTION_NAME": lambda_name}
+    env.pop("ANSWER_CACHE_ENABLED", None)
+    result = subprocess.run(
+        [sys.executable, "-c", "import config; print(config.ANSWER_CACHE_ENABLED)"],
+        cwd=Path(__file__).resolve().parent.parent,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == expected
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("pynamodb")
+
+from singleflight import SingleFlight, conversation_key
+
+
+async def _collect(flights: SingleFlight, key: str, factory) -> list:
+    return [value async for value in flights.stream(key, factory)]
+
+
+def test_concurrent_requests_share_one_execution():
+    calls = 0
+
+    async def answer_stream():
+        nonlocal calls
+        calls += 1
+        for value in ["途中", "完成"]:
+            await asyncio.sleep(0.01)
+            yield value
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            *(_collect(flights, "key", answer_stream) for _ in range(3))
+        )
+        return flights, results
+
+    flights, results = asyncio.run(run())
+
+    assert calls == 1
+    # 途中の値は飛ばすことがあるが、最後の値は全員が受け取る
+    assert all(result[-1] == "完成" for result in results)
+    assert flights.stats() == {"requests": 3, "coalesced": 2, "in_flight": 0}
+
+
+def test_error_is_raised_to_every_waiter_and_next_request_runs_again():
+    calls = 0
+
+    async def failing_stream():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError("failed")
+        yield
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            *(_collect(flights, "key", failing_stream) for _ in range(2)),
+            return_exceptions=True,
+        )
+        assert not flights.in_flight("key")
+        with pytest.raises(RuntimeError):
+            await _collect(flights, "key", failing_stream)
+        return results
+
+    results = asyncio.run(run())
+
+    assert [str(result) for result in results] == ["failed", "failed"]
+    assert calls == 2
+
+
+def test_conversation_key_ignores_case_and_spacing():
+    assert conversation_key(
+        [{"role": "user", "content": "How  to install Playwright?"}]
+    ) == conversation_key([{"role": "user", "content": "how to install playwright"}])
+    assert conversation_key([{"role": "user", "content": "a"}]) != conversation_key(
+        [{"role": "assistant", "content": "a"}]
+    )
@@ -0,0 +1,188 @@
+import importlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import pytest
+
+pytest.importorskip("slack_bolt")
+pytest.importorskip("aws_lambda_powertools")
+pytest.importorskip("pynamodb")
+
+from slack_sdk.signature import SignatureVerifier
+
+import config
+
+SIGNING_SECRET = "test-secret"
+
+
+class _SlackApiStub(BaseHTTPRequestHandler):
+    calls = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if "json" in self.headers.get("Content-Type", ""):
+            params = json.loads(body)
+        else:
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+        self.calls.append((self.path.rsplit("/", 1)[-1], params))
+        payload = json.dumps({"ok": True, "ts": "1700000000.000200"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def slack_api():
+    _SlackApiStub.calls = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SlackApiStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/api/", _SlackApiStub.calls
+    server.shutdown()
+    server.server_close()
+
+
+class _FakeHistory:
+    def __init__(self):
+        self.loaded = []
+
+    def load_history(self, channel, user):
+        self.loaded.append((channel, user))
+        return {"items": []}
+
+    def decide_continuity(self, items, new_message):
+        return False
+
+    def to_messages(self, items):
+        return []
+
+    def resolve_history(self, history, new_message, is_continue, writer):
+        return [new_message]
+
+    class HistoryWriter:
+        def __init__(self, channel, user):
+            pass
+
+        def add(self, message):
+            pass
+
+        def flush(self):
+            pass
+
+
+@pytest.fixture
+def slack_bot(monkeypatch, slack_api):
+    monkeypatch.setenv("SLACK_BOT_TOKEN", "xoxb-test")
+    monkeypatch.setenv("SLACK_SIGNING_SECRET", SIGNING_SECRET)
+    monkeypatch.delenv("EVENT_TABLE_NAME", raising=False)
+    import dedup
+
+    monkeypatch.setattr(dedup, "_claimed", {})
+    monkeypatch.setattr(config, "SLACK_ACK_FIRST", True)
+    monkeypatch.setattr(config, "SLACK_LAZY_RUNNER", "thread")
+    import slack_bot
+
+    module = importlib.reload(slack_bot)
+    monkeypatch.setattr(module.app.client, "base_url", slack_api[0])
+
+    history = _FakeHistory()
+    monkeypatch.setattr(module, "_get_history", lambda: history)
+
+    import planner
+    import pipeline
+
+    monkeypatch.setattr(
+        planner, "make_plan", lambda messages, new_message: {"is_continue": False}
+    )
+    monkeypatch.setattr(planner, "to_search_condition", lambda plan: None)
+    monkeypatch.setattr(
+        pipeline,
+        "answer_stream",
+        lambda messages, condition: iter([{"text": "回答", "references": []}]),
+    )
+    return module, history
+
+
+def _lambda_event(body: dict, retry_num: int = 0) -> dict:
+    raw_body = json.dumps(body)
+    timestamp = str(int(time.time()))
+    headers = {
+        "content-type": "application/json",
+        "x-slack-request-timestamp": timestamp,
+        "x-slack-signature": SignatureVerifier(SIGNING_SECRET).generate_signature(
+            timestamp=timestamp, body=raw_body
+        ),
+    }
+    if retry_num:
+        headers["x-slack-retry-num"] = str(retry_num)
+        headers["x-slack-retry-reason"] = "http_timeout"
+    return {
+        "body": raw_body,
+        "headers": headers,
+        "isBase64Encoded": False,
+        "requestContext": {"http": {"method": "POST"}},
+    }
+
+
+_CONTEXT = SimpleNamespace(
+    function_name="slack-bot",
+    invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:slack-bot",
+)
+
+
+def _wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_thread_runner_replaces_lambda_runner(slack_bot):
+    from slack_bolt.lazy_listener import ThreadLazyListenerRunner
+
+    module, _ = slack_bot
+    assert isinstance(
+        module.app.listener_runner.lazy_listener_runner, ThreadLazyListenerRunner
+    )
+
+
+def test_mention_is_handled_once_and_retry_is_dropped(slack_bot, slack_api):
+    module, history = slack_bot
+    _, calls = slack_api
+    body = {
+        "token": "verification-token",
+        "team_id": "T1",
+        "api_app_id": "A1",
+        "type": "event_callback",
+        "event_id": "Ev1",
+        "event_time": int(time.time()),
+        "event": {
+            "type": "app_mention",
+            "user": "U1",
+            "text": "<@UBOT> 質問",
+            "ts": "1700000000.000100",
+            "channel": "C1",
+            "event_ts": "1700000000.000100",
+        },
+    }
+
+    response = module.handler(_lambda_event(body), _CONTEXT)
+    assert response["statusCode"] == 200
+    _wait_for(lambda: any(method == "chat.update" for method, _ in calls))
+
+    retried = module.handler(_lambda_event(body, retry_num=1), _CONTEXT)
+    assert retried["statusCode"] == 200
+    time.sleep(0.2)
+
+    # client_msg_id がないイベントでも event_id で重複を判定する
+    assert history.loaded == [("C1", "U1")]
+    chat_calls = [(method, params) for method, params in calls if "chat." in method]
+    assert [method for method, _ in chat_calls] == ["chat.postMessage", "chat.update"]
+    assert chat_calls[-1][1]["text"] == "回答"
@@ -14,6 +14,7 @@ if (process.env.SLACK_SIGNING_SECRET_DEV && process.env.SLACK_BOT_TOKEN_DEV) {
     },
     slackSigningSecret: process.env.SLACK_SIGNING_SECRET_DEV,
     slackBotToken: process.env.SLACK_BOT_TOKEN_DEV,
+    corpusVersion: process.env.CORPUS_VERSION,
   })
 }
 
@@ -25,6 +26,7 @@ if (process.env.SLACK_SIGNING_SECRET_PROD && process.env.SLACK_BOT_TOKEN_PROD) {
     },
     slackSigningSecret: process.env.SLACK_SIGNING_SECRET_PROD,
     slackBotToken: process.env.SLACK_BOT_TOKEN_PROD,
+    corpusVersion: process.env.CORPUS_VERSION,
   })
 }
 
@@ -35,5 +37,6 @@ if (process.env.DISCORD_BOT_TOKEN) {
       region: process.env.CDK_DEFAULT_REGION,
     },
     discordBotToken: process.env.DISCORD_BOT_TOKEN,
+    corpusVersion: process.env.CORPUS_VERSION,
   })
 }
@@ -6,6 +6,7 @@ import * as ecs from 'aws-cdk-lib/aws-ecs'
 
 interface DiscordBotStackProps extends cdk.StackProps {
   discordBotToken: string
+  corpusVersion?: string
 }
 
 export class DiscordBotStack extends cdk.Stack {
@@ -35,6 +36,7 @@ export class DiscordBotStack extends cdk.Stack {
             effect: iam.Effect.ALLOW,
             actions: [
               'bedrock:InvokeModel',
+              'bedrock:InvokeModelWithResponseStream',
               'bedrock:Retrieve',
               'bedrock:Rerank',
             ],
@@ -62,6 +64,7 @@ export class DiscordBotStack extends cdk.Stack {
       }),
       environment: {
         DISCORD_BOT_TOKEN: props?.discordBotToken,
+        CORPUS_VERSION: props?.corpusVersion ?? '',
       },
     })
 
@@ -10,6 +10,7 @@ import { HttpLambdaIntegration } from 'aws-cdk-lib/aws-apigatewayv2-integrations
 interface SlackBotStackProps extends cdk.StackProps {
   slackSigningSecret: string
   slackBotToken: string
+  corpusVersion?: string
 }
 
 export class SlackBotStack extends cdk.Stack {
@@ -29,6 +30,27 @@ export class SlackBotStack extends cdk.Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     })
 
+    const cacheTable = new dynamodb.Table(this, 'CacheTable', {
+      partitionKey: {
+        name: 'cache_key',
+        type: dynamodb.AttributeType.STRING,
+      },
+      timeToLiveAttribute: 'ttl',
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    })
+
+    // Slackのイベントを重複して処理しないための記録
+    const eventTable = new dynamodb.Table(this, 'EventTable', {
+      partitionKey: {
+        name: 'event_id',
+        type: dynamodb.AttributeType.STRING,
+      },
+      timeToLiveAttribute: 'ttl',
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    })
+
     const handler = new python.PythonFunction(this, 'Handler', {
       entry: '../bot',
       index: 'slack_bot.py',
@@ -39,12 +61,32 @@ export class SlackBotStack extends cdk.Stack {
       environment: {
         POWERTOOLS_SERVICE_NAME: 'slack-bot',
         HISTORY_TABLE_NAME: historyTable.tableName,
+        CACHE_TABLE_NAME: cacheTable.tableName,
+        EVENT_TABLE_NAME: eventTable.tableName,
+        RETRIEVAL_CACHE_BACKEND: 'dynamodb',
+        CORPUS_VERSION: props.corpusVersion ?? '',
         SLACK_SIGNING_SECRET: props.slackSigningSecret,
         SLACK_BOT_TOKEN: props.slackBotToken,
       },
     })
 
     historyTable.grantReadWriteData(handler)
+    cacheTable.grantReadWriteData(handler)
+    eventTable.grantReadWriteData(handler)
+
+    // lazy listener はLambdaを非同期に自己呼び出しする
+    // 関数とロールの循環参照を避けるため、別のポリシーとしてアタッチする
+    handler.role?.attachInlinePolicy(
+      new iam.Policy(this, 'SelfInvokePolicy', {
+        statements: [
+          new iam.PolicyStatement({
+            effect: iam.Effect.ALLOW,
+            actions: ['lambda:InvokeFunction'],
+            resources: [handler.functionArn],
+          }),
+        ],
+      }),
+    )
 
     const bedrockInvokeModelPolicy = new iam.ManagedPolicy(
       this,
@@ -55,6 +97,7 @@ export class SlackBotStack extends cdk.Stack {
             effect: iam.Effect.ALLOW,
             actions: [
               'bedrock:InvokeModel',
+              'bedrock:InvokeModelWithResponseStream',
               'bedrock:Retrieve',
               'bedrock:Rerank',
             ],
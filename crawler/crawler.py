@@ -1,22 +1,55 @@
 import os
+import re
+import hashlib
 import urllib.parse
 from pathlib import Path
 import time
-import multiprocessing
-from functools import partial
+import asyncio
+import threading
 from typing import Optional, TypedDict, List
 import json
 
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
+import requests
 import trafilatura
 from bs4 import BeautifulSoup
-
+from frontier import Frontier
 from models import Page
 
 # ファイル保存先
 OUTPUT_DIR = Path(__file__).resolve().parent.parent.parent / "output"
+# クロール完了時にコーパスのバージョンを書き出す。デプロイ時に CORPUS_VERSION として渡すとBotのキャッシュが切り替わる
+CORPUS_VERSION_PATH = OUTPUT_DIR.parent / "corpus_version"
+# クロールごとに、追加・変更・削除したドキュメントの一覧を書き出す。Knowledge Baseへの同期に使う
+MANIFEST_DIR = OUTPUT_DIR.parent / "manifests"
+# 同じホストへのリクエストの間隔（秒）
 INTERVAL = 0.1
 
+# 全体と、ホストごとに同時に開くページ数
+CONCURRENCY = 8
+PER_HOST_CONCURRENCY = 4
+# 1ページの取得にかける時間の上限（秒）
+PAGE_TIMEOUT = 60
+# 取得に失敗したページは、キューの最後に戻して同じクロールの中でこの回数まで試す
+PAGE_ATTEMPTS = 3
+# 起動したままにするブラウザで使い回すコンテキストの数
+BROWSER_CONTEXTS = 4
+# 1つのコンテキストでこのページ数を処理したら作り直す
+PAGES_PER_CONTEXT = 50
+# クローラーとブラウザのメモリ使用量（RSS）がこれを超えたらコンテキストを作り直す
+MEMORY_LIMIT_MB = 1500
+# メモリ使用量を確認する間隔（ページ数）
+MEMORY_CHECK_INTERVAL = 20
+# 進捗を表示する間隔（ページ数）
+REPORT_INTERVAL = 50
+
+# fetch_strategy が auto のとき、HTTPで取得した本文がこれより短ければブラウザで取得し直す
+MIN_CONTENT_LENGTH = 200
+# auto でこの回数続けてブラウザが必要になったホストは、以降はブラウザだけで取得する
+JS_ONLY_AFTER = 5
+HTTP_TIMEOUT = 20
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; c105-expert-ai-crawler)"}
+
 
 class CrawlProps(TypedDict, total=False):
     host: str
@@ -26,84 +59,570 @@ class CrawlProps(TypedDict, total=False):
     ignore_suffixes: Optional[List[str]]
     languages: List[str]
     projects: List[str]
+    # auto: HTTPで取得して本文が取れなければブラウザ、http: HTTPのみ、browser: ブラウザのみ
+    fetch_strategy: str
+    # JavaScriptで描画されるサイトの場合は True にすると、HTTPでの取得を試さない
+    js_only: bool
+
+
+class Manifest(TypedDict):
+    version: str
+    # OUTPUT_DIR からの相対パス（.md）。.md.metadata.json も同じように扱う
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+
+def start_crawl(props: CrawlProps, incremental: bool = False):
+    start_crawls([props], incremental)
+
+
+def start_crawls(props_list: list[CrawlProps], incremental: bool = False):
+    """
+    複数のサイトを同時にクロールする。同時に開くページ数は全体とホストごとに制限する。
+    incremental が True なら取得済みのページも条件付きリクエストで取得し直し、変わったものだけを書き換える。
+    """
+    manifest = Manifest(version="", added=[], changed=[], removed=[])
+    asyncio.run(_crawl(props_list, manifest, incremental))
+    if not (manifest["added"] or manifest["changed"] or manifest["removed"]):
+        # 何も変わっていなければバージョンを据え置き、Botのキャッシュを無効にしない
+        print("No documents changed, keeping the current corpus version")
+        return
+    manifest["version"] = _publish_corpus_version()
+    _write_manifest(manifest)
+
+
+def _publish_corpus_version() -> str:
+    version = time.strftime("%Y%m%d%H%M%S")
+    with open(CORPUS_VERSION_PATH, "w") as f:
+        f.write(version)
+    print(f"Published corpus version {version}")
+    return version
+
+
+def _write_manifest(manifest: Manifest):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest_path = MANIFEST_DIR / f"{manifest['version']}.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    print(
+        f"Wrote manifest {manifest_path}: added {len(manifest['added'])},"
+        f" changed {len(manifest['changed'])}, removed {len(manifest['removed'])}"
+    )
+
+
+def _child_pids(pid: int) -> Optional[list[int]]:
+    # /proc/<pid>/task/<tid>/children がないカーネルでは None を返す
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    pids = []
+    for tid in tids:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            if not os.path.exists(f"/proc/{pid}/task/{tid}"):
+                continue
+            return None
+        except OSError:
+            continue
+    return pids
 
 
-def start_crawl(props: CrawlProps):
-    initial_page = Page()
-    initial_page.host = props.get("host")
-    initial_page.url = props.get("start_url")
-    initial_page.save()
-
-    with multiprocessing.Pool() as pool:
-        scrape_func = partial(_scrape_page, props)
-
-        while True:
-            pages = Page.select().where(
-                Page.host == props.get("host"), Page.is_scraped == False
-            )
-            print(f"Remaining {str(len(pages))} pages")
-            if not pages:
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _process_memory_mb() -> float:
+    """このプロセスと、その子孫のプロセス（ブラウザ）のRSSの合計を /proc から読む"""
+    # 子プロセスの一覧を読めれば、/proc 全体ではなくプロセスツリーだけをたどる
+    total_kb = 0
+    stack = [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        children = _child_pids(pid)
+        if children is None:
+            return _scan_process_memory_mb()
+        total_kb += _rss_kb(pid)
+        stack.extend(children)
+    return total_kb / 1024
+
+
+def _scan_process_memory_mb() -> float:
+    """_process_memory_mb と同じ値を、/proc の全てのプロセスを読んで求める"""
+    children: dict[int, list[int]] = {}
+    rss_kb: dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as f:
+                status = dict(
+                    line.split(":", 1) for line in f.read().splitlines() if ":" in line
+                )
+        except OSError:
+            continue
+        pid = int(entry)
+        children.setdefault(int(status["PPid"]), []).append(pid)
+        rss_kb[pid] = int(status.get("VmRSS", "0 kB").split()[0])
+
+    total_kb = 0
+    stack = [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        total_kb += rss_kb.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total_kb / 1024
+
+
+class _Context:
+    def __init__(self, context):
+        self.context = context
+        self.pages = 0
+        self.active = 0
+        self.retired = False
+
+
+class _BrowserPool:
+    """
+    ブラウザは起動したままにし、少数のコンテキストで多数のページを開く。
+    ページ数やメモリ使用量が上限を超えたコンテキストは新しいものと入れ替え、
+    開いているページがなくなってから閉じる。ブラウザが落ちたら起動し直す。
+    """
+
+    def __init__(self):
+        self._playwright = None
+        self._browser = None
+        self._contexts: list[_Context] = []
+        self._released = 0
+        self._start_lock = asyncio.Lock()
+        self._restart_lock = asyncio.Lock()
+
+    async def _start(self):
+        # HTTPだけで取得できるサイトではブラウザを起動しないように、最初に使うときに起動する
+        async with self._start_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+                await self._launch()
+
+    async def _launch(self):
+        self._browser = await self._playwright.chromium.launch()
+        self._contexts = [
+            _Context(await self._browser.new_context())
+            for _ in range(BROWSER_CONTEXTS)
+        ]
+
+    async def _restart(self, browser):
+        async with self._restart_lock:
+            # 他のページが既に起動し直していれば何もしない
+            if self._browser is not browser:
                 return
+            print("Restarting browser")
+            try:
+                await browser.close()
+            except Exception:
+                pass
+            await self._launch()
+
+    async def _retire(self, context: _Context):
+        if context.retired:
+            return
+        context.retired = True
+        # ブラウザを起動し直した後なら、既に新しいコンテキストに入れ替わっている
+        if context in self._contexts:
+            new_context = _Context(await self._browser.new_context())
+            # new_context を待っている間に起動し直されることもある
+            if context in self._contexts:
+                self._contexts[self._contexts.index(context)] = new_context
+            else:
+                await new_context.context.close()
+        if context.active == 0:
+            await context.context.close()
+
+    async def _release(self, context: _Context, browser):
+        context.active -= 1
+        context.pages += 1
+        self._released += 1
+        if self._browser is not browser or not browser.is_connected():
+            return
+        if context.retired:
+            if context.active == 0:
+                await context.context.close()
+        elif context.pages >= PAGES_PER_CONTEXT:
+            await self._retire(context)
+        elif self._released % MEMORY_CHECK_INTERVAL == 0:
+            if await asyncio.to_thread(_process_memory_mb) > MEMORY_LIMIT_MB:
+                print("Exceeded memory limit, recycling contexts")
+                for other in list(self._contexts):
+                    await self._retire(other)
+
+    async def fetch(self, url: str) -> (str, str, int):
+        """url を開いて (HTML, タイトル, ステータスコード) を返す。ブラウザが落ちていたら起動し直して1回だけやり直す"""
+        await self._start()
+        for attempt in range(2):
+            browser = self._browser
+            context = min(self._contexts, key=lambda c: c.active)
+            context.active += 1
+            try:
+                browser_page = await context.context.new_page()
+                try:
+                    response = await browser_page.goto(url, wait_until="networkidle")
+                    return (
+                        await browser_page.content(),
+                        await browser_page.title(),
+                        response.status if response else 200,
+                    )
+                finally:
+                    await browser_page.close()
+            except Exception:
+                if attempt or browser.is_connected():
+                    raise
+                await self._restart(browser)
+            finally:
+                await self._release(context, browser)
+
+    async def close(self):
+        if self._playwright is None:
+            return
+        try:
+            await self._browser.close()
+        finally:
+            await self._playwright.stop()
+
+
+class _Stats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.scraped = 0
+
+    def add(self, remaining: int):
+        self.scraped += 1
+        if self.scraped % REPORT_INTERVAL == 0:
+            self.report(remaining)
+
+    def report(self, remaining: int):
+        elapsed = time.monotonic() - self.started
+        print(
+            f"Scraped {self.scraped} pages in {elapsed:.1f}s"
+            f" ({self.scraped / elapsed:.2f} pages/sec), remaining {remaining}"
+        )
+
+
+async def _crawl(props_list: list[CrawlProps], manifest: Manifest, incremental: bool):
+    """
+    未取得のページをキューに入れ、CONCURRENCY 個のワーカーが取り出して取得する。
+    見つかったリンクはすぐにキューに追加するので、遅いページがあっても他のページは止まらない。
+    """
+    props_by_host = {props["host"]: props for props in props_list}
+    frontier = Frontier(list(props_by_host))
+    queue: asyncio.Queue = asyncio.Queue()
+    for props in props_list:
+        await frontier.add(props.get("host"), [props.get("start_url")])
+        if incremental:
+            # 取得済みのページも全て確認し直す
+            Page.update(is_scraped=False).where(
+                Page.host == props.get("host")
+            ).execute()
+        for page in Page.select().where(
+            Page.host == props.get("host"), Page.is_scraped == False
+        ):
+            queue.put_nowait(page)
+    print(f"Remaining {queue.qsize()} pages")
+
+    host_semaphores = {
+        host: asyncio.Semaphore(PER_HOST_CONCURRENCY) for host in props_by_host
+    }
+    browser_pool = _BrowserPool()
+    stats = _Stats()
+    # ページのID -> 失敗した回数
+    failures: dict[int, int] = {}
 
-            pool.map(scrape_func, pages)
-            time.sleep(INTERVAL)
-
-
-def _scrape_page(props: CrawlProps, page: Page):
+    async def worker():
+        while True:
+            page = await queue.get()
+            try:
+                props = props_by_host[page.host]
+                async with host_semaphores[page.host]:
+                    try:
+                        links = await _scrape_page(
+                            props, page, browser_pool, manifest, incremental
+                        )
+                    finally:
+                        await asyncio.sleep(INTERVAL)
+                await frontier.done(page)
+                for new_page in await frontier.add(page.host, links):
+                    queue.put_nowait(new_page)
+                stats.add(queue.qsize())
+            except Exception as e:
+                # ワーカーが止まるとキューが空にならないので、ここで握りつぶす
+                failures[page.id] = failures.get(page.id, 0) + 1
+                if failures[page.id] < PAGE_ATTEMPTS:
+                    print(f"Retrying {page.url} later: {e!r}")
+                    queue.put_nowait(page)
+                else:
+                    print(f"Giving up {page.url} after {PAGE_ATTEMPTS} attempts: {e!r}")
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(CONCURRENCY)]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await frontier.flush()
+        await browser_pool.close()
+        stats.report(queue.qsize())
+
+
+_http_sessions = threading.local()
+_title_pattern = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+# ホストごとに、HTTPで本文が取れずにブラウザが必要になった連続回数
+_browser_fallbacks: dict[str, int] = {}
+
+
+def _get_http_session() -> requests.Session:
+    """
+    asyncio.to_thread のスレッドごとのセッションを返す。requests.Session はスレッドセーフではないので共有しない。
+    1つのスレッドが同時に送るリクエストは1つなので、ホストごとに1つの接続を使い回す。
+    """
+    session = getattr(_http_sessions, "session", None)
+    if session is None:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=CONCURRENCY, pool_maxsize=1
+        )
+        session = requests.Session()
+        session.headers.update(HTTP_HEADERS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_sessions.session = session
+    return session
+
+
+class _Fetched(TypedDict):
+    status: int
+    content: str
+    title: str
+    markdown: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+# 本文がないことが確定しているステータスコード。ブラウザで取得し直さない
+_FINAL_STATUSES = (304, 404, 410)
+
+
+def _http_fetch(url: str, conditional_headers: dict) -> _Fetched:
+    response = _get_http_session().get(
+        url, headers=conditional_headers, timeout=HTTP_TIMEOUT
+    )
+    if response.status_code not in _FINAL_STATUSES:
+        response.raise_for_status()
+    # Content-Typeにcharsetがないとrequestsは ISO-8859-1 とみなし、日本語のページが文字化けする
+    if "charset" not in response.headers.get("Content-Type", "").lower():
+        response.encoding = response.apparent_encoding
+    content = response.text
+    match = _title_pattern.search(content)
+    return _Fetched(
+        status=response.status_code,
+        content=content,
+        title=match.group(1).strip() if match else "",
+        markdown=None,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+
+
+def _extract(content: str) -> Optional[str]:
+    # HTMLコンテンツからMarkdownを抽出
+    return trafilatura.extract(content, output_format="markdown")
+
+
+def _is_js_only(props: CrawlProps) -> bool:
+    return (
+        props.get("js_only", False)
+        or _browser_fallbacks.get(props.get("host"), 0) >= JS_ONLY_AFTER
+    )
+
+
+def _conditional_headers(page: Page) -> dict:
+    headers = {}
+    if page.etag:
+        headers["If-None-Match"] = page.etag
+    if page.last_modified:
+        headers["If-Modified-Since"] = page.last_modified
+    return headers
+
+
+async def _fetch_and_extract(
+    props: CrawlProps, url: str, browser_pool: _BrowserPool, conditional_headers: dict
+) -> _Fetched:
+    """
+    fetch_strategy に従ってページを取得し、本文をMarkdownにする。
+    静的なサイトはブラウザで描画するよりHTTPで取得する方がずっと速いので、まずHTTPを試す。
+    ブラウザでは条件付きリクエストを送れないので、変更の有無は本文のハッシュで判断する。
+    """
+    strategy = props.get("fetch_strategy", "auto")
+    host = props.get("host")
+    if strategy != "browser" and not _is_js_only(props):
+        try:
+            fetched = await asyncio.to_thread(_http_fetch, url, conditional_headers)
+            if fetched["status"] in _FINAL_STATUSES:
+                return fetched
+            fetched["markdown"] = await asyncio.to_thread(_extract, fetched["content"])
+            if (
+                strategy == "http"
+                or len(fetched["markdown"] or "") >= MIN_CONTENT_LENGTH
+            ):
+                _browser_fallbacks[host] = 0
+                return fetched
+        except requests.RequestException as e:
+            if strategy == "http":
+                raise
+            print(f"HTTP fetch failed, falling back to browser: {url}: {e}")
+
+        _browser_fallbacks[host] = _browser_fallbacks.get(host, 0) + 1
+        if _browser_fallbacks[host] == JS_ONLY_AFTER:
+            print(f"Treating {host} as JavaScript only")
+
+    content, title, status = await asyncio.wait_for(
+        browser_pool.fetch(url), timeout=PAGE_TIMEOUT
+    )
+    return _Fetched(
+        status=status,
+        content=content,
+        title=title,
+        markdown=await asyncio.to_thread(_extract, content),
+        etag=None,
+        last_modified=None,
+    )
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _write_if_changed(path: Path, text: str) -> bool:
+    if path.exists() and path.read_text() == text:
+        return False
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return True
+
+
+def _remove_document(file_path: Path):
+    for path in (file_path, file_path.with_suffix(".md.metadata.json")):
+        if path.exists():
+            os.remove(path)
+
+
+def _output_path(url: str) -> Path:
+    parsed_url = urllib.parse.urlparse(url)
+    file_path = OUTPUT_DIR / parsed_url.netloc / parsed_url.path.lstrip("/")
+    if not file_path.suffix:
+        return file_path / "index.md"
+    return file_path.with_suffix(".md")
+
+
+async def _scrape_page(
+    props: CrawlProps,
+    page: Page,
+    browser_pool: _BrowserPool,
+    manifest: Manifest,
+    incremental: bool,
+) -> list[str]:
+    """
+    ページを取得して、変わっていれば保存する。見つかったリンクを返す。
+    ページの状態は page を書き換えるだけで、DBへの保存は Frontier がまとめて行う。
+    取得に失敗したときは例外を投げ、呼び出し側でやり直す。
+    """
     try:
         print(page.url)
         parsed_url = urllib.parse.urlparse(page.url)
 
-        file_path = OUTPUT_DIR / parsed_url.netloc / parsed_url.path.lstrip("/")
-        if not file_path.suffix:
-            file_path = file_path / "index.md"
-        else:
-            file_path = file_path.with_suffix(".md")
-
-        if os.path.exists(file_path):
-            exit()
-
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            context = browser.new_context()
-            browser_page = context.new_page()
-
-            browser_page.goto(page.url, wait_until="networkidle")
-            content = browser_page.content()
-
-            # HTMLコンテンツからMarkdownを抽出
-            result = trafilatura.extract(content, output_format="markdown")
-
-            os.makedirs(file_path.parent, exist_ok=True)
-            with open(file_path, "w") as f:
-                f.write(result)
-
-            _save_metadata(
-                file_path,
-                page.url,
-                browser_page.title(),
-                props.get("languages", []),
-                props.get("projects", []),
-            )
-            _discover_and_save_links(props, parsed_url.path, content.encode())
-
-            browser.close()
-
+        file_path = _output_path(page.url)
+        relative_path = file_path.relative_to(OUTPUT_DIR).as_posix()
+        exists = file_path.exists()
+        if exists and not incremental:
+            # 以前のクロールで保存済み
+            page.is_scraped = True
+            return []
+
+        # 保存済みのファイルがあるときだけ、変わっていなければ304を返してもらう
+        fetched = await _fetch_and_extract(
+            props,
+            page.url,
+            browser_pool,
+            _conditional_headers(page) if exists else {},
+        )
+
+        if fetched["status"] == 304:
+            page.is_scraped = True
+            return []
+
+        if fetched["status"] in (404, 410):
+            if exists:
+                _remove_document(file_path)
+                manifest["removed"].append(relative_path)
+            page.content_hash = None
+            page.etag = None
+            page.last_modified = None
+            page.is_scraped = True
+            return []
+
+        result = fetched["markdown"]
+        if result is None:
+            print(f"No content extracted from {page.url}")
+            return []
+
+        content_hash = _content_hash(result)
+        changed = False
+        if not exists or content_hash != page.content_hash:
+            changed = _write_if_changed(file_path, result)
+        changed |= _save_metadata(
+            file_path,
+            page.url,
+            fetched["title"],
+            props.get("languages", []),
+            props.get("projects", []),
+        )
+        if not exists:
+            manifest["added"].append(relative_path)
+        elif changed:
+            manifest["changed"].append(relative_path)
+
+        links = await asyncio.to_thread(
+            _discover_links, props, parsed_url.path, fetched["content"].encode()
+        )
+
+        page.content_hash = content_hash
+        page.etag = fetched["etag"]
+        page.last_modified = fetched["last_modified"]
         page.is_scraped = True
-        page.save()
-    except TypeError:
-        pass
+        return links
+    except asyncio.TimeoutError:
+        print(f"Timed out scraping {page.url}")
+        raise
     except Exception as e:
         print(f"Error scraping {page.url}: {e}")
-
-
-# 毎回DBにgetしてると遅すぎて発狂しそうだったのでキャッシュを持つ
-_discovered = {}
+        raise
 
 
 def _save_metadata(
     file_path: Path, url: str, title: str, languages: list[str], projects: list[str]
-):
+) -> bool:
+    """メタデータを書き出す。内容が変わっていなければ書き換えずに False を返す"""
     metadata = {
         "metadataAttributes": {
             "languages": languages,
@@ -113,11 +632,12 @@ def _save_metadata(
         }
     }
     metadata_path = file_path.with_suffix(".md.metadata.json")
-    with open(metadata_path, "w") as f:
-        json.dump(metadata, f, indent=4)
+    return _write_if_changed(metadata_path, json.dumps(metadata, indent=4))
 
 
-def _discover_and_save_links(props: CrawlProps, path: str, content: bytes):
+def _discover_links(props: CrawlProps, path: str, content: bytes) -> list[str]:
+    """クロール対象のリンクのURLを返す"""
+    links = []
     soup = BeautifulSoup(content, "lxml")
     for a in soup.findAll("a"):
         link = a.get("href")
@@ -151,14 +671,5 @@ def _discover_and_save_links(props: CrawlProps, path: str, content: bytes):
             if any(new_path.endswith(suffix) for suffix in ignore_suffixes):
                 continue
 
-        url = props.get("host", "") + new_path
-        if url in _discovered:
-            continue
-
-        if not Page.get_or_none(Page.url == url):
-            page = Page()
-            page.host = props.get("host", "")
-            page.url = url
-            page.save()
-
-        _discovered[url] = True
+        links.append(props.get("host", "") + new_path)
+    return links
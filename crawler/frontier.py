@@ -0,0 +1,83 @@
+import asyncio
+
+from peewee import chunked
+
+from models import Page, db
+
+"""
+クロール対象のURLを管理する。ワーカーは見つけたリンクを返すだけで、DBへの書き込みはここでまとめて行う。
+既知のURLはメモリ上の集合で弾き、新しいURLだけをまとめてINSERTする。
+SQLiteへの書き込みはイベントループを止めないように別のスレッドで行う。
+集合や一覧の更新はイベントループ上で済ませるので、スレッドからは触らない。
+"""
+
+# 取得したページの状態は、この件数ごとにまとめてDBに書き込む
+STATUS_BATCH_SIZE = 100
+# SQLiteの変数の数の上限に収まるように、INSERTやINの件数を分ける
+DB_BATCH_SIZE = 400
+
+
+class Frontier:
+    def __init__(self, hosts: list[str]):
+        self._seen = {
+            url
+            for (url,) in Page.select(Page.url).where(Page.host.in_(hosts)).tuples()
+        }
+        # 登録中のURL。同じリンクを別のワーカーが同時に登録しないようにする
+        self._pending: set[str] = set()
+        self._done: list[Page] = []
+
+    async def add(self, host: str, urls: list[str]) -> list[Page]:
+        """
+        まだ知らないURLを登録し、追加したページを返す。
+        登録に失敗したURLは既知にしないので、やり直したときにもう一度登録される。
+        """
+        new_urls = [
+            url
+            for url in dict.fromkeys(urls)
+            if url not in self._seen and url not in self._pending
+        ]
+        if not new_urls:
+            return []
+        self._pending.update(new_urls)
+        try:
+            pages = await asyncio.to_thread(self._insert, host, new_urls)
+        finally:
+            self._pending.difference_update(new_urls)
+        self._seen.update(new_urls)
+        return pages
+
+    def _insert(self, host: str, new_urls: list[str]) -> list[Page]:
+        pages: list[Page] = []
+        with db.atomic():
+            for batch in chunked(new_urls, DB_BATCH_SIZE):
+                Page.insert_many(
+                    [{"host": host, "url": url} for url in batch]
+                ).on_conflict_ignore().execute()
+                pages.extend(Page.select().where(Page.url.in_(batch)))
+        return pages
+
+    async def done(self, page: Page):
+        self._done.append(page)
+        if len(self._done) >= STATUS_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if not self._done:
+            return
+        # 書き込んでいる間に終わったページは次の書き込みに回す
+        pages, self._done = self._done, []
+        await asyncio.to_thread(self._update, pages)
+
+    def _update(self, pages: list[Page]):
+        with db.atomic():
+            Page.bulk_update(
+                pages,
+                fields=[
+                    Page.is_scraped,
+                    Page.etag,
+                    Page.last_modified,
+                    Page.content_hash,
+                ],
+                batch_size=DB_BATCH_SIZE // 5,
+            )
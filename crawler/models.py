@@ -1,18 +1,66 @@
+import os
 from pathlib import Path
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 
-db = SqliteDatabase(Path(__file__).resolve().parent.parent / "sqlite.db")
+# WALにすると、書き込み中も読み込みが待たされない
+db = SqliteDatabase(
+    os.environ.get(
+        "CRAWLER_DB_PATH", str(Path(__file__).resolve().parent.parent / "sqlite.db")
+    ),
+    pragmas={"journal_mode": "wal", "synchronous": "normal"},
+)
 
 
 class Page(Model):
-    host = CharField()
-    url = CharField()
+    host = CharField(index=True)
+    url = CharField(unique=True)
     is_scraped = BooleanField(default=False)
+    # 差分クロールで変更を検知するために、前回取得したときの値を持つ
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    content_hash = CharField(null=True)
 
     class Meta:
         database = db
 
 
+def _migrate():
+    if not db.table_exists("page"):
+        return
+
+    # 以前のバージョンで作ったDBには差分クロール用の列がないので追加する
+    columns = {column.name for column in db.get_columns("page")}
+    migrator = SqliteMigrator(db)
+    operations = [
+        migrator.add_column("page", name, CharField(null=True))
+        for name in ("etag", "last_modified", "content_hash")
+        if name not in columns
+    ]
+    if operations:
+        migrate(*operations)
+
+    # 以前のバージョンではURLに索引がなく、同じURLが重複して登録されていることがある
+    # 重複を除いておけば、create_tables で一意な索引を作れる
+    # 取得済みの行があればそれを残し、なければ最初に登録された行を残す
+    indexes = {index.name for index in db.get_indexes("page")}
+    if "page_url" not in indexes:
+        db.execute_sql(
+            """
+            DELETE FROM page WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY url ORDER BY is_scraped DESC, id
+                    ) AS n
+                    FROM page
+                )
+                WHERE n > 1
+            )
+            """
+        )
+
+
+_migrate()
 db.create_tables([Page])
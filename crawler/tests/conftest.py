@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# クローラーのモジュールは crawler/ をカレントディレクトリにして動かす前提で、互いをトップレベルで読み込む
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# models を読み込むとDBが作られるので、リポジトリのDBではなく一時ディレクトリに作る
+os.environ.setdefault("CRAWLER_DB_PATH", os.path.join(tempfile.mkdtemp(), "sqlite.db"))
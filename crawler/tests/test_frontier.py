@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("peewee")
+
+import frontier
+from frontier import Frontier
+from models import Page
+
+HOST = "https://example.com"
+
+
+@pytest.fixture(autouse=True)
+def empty_db():
+    Page.delete().execute()
+    yield
+    Page.delete().execute()
+
+
+def test_add_registers_only_unknown_urls():
+    async def run():
+        pages = Frontier([HOST])
+        first = await pages.add(HOST, [f"{HOST}/a", f"{HOST}/b", f"{HOST}/a"])
+        second = await pages.add(HOST, [f"{HOST}/b", f"{HOST}/c"])
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert sorted(page.url for page in first) == [f"{HOST}/a", f"{HOST}/b"]
+    assert [page.url for page in second] == [f"{HOST}/c"]
+    assert Page.select().count() == 3
+
+
+def test_add_splits_large_batches(monkeypatch):
+    monkeypatch.setattr(frontier, "DB_BATCH_SIZE", 2)
+    urls = [f"{HOST}/{i}" for i in range(5)]
+
+    pages = asyncio.run(Frontier([HOST]).add(HOST, urls))
+
+    assert sorted(page.url for page in pages) == sorted(urls)
+    assert all(isinstance(page, Page) for page in pages)
+
+
+def test_known_urls_are_loaded_from_db():
+    Page.create(host=HOST, url=f"{HOST}/a", is_scraped=True)
+
+    pages = asyncio.run(Frontier([HOST]).add(HOST, [f"{HOST}/a", f"{HOST}/b"]))
+
+    assert [page.url for page in pages] == [f"{HOST}/b"]
+
+
+def test_failed_insert_can_be_retried(monkeypatch):
+    async def run():
+        pages = Frontier([HOST])
+        insert = pages._insert
+
+        def failing_insert(host, urls):
+            raise RuntimeError("database is locked")
+
+        monkeypatch.setattr(pages, "_insert", failing_insert)
+        with pytest.raises(RuntimeError):
+            await pages.add(HOST, [f"{HOST}/a"])
+        monkeypatch.setattr(pages, "_insert", insert)
+        return await pages.add(HOST, [f"{HOST}/a"])
+
+    assert [page.url for page in asyncio.run(run())] == [f"{HOST}/a"]
+
+
+def test_done_writes_status_in_batches(monkeypatch):
+    monkeypatch.setattr(frontier, "STATUS_BATCH_SIZE", 2)
+
+    async def run():
+        pages = Frontier([HOST])
+        added = await pages.add(HOST, [f"{HOST}/a", f"{HOST}/b", f"{HOST}/c"])
+        for page in added:
+            page.is_scraped = True
+            page.content_hash = "hash"
+            await pages.done(page)
+        # 2件目で書き込まれ、3件目は flush まで残る
+        scraped = Page.select().where(Page.is_scraped == True).count()
+        await pages.flush()
+        return scraped
+
+    assert asyncio.run(run()) == 2
+    assert Page.select().where(Page.is_scraped == True).count() == 3
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("playwright")
+pytest.importorskip("trafilatura")
+
+import requests
+
+import crawler
+
+_HTML = """<html><head><title>インストール方法</title></head>
+<body><p>このページではツールのインストール方法を日本語で説明します。</p></body></html>"""
+
+
+def _install_response(monkeypatch, body: bytes, content_type: str):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.headers["Content-Type"] = content_type
+    # 実際のアダプターと同じく、ヘッダーから文字コードを決める
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+
+    class _Session:
+        def get(self, url, headers=None, timeout=None):
+            return response
+
+    monkeypatch.setattr(crawler, "_get_http_session", lambda: _Session())
+
+
+def test_http_fetch_detects_encoding_without_charset(monkeypatch):
+    # charsetがないと requests は ISO-8859-1 とみなすので、内容から判定させる
+    _install_response(monkeypatch, _HTML.encode("utf-8"), "text/html")
+
+    fetched = crawler._http_fetch("https://example.com/", {})
+
+    assert fetched["title"] == "インストール方法"
+    assert fetched["content"] == _HTML
+
+
+def test_http_fetch_respects_declared_charset(monkeypatch):
+    _install_response(
+        monkeypatch, _HTML.encode("shift_jis"), "text/html; charset=Shift_JIS"
+    )
+
+    fetched = crawler._http_fetch("https://example.com/", {})
+
+    assert fetched["content"] == _HTML